@@ -1,46 +1,358 @@
 from utils.DirectoryListener import DirectoryListener, ChangeType
-from utils.ClientFileUtils import FileUtils
-from threading import Thread
+from utils.ClientFileUtils import FileUtils, GeneratorStream
+from utils.Chunking import DELTA_MIN_SIZE
+from utils.TransferPool import TransferPool
+from utils.TrackerIndex import TrackerIndex, TrackedFile
+from utils.HashCache import HashCache
+from utils.Outbox import Outbox
+from utils.Debouncer import Debouncer, SETTLE_TIME
+from utils.Metadata import METADATA_HEADER, OFFSET_HEADER, FRAME_CONTENT_TYPE, FRAME_VERSION, Frame
+from utils.Hashing import ContentHash, DEFAULT_ALGORITHM
+from utils.Compression import Compression
+from threading import Thread, Lock
 from sqlitedict import SqliteDict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import json
+import time
 import logging
 
+# Number of small operations (folder changes, deletions, dedup creates) sent per batch request
+BATCH_SIZE = 500
+# Number of created/modified files whose MD5s are checked for on the server per request
+PROBE_SIZE = 1000
+# Number of files/folders compared against the server's copy per manifest request, when bootstrapping
+MANIFEST_SIZE = 10000
+# Files smaller than this are uploaded together in packs, rather than one request each
+PACK_MAX_FILE = 256 * 1024
+# Most bytes and files sent per pack request
+PACK_SIZE = 8 * 1024 * 1024
+PACK_FILES = 1000
+# Files at least this large are sent as resumable uploads, which continue from where they got to after an interruption
+RESUMABLE_MIN_SIZE = 64 * 1024 * 1024
+# Seconds a resumable upload may go without sending or receiving anything before it is treated as interrupted
+UPLOAD_TIMEOUT = 60
+
 
 class DropNotClient(Thread):
 
-    def __init__(self, sync_dir, target, port):
+    def __init__(self, sync_dir, target, port, concurrency=4, pool_size=None, retries=3, backoff=0.5,
+                 hash_algorithm=None, compression=None, settle_time=SETTLE_TIME):
         """
         Initialise the DropNot Client
         :param sync_dir: Directory to synchronise on the client machine
         :param target: Target DropNot Server IP/domain
         :param port: Port to access DropNot Server on
+        :param concurrency: Number of sync operations to run in parallel
+        :param pool_size: (optional) Number of keep-alive connections to the server. Defaults to concurrency
+        :param retries: Number of times to retry a request after a connection error or 502/503/504 response
+        :param backoff: Backoff factor (seconds) for exponential delay between retries
+        :param hash_algorithm: (optional) Hash algorithm for file digests, used if the server supports it.
+                               Defaults to the fastest algorithm both sides support
+        :param compression: (optional) Content-Encoding to compress uploads with, used if the server supports it, or
+                            'none' to never compress. Defaults to the preferred encoding both sides support
+        :param settle_time: Milliseconds a file's size and modified time must be unchanged before it is synced, so files
+                            being written continuously are uploaded once. 0 syncs every change straight away
         """
         logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', filename='client.log', level=logging.INFO)
         self.sync_dir = sync_dir
         self.target = target
         self.port = port
-        # Our key-value stores for client metadata
-        self.file_db = SqliteDict('client_tracker.db', tablename='files', encode=json.dumps, decode=json.loads)
-        self.folder_db = SqliteDict('client_tracker.db', tablename='folders', encode=json.dumps, decode=json.loads)
+        self.requested_hash = hash_algorithm
+        self.requested_compression = compression
+        # Negotiated with the server when the client starts
+        self.hash_algorithm = DEFAULT_ALGORITHM
+        self.compression = None
+        # Whether batches are sent as binary frames, if the server accepts them
+        self.frames = False
+        # Whether small files are uploaded in packs, until the server turns out not to accept them
+        self.packs = True
+        # Our key-value stores for client metadata, indexed in memory and written back in batches
+        self.file_db = TrackerIndex(SqliteDict('client_tracker.db', tablename='files', encode=json.dumps,
+                                               decode=json.loads),
+                                    decode=TrackedFile.from_value, encode=TrackedFile.to_value)
+        self.folder_db = TrackerIndex(SqliteDict('client_tracker.db', tablename='folders', encode=json.dumps,
+                                                 decode=json.loads))
+        # Digests of files by inode, so files that have not changed are not re-read to hash them
+        self.hash_cache = HashCache(TrackerIndex(SqliteDict('client_tracker.db', tablename='hashes',
+                                                            encode=json.dumps, decode=json.loads)))
+        # Sync operations that failed, retried with exponential backoff by the retry thread
+        self.outbox = Outbox(TrackerIndex(SqliteDict('client_tracker.db', tablename='outbox', encode=json.dumps,
+                                                     decode=json.loads)), give_up_callback=self.on_give_up)
+        # All requests share a pool of keep-alive connections to the server
+        self.session = self.create_session(pool_size or concurrency, retries, backoff)
+        # Interrupted resumable uploads are continued this many times, with exponential delay between attempts
+        self.retries = retries
+        self.backoff = backoff
+        # Sync operations run on a bounded worker pool, ordered per path
+        self.transfers = TransferPool(workers=concurrency, max_pending=concurrency * 64)
+        # Small operations waiting to be sent together to the batch endpoint
+        self.batch = []
+        self.batch_lock = Lock()
+        # Created/modified files waiting to be checked for on the server before uploading
+        self.probes = []
+        # Files identical to another file being uploaded, created from the server's copy at the end of the scan
+        self.deferred = []
+        self.probe_lock = Lock()
+        # Held while outstanding operations are sent, by the listener after each scan and by the retry thread
+        self.flush_lock = Lock()
+        # File changes are synced once the file has stopped changing
+        self.debouncer = Debouncer(self.on_change, settle_time, settled_callback=self.flush_pending)
+        # Listens for changes in the sync directory once the client is running
+        self.listener = None
         Thread.__init__(self)
 
+    @staticmethod
+    def create_session(pool_size, retries, backoff):
+        """
+        Create a requests Session with connection pooling and retry-with-backoff
+        :param pool_size: Number of connections to keep alive to the server
+        :param retries: Number of times to retry a failed request
+        :param backoff: Backoff factor (seconds) for exponential delay between retries
+        :return: requests Session
+        """
+        # Connection errors are retried for every method, as nothing has been sent yet. Read errors and error
+        # responses are only retried for methods without a request body, since streamed bodies cannot be replayed
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET', 'DELETE', 'HEAD']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
     def run(self):
         """
         Start the DropNot Client
         :return: None
         """
-        # Start a DirectoryListener thread to scan for file changes
-        dir_worker = DirectoryListener(dir=self.sync_dir,
-                                       change_callback=self.on_change,
-                                       file_db=self.file_db,
-                                       folder_db=self.folder_db)
-        Thread(name='dir_listener', target=DirectoryListener.scan_directory(dir_worker))
+        self.hash_algorithm = self.negotiate_hash()
+        logging.info('Using hash algorithm:{}'.format(self.hash_algorithm))
+        self.compression = self.negotiate_compression()
+        logging.info('Compressing uploads with:{}'.format(self.compression))
+        self.frames = self.negotiate_frames()
+        if len(self.file_db) == 0 and not set(self.folder_db.keys()) - {self.sync_dir}:
+            # With nothing tracked, every item would be hashed and sent. Only send what the server's copy lacks
+            self.bootstrap()
+        # Retry failed operations, including any left over from a previous run, as they fall due
+        Thread(name='outbox', target=self.retry_pending, daemon=True).start()
+        # Start a DirectoryListener thread to listen for file changes
+        self.listener = DirectoryListener(dir=self.sync_dir,
+                                          change_callback=self.debouncer.on_change,
+                                          file_db=self.file_db,
+                                          folder_db=self.folder_db,
+                                          scan_callback=self.on_scan_complete)
+        Thread(name='dir_listener', target=DirectoryListener.listen(self.listener))
+
+    def negotiate_hash(self):
+        """
+        Choose the hash algorithm for file digests from those the server supports
+        :return: Algorithm name. MD5 if the server does not list its algorithms (e.g. an older server)
+        """
+        try:
+            resp = self.session.get('http://{}:{}/hashes'.format(self.target, self.port))
+            supported = resp.json()['algorithms'] if resp.status_code == 200 else []
+        except (requests.RequestException, ValueError, KeyError):
+            supported = []
+        return ContentHash.negotiate(supported, self.requested_hash)
+
+    def negotiate_compression(self):
+        """
+        Choose the Content-Encoding for compressing uploads from those the server supports
+        :return: Encoding name, or None if uploads are sent uncompressed (e.g. to an older server)
+        """
+        if self.requested_compression == 'none':
+            return None
+        try:
+            resp = self.session.get('http://{}:{}/encodings'.format(self.target, self.port))
+            supported = resp.json()['encodings'] if resp.status_code == 200 else []
+        except (requests.RequestException, ValueError, KeyError):
+            supported = []
+        return Compression.negotiate(supported, self.requested_compression)
+
+    def negotiate_frames(self):
+        """
+        Check whether the server accepts batches of binary frames
+        :return: True if batches can be sent as frames, False to send JSON (e.g. to an older server)
+        """
+        try:
+            resp = self.session.get('http://{}:{}/frames'.format(self.target, self.port))
+            return resp.status_code == 200 and FRAME_VERSION in resp.json()['versions']
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return False
+
+    def bootstrap(self):
+        """
+        Reconcile an empty tracker index with the server's copy of the sync directory, e.g. when re-attaching an
+        existing mirror. A manifest of the size and modified time of every file (and its digest, if cached) is sent to
+        the server in pages, and only the items the server lacks or holds a different copy of are synced. The rest are
+        tracked as synced without being hashed. If the server does not support manifests, the listener's first scan
+        syncs everything as usual.
+        :return: None
+        """
+        page = []
+        stack = [self.sync_dir]
+        while stack:
+            dir = stack.pop()
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                                page.append((entry.path, None))
+                            elif entry.is_file():
+                                page.append((entry.path, entry.stat()))
+                        except FileNotFoundError:
+                            continue
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            while len(page) >= MANIFEST_SIZE:
+                if not self.send_manifest(page[:MANIFEST_SIZE]):
+                    return
+                page = page[MANIFEST_SIZE:]
+        if page and not self.send_manifest(page):
+            return
+        self.flush_pending()
+
+    def send_manifest(self, items):
+        """
+        Send a page of the manifest to the server, track the items it already holds as synced and queue the rest
+        :param items: List of (absolute path, os.stat_result) for files, or (absolute path, None) for folders
+        :return: True if the server compared the manifest, False if it could not (e.g. an older server)
+        """
+        stats = {os.path.relpath(path, self.sync_dir).replace("\\", "/"): (path, stat) for path, stat in items}
+        entries = []
+        for rel_path, (path, stat) in stats.items():
+            if stat is None:
+                entries.append({'path': rel_path, 'type': 'folder'})
+                continue
+            entry = {'path': rel_path, 'type': 'file', 'size': stat.st_size, 'modified': stat.st_mtime}
+            digest = self.hash_cache.get(stat, self.hash_algorithm)
+            if digest is not None:
+                entry['md5'] = digest
+            entries.append(entry)
+        body = json.dumps({'entries': entries}).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.compression is not None:
+            body = Compression.compress(body, self.compression)
+            headers['Content-Encoding'] = self.compression
+        try:
+            resp = self.session.post('http://{}:{}/manifest'.format(self.target, self.port), data=body,
+                                     headers=headers)
+            if resp.status_code != 200:
+                logging.warning('Server could not compare manifest ({}), syncing every item'.format(resp.status_code))
+                return False
+            result = resp.json()
+            synced, operations = result['synced'], result['operations']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning('Could not compare manifest, syncing every item:{}'.format(e))
+            return False
+
+        for rel_path, digest in synced.items():
+            path, stat = stats[rel_path]
+            if stat is None:
+                try:
+                    folder_encoding = FileUtils.get_folder_encoding(path, rel_path)
+                except FileNotFoundError:
+                    continue
+                folder_encoding.sync = True
+                self.folder_db[path] = folder_encoding.to_value()
+            else:
+                self.file_db[path] = TrackedFile(stat.st_mtime, stat.st_size, digest, True, stat.st_mtime_ns,
+                                                 FileUtils.get_inode(stat))
+        self.file_db.commit()
+        self.folder_db.commit()
+        logging.info('{} of {} items already synced to remote'.format(len(synced), len(items)))
+
+        changes = {('create', 'folder'): ChangeType.CreatedFolder, ('create', 'file'): ChangeType.CreatedFile,
+                   ('update', 'file'): ChangeType.ModifiedFile}
+        for operation in operations:
+            self.debouncer.on_change(changes[operation['op'], operation['type']], stats[operation['path']][0])
+        return True
 
-    def on_change(self, change: ChangeType, path):
+    def on_change(self, change: ChangeType, path, source=None):
         """
-        Handle a change in the synced folder. Callback for the DirectoryListener
+        Handle a change in the synced folder. Callback for the DirectoryListener.
+        The change is queued on the transfer pool, blocking if too many changes are already queued. A change to a path
+        whose last sync failed is merged into the operation waiting to be retried instead. Moves are synced straight
+        away, as the listener diffs the rest of its changes against the tracker index they update.
+        :param change: Value of ChangeType defining what was changed
+        :param path: Absolute path of changed file/folder
+        :param source: (optional) Absolute path the file/folder moved from, for moves
+        :return: None
+        """
+        if source is not None:
+            self.sync_move(path, source)
+            return
+        if self.outbox.coalesce(path, change):
+            logging.info('Change merged into pending retry:{}'.format(path))
+            return
+        self.transfers.submit(path, self.sync_change, change, path)
+
+    def retry_pending(self):
+        """
+        Retry failed sync operations as they fall due. Runs on its own thread
+        :return: None
+        """
+        while True:
+            self.outbox.wait()
+            try:
+                for path, change in self.outbox.take_due():
+                    self.transfers.submit(path, self.retry_change, change, path)
+                self.flush_pending()
+            except Exception:
+                logging.exception('Failed to retry pending sync operations')
+
+    def retry_change(self, change: ChangeType, path):
+        """
+        Retry a failed sync operation
+        :param change: Value of ChangeType defining what was changed
+        :param path: Absolute path of changed file/folder
+        :return: None
+        """
+        try:
+            self.sync_change(change, path)
+        except OSError:
+            # The file/folder no longer exists. The listener reports its deletion, if it was ever tracked
+            logging.info('Pending change no longer applies:{}'.format(path))
+            self.outbox.complete(path)
+        except Exception:
+            logging.exception('Retry failed:{}'.format(path))
+            self.outbox.defer(path, change)
+
+    def on_give_up(self, path, change: ChangeType):
+        """
+        Undo the tracker index's record of a change the outbox has given up retrying, and have the listener check the
+        path again, so the change is reported again rather than the server being left out of step
+        :param path: Absolute path of the changed file/folder
+        :param change: Value of ChangeType that was given up on
+        :return: None
+        """
+        if change in (ChangeType.CreatedFile, ChangeType.ModifiedFile):
+            # Untracked, so the file is reported as created
+            self.file_db.pop(path, None)
+            self.file_db.commit()
+        elif change == ChangeType.CreatedFolder:
+            self.folder_db.pop(path, None)
+            self.folder_db.commit()
+        elif change == ChangeType.DeletedFile and not os.path.lexists(path):
+            # Tracked again, so the file is reported as deleted
+            self.file_db[path] = TrackedFile(None, None, None, False)
+            self.file_db.commit()
+        elif change == ChangeType.DeletedFolder and not os.path.lexists(path):
+            self.folder_db[path] = {'type': 'folder', 'sync': False}
+            self.folder_db.commit()
+        if self.listener is not None:
+            # The inotify listener only re-scans the whole directory at start-up
+            self.listener.recheck(path)
+
+    def sync_change(self, change: ChangeType, path):
+        """
+        Synchronise a change in the synced folder to the server
         :param change: Value of ChangeType defining what was changed
         :param path: Absolute path of changed file/folder
         :return: None
@@ -63,6 +375,95 @@ class DropNotClient(Thread):
             logging.critical('Unsupported ChangeType')
             raise RuntimeError('Unsupported ChangeType')
 
+    def on_scan_complete(self):
+        """
+        Called by the DirectoryListener after each scan. Waits for all outstanding sync operations, sends any
+        partially filled batch and writes the tracker index back, so the next scan sees the results of this one.
+        :return: None
+        """
+        self.flush_pending()
+
+    def flush_pending(self):
+        """
+        Wait for all outstanding sync operations, send any partially filled batch and write the tracker index back
+        :return: None
+        """
+        with self.flush_lock:
+            self.transfers.join()
+            self.flush_probes()
+            self.transfers.join()
+            with self.probe_lock:
+                deferred, self.deferred = self.deferred, []
+            for change, path, rel_path, file_metadata in deferred:
+                self.queue_metadata_only(change, path, rel_path, file_metadata)
+            self.flush_batch()
+            self.file_db.flush()
+            self.hash_cache.flush()
+            self.folder_db.flush()
+
+    def queue_batch(self, operation, on_result):
+        """
+        Queue a small operation to be sent to the server's batch endpoint along with others
+        :param operation: Batch operation dictionary, e.g. {"op": "create", "path": ..., "data": FolderEncoding}
+        :param on_result: Callback taking the operation's response status code
+        :return: None
+        """
+        with self.batch_lock:
+            self.batch.append((operation, on_result))
+            full = len(self.batch) >= BATCH_SIZE
+        if full:
+            self.flush_batch()
+
+    def flush_batch(self):
+        """
+        Send all queued batch operations to the server
+        :return: None
+        """
+        with self.batch_lock:
+            items, self.batch = self.batch, []
+        if items:
+            self.send_batch(items)
+
+    def send_batch(self, items):
+        """
+        Send a batch of operations to the server and dispatch each result to its callback
+        :param items: List of (operation, on_result) tuples
+        :return: None
+        """
+        operations = [operation for operation, on_result in items]
+        url = 'http://{}:{}/batch'.format(self.target, self.port)
+        try:
+            if self.frames:
+                resp = self.session.post(url, data=Frame.pack_operations(operations),
+                                         headers={'Content-Type': FRAME_CONTENT_TYPE})
+            else:
+                resp = self.session.post(url, json={'operations': [DropNotClient.json_operation(operation)
+                                                                   for operation in operations]})
+            if resp.status_code == 200:
+                statuses = [result['status'] for result in resp.json()['results']]
+            else:
+                logging.error('Batch of {} operations failed on remote:{}'.format(len(items), resp.status_code))
+                statuses = [resp.status_code] * len(items)
+        except requests.RequestException as e:
+            logging.error('Batch of {} operations could not be sent:{}'.format(len(items), e))
+            statuses = [None] * len(items)
+        for (operation, on_result), status in zip(items, statuses):
+            try:
+                on_result(status)
+            except Exception:
+                logging.exception('Failed to handle batch result:{}'.format(operation.get('path')))
+
+    @staticmethod
+    def json_operation(operation):
+        """
+        Get a batch operation as it is sent in JSON
+        :param operation: Batch operation dictionary, whose data may be a FileMetadata or FolderEncoding
+        :return: Batch operation dictionary of JSON types
+        """
+        if hasattr(operation.get('data'), 'to_dict'):
+            return dict(operation, data=operation['data'].to_dict())
+        return operation
+
     def sync_new_folder(self, path, rel_path):
         """
         Synchronise creation of a folder to the server
@@ -71,20 +472,30 @@ class DropNotClient(Thread):
         :return: None
         """
         folder_encoding = FileUtils.get_folder_encoding(path, rel_path)
-        resp = requests.post('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                             json=repr(folder_encoding))
-        if resp.status_code == 200:
+        self.queue_batch({'op': 'create', 'path': rel_path, 'data': folder_encoding},
+                         lambda status: self.on_new_folder_result(path, rel_path, folder_encoding, status))
+
+    def on_new_folder_result(self, path, rel_path, folder_encoding, status):
+        """
+        Handle the server's response to a folder creation
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param folder_encoding: FolderEncoding that was sent
+        :param status: Response status code
+        :return: None
+        """
+        if status == 200:
             logging.info('Folder synced to remote:{}'.format(rel_path))
             folder_encoding.sync = True
-            self.folder_db[path] = repr(folder_encoding)
-            self.folder_db.commit()
-        elif resp.status_code == 400 or resp.status_code == 400:
-            logging.error('Folder sync unsuccessful{}'.format(rel_path))
-            self.folder_db[path] = repr(folder_encoding)
+            self.folder_db[path] = folder_encoding.to_value()
             self.folder_db.commit()
+            self.outbox.complete(path)
         else:
-            logging.critical('Unsupported response status code from remote:{}'.format(resp.status_code))
-            raise NotImplementedError('Unsupported resp status code:', resp.status_code)
+            logging.error('Folder sync unsuccessful ({}):{}'.format(status, rel_path))
+            # Tracked as unsynced, so the listener does not report it again while the outbox retries it
+            self.folder_db[path] = folder_encoding.to_value()
+            self.folder_db.commit()
+            self.outbox.defer(path, ChangeType.CreatedFolder)
 
     def sync_del_folder(self, path, rel_path):
         """
@@ -93,18 +504,28 @@ class DropNotClient(Thread):
         :param rel_path: Relative path from sync directory
         :return: None
         """
-        resp = requests.delete('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                               json={"type": "folder"})
-        if resp.status_code == 200:
+        self.queue_batch({'op': 'delete', 'path': rel_path, 'data': {'type': 'folder'}},
+                         lambda status: self.on_del_folder_result(path, rel_path, status))
+
+    def on_del_folder_result(self, path, rel_path, status):
+        """
+        Handle the server's response to a folder deletion
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param status: Response status code
+        :return: None
+        """
+        if status == 200:
             logging.info('Folder removed from remote:{}'.format(rel_path))
             self.folder_db.pop(path, None)
             self.folder_db.commit()
-        elif resp.status_code == 400 or resp.status_code == 422:
-            logging.error('Folder removal failed on remote:{}'.format(rel_path))
-            # todo: handle this?
+            self.outbox.complete(path)
         else:
-            logging.critical('Unsupported response status code from remote:{}'.format(resp.status_code))
-            raise NotImplementedError('Unsupported resp status code:', resp.status_code)
+            logging.error('Folder removal failed on remote ({}):{}'.format(status, rel_path))
+            # Untracked, so the listener does not report it again while the outbox retries it
+            self.folder_db.pop(path, None)
+            self.folder_db.commit()
+            self.outbox.defer(path, ChangeType.DeletedFolder)
 
     def sync_del_file(self, path, rel_path):
         """
@@ -113,18 +534,63 @@ class DropNotClient(Thread):
         :param rel_path: Relative path from sync directory
         :return: None
         """
-        resp = requests.delete('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                               json={"type": "file"})
-        if resp.status_code == 200:
+        self.queue_batch({'op': 'delete', 'path': rel_path, 'data': {'type': 'file'}},
+                         lambda status: self.on_del_file_result(path, rel_path, status))
+
+    def on_del_file_result(self, path, rel_path, status):
+        """
+        Handle the server's response to a file deletion
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param status: Response status code
+        :return: None
+        """
+        tracked = self.file_db.pop(path, None)
+        self.file_db.commit()
+        if tracked is not None:
+            # The file is gone, so its cached digest will not be used again
+            self.hash_cache.forget(TrackedFile.from_value(tracked).inode)
+        if status == 200:
             logging.info('File removed from remote:{}'.format(rel_path))
-            self.file_db.pop(path, None)
-            self.file_db.commit()
-        elif resp.status_code == 400 or resp.status_code == 400:
-            logging.error('File removal failed on remote:{}'.format(rel_path))
-            # todo: handle this?
+            self.outbox.complete(path)
         else:
-            logging.critical('Unsupported response status code from remote:{}'.format(resp.status_code))
-            raise NotImplementedError('Unsupported resp status code:', resp.status_code)
+            logging.error('File removal failed on remote ({}):{}'.format(status, rel_path))
+            # Untracked, so the listener does not report it again while the outbox retries it
+            self.outbox.defer(path, ChangeType.DeletedFile)
+
+    def sync_move(self, path, source):
+        """
+        Synchronise a file/folder move or rename to the server, which moves its copy rather than being sent the content
+        again. If the server cannot move it, the tracker index is left unchanged, so the listener reports the move as a
+        deletion and a creation instead.
+        :param path: Absolute path moved to
+        :param source: Absolute path moved from
+        :return: None
+        """
+        rel_path = os.path.relpath(path, self.sync_dir).replace("\\", "/")
+        rel_source = os.path.relpath(source, self.sync_dir).replace("\\", "/")
+        # Operations already queued on the source must reach the server first
+        self.flush_pending()
+        if self.outbox.pending(source):
+            logging.info('Not moving on remote, as changes to it are waiting to be retried:{}'.format(rel_source))
+            return
+        try:
+            resp = self.session.post('http://{}:{}/move/{}'.format(self.target, self.port, rel_source),
+                                     json={'to': rel_path})
+            status = resp.status_code
+        except requests.RequestException as e:
+            logging.error('Could not send move to remote:{}'.format(e))
+            status = None
+        if status != 200:
+            logging.warning('Move failed on remote ({}), sending it again:{}'.format(status, rel_path))
+            return
+        logging.info('Moved on remote:{} -> {}'.format(rel_source, rel_path))
+        prefix = os.path.join(source, '')
+        for db in (self.folder_db, self.file_db):
+            for key in db.keys():
+                if key == source or key.startswith(prefix):
+                    db[path + key[len(source):]] = db.pop(key)
+            db.flush()
 
     def sync_new_file(self, path, rel_path):
         """
@@ -133,73 +599,344 @@ class DropNotClient(Thread):
         :param rel_path: Relative path from sync directory
         :return: None
         """
-        file_encoding = FileUtils.get_file_encoding(path, rel_path)
-        file_metadata = FileUtils.get_metadata(file_encoding)
+        file_metadata = FileUtils.get_file_metadata(path, rel_path, self.hash_algorithm, self.hash_cache)
+        self.queue_probe(ChangeType.CreatedFile, path, rel_path, file_metadata)
 
-        if self.check_file_exists(file_metadata.md5):
-            # Only send metadata, not the binary
-            resp = requests.post('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                                 json=repr(file_metadata))
-        else:
-            # Send metadata and binary
-            resp = requests.post('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                                 json=repr(file_encoding))
-
-        if resp.status_code == 200:
-            logging.info('File creation synced to remote:{}'.format(rel_path))
+    def sync_edit_file(self, path, rel_path):
+        """
+        Synchronise a file edit to the server
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :return: None
+        """
+        file_metadata = FileUtils.get_file_metadata(path, rel_path, self.hash_algorithm, self.hash_cache)
+        tracked = self.file_db.get(path)
+        if tracked is not None and tracked.sync and tracked.md5 == file_metadata.md5:
+            # Only the modified time changed, so the server's copy is already up to date
+            logging.info('File modified time changed without content changing:{}'.format(rel_path))
             file_metadata.sync = True
-            self.file_db[path] = repr(file_metadata)
-            self.file_db.commit()
-        elif resp.status_code == 400 or resp.status_code == 422:
-            logging.error('File creation sync unsuccessful:{}'.format(rel_path))
-            self.file_db[path] = repr(file_metadata)
+            self.file_db[path] = TrackedFile.from_metadata(file_metadata)
             self.file_db.commit()
-            # todo: handle this?
-        else:
-            logging.critical('Unsupported response status code from remote:{}'.format(resp.status_code))
-            raise NotImplementedError('Unsupported resp status code:', resp.status_code)
+            self.outbox.complete(path)
+            return
+        self.queue_probe(ChangeType.ModifiedFile, path, rel_path, file_metadata)
 
-    def sync_edit_file(self, path, rel_path):
+    def queue_probe(self, change, path, rel_path, file_metadata):
         """
-        Synchronise a file edit to the server
+        Queue a created/modified file, whose content will be checked for on the server along with others
+        :param change: ChangeType.CreatedFile or ChangeType.ModifiedFile
         :param path: Path including sync directory on Client machine
         :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
         :return: None
         """
-        file_encoding = FileUtils.get_file_encoding(path, rel_path)
-        file_metadata = FileUtils.get_metadata(file_encoding)
+        with self.probe_lock:
+            self.probes.append((change, path, rel_path, file_metadata))
+            full = len(self.probes) >= PROBE_SIZE
+        if full:
+            self.flush_probes()
 
-        if self.check_file_exists(file_metadata.md5):
-            # Only send metadata, not the binary
-            resp = requests.put('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                                json=repr(file_metadata))
-        else:
-            # Send metadata and binary
-            resp = requests.put('http://{}:{}/sync/{}'.format(self.target, self.port, rel_path),
-                                json=repr(file_encoding))
+    def flush_probes(self):
+        """
+        Ask the server which queued files' content it already holds. Those files are created from the server's copy
+        via the batch endpoint, and the binaries of the rest are queued for upload, small files together in packs.
+        :return: None
+        """
+        with self.probe_lock:
+            items, self.probes = self.probes, []
+        if not items:
+            return
 
-        if resp.status_code == 200:
-            logging.info('File modification synced to remote:{}'.format(rel_path))
+        present = self.check_files_exist([file_metadata.md5 for change, path, rel_path, file_metadata in items])
+        uploading = set()
+        packed = []
+        for change, path, rel_path, file_metadata in items:
+            if file_metadata.md5 in present:
+                # The server already holds identical content, so only the metadata is sent
+                self.queue_metadata_only(change, path, rel_path, file_metadata)
+                continue
+            if file_metadata.md5 in uploading:
+                # Identical to a file being uploaded, so only the metadata is sent once that upload has finished
+                with self.probe_lock:
+                    self.deferred.append((change, path, rel_path, file_metadata))
+                continue
+
+            uploading.add(file_metadata.md5)
+            if self.frames and self.packs and file_metadata.size < PACK_MAX_FILE:
+                packed.append((change, path, rel_path, file_metadata))
+            elif change == ChangeType.CreatedFile:
+                self.transfers.submit(path, self.upload_new_file, path, rel_path, file_metadata, block=False)
+            else:
+                self.transfers.submit(path, self.upload_edited_file, path, rel_path, file_metadata, block=False)
+
+        pack, size = [], 0
+        for item in packed:
+            pack.append(item)
+            size += item[3].size
+            if len(pack) >= PACK_FILES or size >= PACK_SIZE or item is packed[-1]:
+                # Keyed by every file in the pack, so it stays in order with other changes to any of them
+                self.transfers.submit([path for change, path, rel_path, file_metadata in pack], self.upload_pack,
+                                      pack, block=False)
+                pack, size = [], 0
+
+    def queue_metadata_only(self, change, path, rel_path, file_metadata):
+        """
+        Queue a file creation or modification whose content the server already holds on the batch endpoint
+        :param change: ChangeType.CreatedFile or ChangeType.ModifiedFile
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
+        :return: None
+        """
+        op = 'create' if change == ChangeType.CreatedFile else 'update'
+        self.queue_batch({'op': op, 'path': rel_path, 'data': file_metadata},
+                         self.file_result_callback(path, rel_path, file_metadata, change))
+
+    def upload_new_file(self, path, rel_path, file_metadata):
+        """
+        Upload the binary of a new file to the server
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
+        :return: None
+        """
+        try:
+            status = self.upload_file(self.session.post, path, rel_path, file_metadata).status_code
+        except (requests.RequestException, OSError) as e:
+            logging.error('File upload interrupted:{}:{}'.format(rel_path, e))
+            status = None
+        self.on_file_result(path, rel_path, file_metadata, status, ChangeType.CreatedFile)
+
+    def upload_edited_file(self, path, rel_path, file_metadata):
+        """
+        Upload a modified file to the server, as a delta for large files
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
+        :return: None
+        """
+        try:
+            resp = None
+            if file_metadata.size >= DELTA_MIN_SIZE:
+                # Try sending only the changed chunks of large files, falling back to a full upload
+                resp = self.upload_delta(path, rel_path, file_metadata)
+            if resp is None or resp.status_code != 200:
+                resp = self.upload_file(self.session.put, path, rel_path, file_metadata)
+            status = resp.status_code
+        except (requests.RequestException, OSError) as e:
+            logging.error('File upload interrupted:{}:{}'.format(rel_path, e))
+            status = None
+        self.on_file_result(path, rel_path, file_metadata, status, ChangeType.ModifiedFile)
+
+    def upload_pack(self, items):
+        """
+        Upload the binaries of many small files in one request, as a pack of file encoding frames each followed by the
+        file binary. Falls back to uploading each file on its own if the server does not accept packs
+        :param items: List of (change, path, rel_path, file_metadata) tuples
+        :return: None
+        """
+        body = bytearray()
+        packed = []
+        for change, path, rel_path, file_metadata in items:
+            try:
+                with open(path, 'rb') as file:
+                    binary = file.read(file_metadata.size + 1)
+            except OSError as e:
+                logging.error('File could not be read:{}:{}'.format(rel_path, e))
+                binary = None
+            if binary is None or len(binary) != file_metadata.size:
+                # The file changed since it was hashed, so it is retried from the outbox rather than sent
+                self.on_file_result(path, rel_path, file_metadata, None, change)
+                continue
+            body += file_metadata.pack(binary=True)
+            body += binary
+            packed.append((change, path, rel_path, file_metadata))
+        if not packed:
+            return
+
+        url = 'http://{}:{}/pack'.format(self.target, self.port)
+        headers = {'Content-Type': FRAME_CONTENT_TYPE}
+        if self.compression is not None:
+            headers['Content-Encoding'] = self.compression
+            body = Compression.compress(bytes(body), self.compression)
+        try:
+            resp = self.session.post(url, data=bytes(body), headers=headers)
+            if resp.status_code in (404, 405):
+                logging.info('Server does not accept packs, uploading files one at a time')
+                self.packs = False
+                for change, path, rel_path, file_metadata in packed:
+                    if change == ChangeType.CreatedFile:
+                        self.upload_new_file(path, rel_path, file_metadata)
+                    else:
+                        self.upload_edited_file(path, rel_path, file_metadata)
+                return
+            if resp.status_code == 200:
+                statuses = [result['status'] for result in resp.json()['results']]
+            else:
+                logging.error('Pack of {} files failed on remote:{}'.format(len(packed), resp.status_code))
+                statuses = [resp.status_code] * len(packed)
+        except requests.RequestException as e:
+            logging.error('Pack of {} files could not be sent:{}'.format(len(packed), e))
+            statuses = []
+        # Files after a malformed frame have no result, and are retried from the outbox
+        statuses += [None] * (len(packed) - len(statuses))
+        for (change, path, rel_path, file_metadata), status in zip(packed, statuses):
+            self.on_file_result(path, rel_path, file_metadata, status, change)
+
+    def file_result_callback(self, path, rel_path, file_metadata, change):
+        """
+        Get a batch result callback for a file creation or modification
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata that was sent
+        :param change: ChangeType.CreatedFile or ChangeType.ModifiedFile
+        :return: Callback taking the response status code
+        """
+        return lambda status: self.on_file_result(path, rel_path, file_metadata, status, change)
+
+    def on_file_result(self, path, rel_path, file_metadata, status, change):
+        """
+        Handle the server's response to a file creation or modification
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata that was sent
+        :param status: Response status code, or None if the request could not be sent
+        :param change: ChangeType.CreatedFile or ChangeType.ModifiedFile
+        :return: None
+        """
+        action = 'creation' if change == ChangeType.CreatedFile else 'modification'
+        if status == 200:
+            logging.info('File {} synced to remote:{}'.format(action, rel_path))
             file_metadata.sync = True
-            self.file_db[path] = repr(file_metadata)
-            self.file_db.commit()
-        elif resp.status_code == 400 or resp.status_code == 422:
-            logging.info('File modification sync unsuccessful:{}'.format(rel_path))
-            self.file_db[path] = repr(file_metadata)
+            self.file_db[path] = TrackedFile.from_metadata(file_metadata)
             self.file_db.commit()
-            # todo: handle this?
+            self.outbox.complete(path)
         else:
-            logging.critical('Unsupported response status code from remote:{}'.format(resp.status_code))
-            raise NotImplementedError('Unsupported resp status code:', resp.status_code)
+            logging.error('File {} sync unsuccessful ({}):{}'.format(action, status, rel_path))
+            # Tracked as unsynced, so the listener does not report it again while the outbox retries it
+            self.file_db[path] = TrackedFile.from_metadata(file_metadata)
+            self.file_db.commit()
+            self.outbox.defer(path, change)
+
+    def upload_file(self, method, path, rel_path, file_metadata):
+        """
+        Send a file to the server, streaming the binary from disk in the request body with the metadata in a header
+        :param method: Session method to send with (session.post for new files, session.put for edits)
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
+        :return: Server response
+        """
+        if file_metadata.size >= RESUMABLE_MIN_SIZE:
+            resp = self.upload_resumable(path, rel_path, file_metadata)
+            if resp is not None:
+                return resp
+
+        url = 'http://{}:{}/sync/{}'.format(self.target, self.port, rel_path)
+        headers = {'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(file_metadata)}
+        if self.compression is not None and Compression.should_compress(path, file_metadata.size):
+            # The compressed size is not known up front, so the body is sent with chunked transfer encoding
+            headers['Content-Encoding'] = self.compression
+            return method(url, data=Compression.compress_file(path, self.compression), headers=headers)
+        with open(path, 'rb') as file:
+            return method(url, data=file, headers=headers)
+
+    def upload_resumable(self, path, rel_path, file_metadata):
+        """
+        Send a file to the server as a resumable upload. If the connection drops, the upload continues from the last
+        byte the server acknowledged, rather than starting again.
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
+        :return: Server response, or None if the server does not support resumable uploads
+        """
+        url = 'http://{}:{}/upload/{}'.format(self.target, self.port, rel_path)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** attempt)
+            try:
+                # Ask where the upload got to. An interrupted upload of the same content continues from there
+                resp = self.session.post(url, headers={METADATA_HEADER: repr(file_metadata)}, timeout=UPLOAD_TIMEOUT)
+                if resp.status_code in (404, 405):
+                    return None
+                if resp.status_code == 409:
+                    # A previous attempt that stalled still holds the upload, until the server gives up on it
+                    continue
+                if resp.status_code != 200:
+                    return resp
+                upload = resp.json()
+                if upload['offset'] > 0:
+                    logging.info('Resuming upload from byte {}:{}'.format(upload['offset'], rel_path))
+                resp = self.send_upload(path, file_metadata, upload['id'], upload['offset'])
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt == self.retries:
+                    raise
+                logging.warning('Upload interrupted:{}'.format(rel_path))
+                continue
+            if resp.status_code not in (202, 409):
+                return resp
+        return resp
 
-    def check_file_exists(self, md5):
+    def send_upload(self, path, file_metadata, upload_id, offset):
         """
-        Check whether a file matching the md5 already exists on the remote
-        :param md5: md5 hash
-        :return: True if an identical file exists, False otherwise
+        Send the rest of a file to a resumable upload session
+        :param path: Path including sync directory on Client machine
+        :param file_metadata: FileMetadata for the file
+        :param upload_id: Session ID
+        :param offset: Byte to continue from
+        :return: Server response
         """
-        resp = requests.get('http://{}:{}/sync/exists/{}'.format(self.target, self.port, md5))
+        url = 'http://{}:{}/upload/{}'.format(self.target, self.port, upload_id)
+        headers = {'Content-Type': 'application/octet-stream', OFFSET_HEADER: str(offset)}
+        if self.compression is not None and Compression.should_compress(path, file_metadata.size):
+            headers['Content-Encoding'] = self.compression
+            return self.session.put(url, data=Compression.compress_file(path, self.compression, offset),
+                                    headers=headers, timeout=UPLOAD_TIMEOUT)
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            return self.session.put(url, data=file, headers=headers, timeout=UPLOAD_TIMEOUT)
+
+    def upload_delta(self, path, rel_path, file_metadata):
+        """
+        Send an edited file to the server as a delta of content-defined chunks, uploading only the chunks
+        that the server's copy of the file does not already contain.
+        :param path: Path including sync directory on Client machine
+        :param rel_path: Relative path from sync directory
+        :param file_metadata: FileMetadata for the file
+        :return: Server response, or None if the server has no copy of the file to delta against
+        """
+        url = 'http://{}:{}/delta/{}'.format(self.target, self.port, rel_path)
+        chunks = FileUtils.get_file_chunks(path)
+        resp = self.session.post(url, json={'chunks': chunks})
+        if resp.status_code != 200:
+            return None
+
+        missing = set(resp.json()['missing'])
+        preamble = (json.dumps(chunks) + '\n').encode('utf-8')
+        length = len(preamble) + sum(size for md5, size in {(md5, size) for md5, size in chunks if md5 in missing})
+
+        def body():
+            yield preamble
+            yield from FileUtils.read_chunks(path, chunks, missing)
+
+        logging.info('Sending delta of {}/{} chunks:{}'.format(len(missing), len(chunks), rel_path))
+        return self.session.put(url, data=GeneratorStream(body(), length),
+                                headers={'Content-Type': 'application/octet-stream',
+                                         METADATA_HEADER: repr(file_metadata)})
+
+    def check_files_exist(self, md5s):
+        """
+        Check which files already exist on the remote, by their md5
+        :param md5s: List of md5 hashes
+        :return: Set of the md5s with an identical file on the remote
+        """
+        try:
+            resp = self.session.post('http://{}:{}/exists'.format(self.target, self.port), json={'md5s': md5s})
+        except requests.RequestException as e:
+            # Every file is uploaded, and retried from the outbox if the server is unreachable
+            logging.error('Could not check for files on remote:{}'.format(e))
+            return set()
         if resp.status_code == 200:
-            return True
+            return set(resp.json()['present'])
         else:
-            return False
+            return set()
@@ -3,6 +3,10 @@ import click
 from threading import Thread
 from client import Client
 from server import Server
+from server.Production import ProductionServer
+from server.AsyncServer import AsyncServer
+from utils.Hashing import ContentHash
+from utils.Compression import Compression
 import time
 
 
@@ -11,20 +15,51 @@ import time
 @click.option('--target', '-t', type=str, help="DropNot server domain")
 @click.option('--server', '-s', type=click.Path(exists=True), help="Launch in Server mode")
 @click.option('--port', '-p', default=5000, type=int, help="Port for DropNot Server")
-def launch(client, target, server, port):
+@click.option('--concurrency', default=4, type=int, help="Number of parallel transfers in Client mode")
+@click.option('--hash', 'hash_algorithm', type=click.Choice(ContentHash.available()),
+              help="File hash algorithm in Client mode. Defaults to the fastest the server supports")
+@click.option('--compress', 'compression', type=click.Choice(Compression.available() + ['none']),
+              help="Upload compression in Client mode. Defaults to the best the server supports")
+@click.option('--settle', default=2000, type=int,
+              help="Milliseconds a file must be unchanged before it is uploaded in Client mode. 0 uploads straight away")
+@click.option('--workers', default=0, type=int,
+              help="Number of worker processes in Server mode. 0 runs the Flask development server")
+@click.option('--threads', default=4, type=int,
+              help="Number of request threads per worker process (or disk I/O threads with --async) in Server mode")
+@click.option('--async', 'async_mode', is_flag=True,
+              help="Serve with asyncio in Server mode, keeping many uploads open without a thread for each")
+def launch(client, target, server, port, concurrency, hash_algorithm, compression, settle, workers, threads,
+           async_mode):
     print("Launching with client:", client, "targeting", target)
     print("Launching with server:", server)
 
     if client:
         client_dir = os.path.abspath(client)  # Convert relative paths to absolute path
         print("Starting Client, synchronising directory:", client_dir)
-        client = Client.DropNotClient(client_dir, target, port)
+        client = Client.DropNotClient(client_dir, target, port, concurrency, hash_algorithm=hash_algorithm,
+                                      compression=compression, settle_time=settle)
         client.daemon = True
         client.start()
 
     if server:
         server_dir = os.path.abspath(server)  # Convert relative paths to absolute path
         print("Starting Server, synchronising files to:", server_dir)
+        if async_mode:
+            try:
+                async_server = AsyncServer(server_dir, threads=threads)
+            except ImportError as e:
+                raise click.UsageError(str(e))
+            # Runs in the main thread, which owns the event loop
+            async_server.run('0.0.0.0', port)
+            return
+        if workers > 0:
+            try:
+                production = ProductionServer(server_dir, '0.0.0.0', port, workers=workers, threads=threads)
+            except ImportError as e:
+                raise click.UsageError(str(e))
+            # Runs in the main thread, as gunicorn manages its workers with signals
+            production.run()
+            return
         server = Server.initialise(server_dir)
         server = Thread(target=server.run, kwargs={'host': '0.0.0.0', 'port': port})
         server.daemon = True
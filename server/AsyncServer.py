@@ -0,0 +1,258 @@
+from concurrent.futures import ThreadPoolExecutor
+from server import Server
+from utils.ServerFileUtils import ServerFileUtils, UploadWriter, UploadOffsetError
+from utils.ServerStore import ServerStore
+from utils.MerkleTree import MerkleTree
+from utils.Compression import Compression, ENCODINGS
+from utils.Metadata import METADATA_HEADER, OFFSET_HEADER, CHUNK_SIZE
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from tempfile import SpooledTemporaryFile
+import asyncio
+import logging
+import json
+
+try:
+    from aiohttp import web
+except ImportError:
+    # aiohttp is optional, only needed for the asyncio server mode
+    web = None
+
+# Bodies of delegated requests are held in memory up to this size, then spooled to disk
+SPOOL_SIZE = 1024 * 1024
+
+
+class AsyncServer:
+    """
+    Serves DropNot with asyncio (aiohttp), so thousands of uploads can be open at once without a thread for each.
+    Streamed file uploads are handled natively: the body is read without blocking the event loop, and each block is
+    hashed and written to disk on a small thread pool. Every other route is passed to the Flask app, which runs on the
+    same thread pool, so both modes share one implementation of the protocol.
+    """
+
+    def __init__(self, sync_dir, threads=8, store=None):
+        """
+        Initialise the AsyncServer
+        :param sync_dir: Directory to sync files to
+        :param threads: Number of threads for disk I/O, hashing and database access
+        :param store: (optional): Use non-default ServerStore (used for Unit testing)
+        """
+        if web is None:
+            raise ImportError('Asyncio mode requires aiohttp (pip install aiohttp)')
+        self.sync_dir = sync_dir
+        self.store = store if store is not None else ServerStore('server_tracker.db')
+        self.hash_db = self.store.table('hashmap')
+        # Metadata writes keep the folder hashes up to date
+        self.meta_db = MerkleTree(self.store.table('metadata'), self.store.table('tree'), sync_dir)
+        self.ref_db = self.store.table('refs')
+        self.upload_db = self.store.table('uploads')
+        self.chunk_db = self.store.table('chunks')
+        self.flask_app = Server.initialise(sync_dir, hash_db=self.hash_db, meta_db=self.meta_db,
+                                           chunk_db=self.chunk_db, ref_db=self.ref_db,
+                                           upload_db=self.upload_db, store=self.store)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='dropnot-io')
+
+    def app(self):
+        """
+        Build the aiohttp application
+        :return: aiohttp web.Application
+        """
+        # Compressed uploads are decompressed by write_block(), which stops at the file's expected size
+        app = web.Application(handler_args={'auto_decompress': False})
+        app.router.add_route('POST', '/sync/{path:.+}', self.upload)
+        app.router.add_route('PUT', '/sync/{path:.+}', self.upload)
+        app.router.add_route('PUT', '/upload/{upload_id}', self.append_upload)
+        app.router.add_route('*', '/{tail:.*}', self.delegate)
+        app.on_cleanup.append(self.cleanup)
+        return app
+
+    def run(self, host, port):
+        """
+        Serve until interrupted
+        :param host: Address to listen on
+        :param port: Port to listen on
+        :return: None
+        """
+        web.run_app(self.app(), host=host, port=port, print=None)
+
+    async def cleanup(self, app):
+        self.executor.shutdown(wait=True)
+        self.store.close()
+
+    async def in_executor(self, func, *args):
+        """
+        Run a blocking function on the I/O thread pool
+        :param func: Function to run
+        :param args: Function arguments
+        :return: Function result
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def upload(self, request):
+        """
+        Create or update a file on the server from the binary streamed in the request body.
+        Uploads in the JSON format are passed to the Flask app.
+        :param request: aiohttp Request
+        :return: 200 success. 400 invalid request. 422 file corrupted in transmission.
+        """
+        if request.content_type != 'application/octet-stream':
+            return await self.delegate(request)
+
+        path = request.match_info['path']
+        try:
+            target_path = ServerFileUtils.resolve_path(self.sync_dir, path)
+            meta = json.loads(request.headers[METADATA_HEADER])
+            if meta.get('type') != 'file':
+                raise KeyError('Invalid data type received')
+            encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+            decompressor = None if encoding == 'identity' else Compression.decompressor(encoding, meta['size'])
+            writer = await self.in_executor(UploadWriter, target_path, meta)
+        except (KeyError, ValueError) as e:
+            return web.Response(text=str(e), status=400)
+
+        try:
+            async for block in request.content.iter_chunked(CHUNK_SIZE):
+                await self.in_executor(self.write_block, writer, decompressor, block)
+            if decompressor is not None:
+                decompressor.finish()
+            await self.in_executor(self.finish_upload, writer, target_path, meta)
+        except IOError as e:
+            writer.abort()
+            logging.warning('IOError when streaming a file. '
+                            'This is thrown if the MD5 checksum does not match a file. '
+                            'This may be because of corruption during transmission')
+            return web.Response(text=str(e), status=422)
+        except BaseException:
+            # Client disconnected, or the server is shutting down
+            writer.abort()
+            raise
+        logging.info('File {}:{}'.format('created' if request.method == 'POST' else 'updated', path))
+        return web.Response(text='OK')
+
+    @staticmethod
+    def write_block(writer, decompressor, block):
+        """
+        Decompress (if needed), hash and write the next block of an upload
+        :param writer: UploadWriter
+        :param decompressor: Decompressor, or None if the upload is not compressed
+        :param block: Bytes received
+        :return: None
+        """
+        if decompressor is not None:
+            block = decompressor.decompress(block)
+        writer.write(block)
+
+    def finish_upload(self, writer, target_path, meta):
+        """
+        Verify an upload, move it into place and record its metadata
+        :param writer: UploadWriter
+        :param target_path: File path on the server
+        :param meta: Dictionary containing the file's metadata
+        :return: None
+        """
+        md5 = writer.finish()
+        with self.store.transaction():
+            ServerFileUtils.record_file(self.hash_db, self.meta_db, target_path, meta, md5, ref_db=self.ref_db,
+                                        chunk_db=self.chunk_db)
+
+    def transact(self, func, *args):
+        """
+        Run a function in a store transaction. Called on the I/O thread pool.
+        :param func: Function to run
+        :param args: Function arguments
+        :return: Function result
+        """
+        with self.store.transaction():
+            return func(*args)
+
+    async def append_upload(self, request):
+        """
+        Continue a resumable upload from the binary streamed in the request body (see Server.append_upload())
+        :param request: aiohttp Request
+        :return: 200/202 with JSON {"offset": ...}. 400 invalid request. 404 unknown session. 409 with the offset to
+                 continue from. 422 file corrupted in transmission.
+        """
+        upload_id = request.match_info['upload_id']
+        try:
+            offset = int(request.headers[OFFSET_HEADER])
+        except (KeyError, ValueError):
+            return web.Response(text='Missing or invalid {} header'.format(OFFSET_HEADER), status=400)
+        encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding != 'identity' and encoding not in ENCODINGS:
+            # Refused before the session is claimed, so it is left untouched
+            return web.Response(text='Unsupported Content-Encoding: {}'.format(encoding), status=400)
+        try:
+            session, writer = await self.in_executor(self.transact, ServerFileUtils.claim_upload, self.upload_db,
+                                                     upload_id, offset)
+        except FileNotFoundError as e:
+            return web.Response(text=str(e), status=404)
+        except UploadOffsetError as e:
+            return web.json_response({'offset': e.offset}, status=409)
+
+        size = session['meta']['size']
+        try:
+            decompressor = None if encoding == 'identity' else Compression.decompressor(encoding, size - offset)
+            async for block in request.content.iter_chunked(CHUNK_SIZE):
+                await self.in_executor(self.write_block, writer, decompressor, block)
+                if ServerFileUtils.should_acknowledge(session, writer):
+                    await self.in_executor(self.transact, ServerFileUtils.acknowledge_upload, self.upload_db,
+                                           upload_id, session, writer)
+            if decompressor is not None and writer.size == size:
+                decompressor.finish()
+        except UploadOffsetError as e:
+            # Another request took over the session
+            return web.json_response({'offset': e.offset}, status=409)
+        except BaseException as e:
+            # Keep what was received, so the upload can be resumed
+            try:
+                await self.in_executor(self.transact, ServerFileUtils.acknowledge_upload, self.upload_db, upload_id,
+                                       session, writer, True)
+            except UploadOffsetError as lost:
+                return web.json_response({'offset': lost.offset}, status=409)
+            writer.close()
+            if isinstance(e, KeyError):
+                return web.Response(text=str(e), status=400)
+            if isinstance(e, IOError):
+                return web.Response(text=str(e), status=422)
+            raise
+
+        try:
+            received = await self.in_executor(self.transact, ServerFileUtils.end_upload, self.hash_db, self.meta_db,
+                                              self.upload_db, upload_id, session, writer, self.ref_db, self.chunk_db)
+        except IOError as e:
+            logging.warning('IOError when continuing a resumable upload. '
+                            'This is thrown if the MD5 checksum does not match a file. '
+                            'This may be because of corruption during transmission')
+            return web.Response(text=str(e), status=422)
+        if received < size:
+            return web.json_response({'offset': received}, status=202)
+        logging.info('File uploaded:{}'.format(session['meta']['path']))
+        return web.json_response({'offset': received})
+
+    async def delegate(self, request):
+        """
+        Handle a request with the Flask app. The body is read first, so the app never blocks on the network.
+        :param request: aiohttp Request
+        :return: aiohttp Response
+        """
+        body = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        size = 0
+        try:
+            async for block in request.content.iter_chunked(CHUNK_SIZE):
+                size += len(block)
+                if size > SPOOL_SIZE:
+                    # Large bodies are written to disk
+                    await self.in_executor(body.write, block)
+                else:
+                    body.write(block)
+            body.seek(0)
+            headers = [(key, value) for key, value in request.headers.items()
+                       if key.lower() not in ('content-length', 'content-type')]
+            environ = EnvironBuilder(path=request.raw_path, method=request.method, headers=headers,
+                                     input_stream=body, content_length=size,
+                                     content_type=request.headers.get('Content-Type')).get_environ()
+            app_iter, status, response_headers = await self.in_executor(run_wsgi_app, self.flask_app, environ, True)
+        finally:
+            body.close()
+        return web.Response(body=b''.join(app_iter), status=int(status.split()[0]),
+                            headers={key: value for key, value in response_headers
+                                     if key.lower() != 'content-length'})
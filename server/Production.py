@@ -0,0 +1,47 @@
+from server import Server
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # gunicorn is optional, and not available on Windows
+    BaseApplication = object
+
+
+class ProductionServer(BaseApplication):
+    """
+    Serves the DropNot Flask app with gunicorn: a pre-forked pool of worker processes, each running a pool of threads
+    """
+
+    def __init__(self, sync_dir, host, port, workers=4, threads=4, timeout=120):
+        """
+        Initialise the ProductionServer
+        :param sync_dir: Directory to sync files to
+        :param host: Address to listen on
+        :param port: Port to listen on
+        :param workers: Number of worker processes
+        :param threads: Number of request threads per worker process
+        :param timeout: Seconds a worker may go without responding before it is restarted
+        """
+        if BaseApplication is object:
+            raise ImportError('Production mode requires gunicorn (pip install gunicorn), which is not available on '
+                              'Windows')
+        self.sync_dir = sync_dir
+        self.options = {
+            'bind': '{}:{}'.format(host, port),
+            'workers': workers,
+            'threads': threads,
+            # Threaded workers, so a slow upload only occupies one thread rather than a whole process
+            'worker_class': 'gthread',
+            'timeout': timeout,
+            'graceful_timeout': 30,
+            'keepalive': 5,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Called in each worker process after it forks, so database connections are never shared between processes
+        return Server.initialise(self.sync_dir)
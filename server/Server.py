@@ -1,75 +1,208 @@
 from flask import Flask, request
-from utils.ServerFileUtils import ServerFileUtils
-from sqlitedict import SqliteDict
+from utils.ServerFileUtils import ServerFileUtils, UploadOffsetError
+from utils.Metadata import METADATA_HEADER, OFFSET_HEADER, FRAME_CONTENT_TYPE, FRAME_VERSION, ENCODING_RECORD, Frame
+from utils.ServerStore import ServerStore
+from utils.MerkleTree import MerkleTree
+from utils.Hashing import ContentHash
+from utils.Compression import Compression
 import json
-import os
-import hashlib
 import logging
 
+# Largest manifest, decompressed, the server will read in one request
+MANIFEST_LIMIT = 64 * 1024 * 1024
+# Largest pack of files, decompressed, the server will read in one request
+PACK_LIMIT = 256 * 1024 * 1024
 
-def initialise(sync_dir, hash_db=None, meta_db=None):
+
+def initialise(sync_dir, hash_db=None, meta_db=None, chunk_db=None, ref_db=None, upload_db=None, store=None,
+               tree_db=None):
     """
     Application Factory method for Flask
     :param sync_dir: Directory to sync files to
     :param hash_db: (optional): Use non-default hash DB (used for Unit testing)
     :param meta_db: (optional): Use non-default metadata DB (used for Unit testing)
+    :param chunk_db: (optional): Use non-default chunk DB (used for Unit testing)
+    :param ref_db: (optional): Use non-default reference count DB (used for Unit testing)
+    :param upload_db: (optional): Use non-default upload session DB (used for Unit testing)
+    :param store: (optional): Use non-default ServerStore for the tables not given
+    :param tree_db: (optional): Use non-default folder hash DB (used for Unit testing). Kept in memory if the other
+                    tables are given without a store
     :return: Flask app
     """
     app = Flask(__name__)
 
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', filename='server.log', level=logging.INFO)
 
+    if store is None and None in (hash_db, meta_db, chunk_db, ref_db, upload_db):
+        # The metadata tables share one WAL-mode database, so each request's writes are committed together
+        store = ServerStore('server_tracker.db')
     if hash_db is None:
         # A Key-Value DB table storing MD5 -> Path. This allows us to detect the upload of identical files to save bandwidth
-        hash_db = SqliteDict('server_tracker.db', tablename='hashmap', encode=json.dumps, decode=json.loads)
+        hash_db = store.table('hashmap')
     if meta_db is None:
         # A Key-Value DB table storing Path -> Metadata. Metadata is stored as JSON
-        meta_db = SqliteDict('server_tracker.db', tablename='metadata', encode=json.dumps, decode=json.loads)
+        meta_db = store.table('metadata')
+    if chunk_db is None:
+        # A Key-Value DB table storing MD5 -> Chunk list. This caches the content-defined chunks of files for delta sync
+        chunk_db = store.table('chunks')
+    if ref_db is None:
+        # A Key-Value DB table storing MD5 -> {Path: stat fingerprint} for files holding that content. Identical files
+        # share storage via links, so content is only forgotten once no path references it
+        ref_db = store.table('refs')
+    if upload_db is None:
+        # A Key-Value DB table storing upload session ID -> resumable upload session (target, metadata, offset)
+        upload_db = store.table('uploads')
+    if not isinstance(meta_db, MerkleTree):
+        if tree_db is None:
+            # A Key-Value DB table storing Folder path -> Merkle hash of everything in the folder
+            tree_db = store.table('tree') if store is not None else {}
+        # Metadata writes keep the folder hashes up to date
+        meta_db = MerkleTree(meta_db, tree_db, sync_dir)
+    if meta_db.tree_db.get(meta_db.root) is None:
+        # The tree has not been built yet, e.g. for a database written before it was kept
+        if store is not None:
+            with store.transaction():
+                meta_db.rebuild()
+        else:
+            meta_db.rebuild()
 
-    @app.route('/sync/exists/<md5>', methods=['GET'])
-    def file_exists_check(md5):
+    if store is not None:
+        # Every metadata write made while handling a request is committed in one transaction once it succeeds
+        app.before_request(store.begin)
+
+        @app.after_request
+        def commit_request(response):
+            store.commit()
+            return response
+
+        @app.teardown_request
+        def rollback_request(error):
+            # Discards the writes of a request that raised (a no-op once committed)
+            store.rollback()
+
+    def is_stream_upload():
         """
-        Allows clients to check whether an exact copy of a file exists on the server before uploading.
-        :param md5: md5 of file to check
-        :return: 200 if exist, 204 if it doesn't
+        Check whether the current request streams a file binary in its body (rather than base64 inside JSON)
+        :return: True if the body is a raw binary stream
+        """
+        return request.mimetype == 'application/octet-stream'
+
+    def is_frame():
+        """
+        Check whether the current request body holds binary frames (rather than JSON)
+        :return: True if the body is framed
+        """
+        return request.mimetype == FRAME_CONTENT_TYPE
+
+    def json_item():
+        """
+        Get the item metadata sent as a JSON body
+        :return: Dictionary of item metadata
+        """
+        data = request.get_json(silent=False)
+        if isinstance(data, str):
+            # Older clients send the metadata as a JSON string inside the JSON body
+            return json.loads(data)
+        return data
+
+    def stream_metadata():
+        """
+        Get the file metadata sent in the header of a streamed upload
+        :return: Dictionary of file metadata
         """
         try:
-            existing_path = hash_db[md5]
+            meta = json.loads(request.headers[METADATA_HEADER])
+        except (KeyError, ValueError):
+            raise KeyError('Missing or invalid {} header'.format(METADATA_HEADER))
+        if meta.get('type') != 'file':
+            raise KeyError('Invalid data type received')
+        return meta
 
-            # Check stored MD5 hash is still up-to-date
-            md5_hash = hashlib.md5()
-            with open(existing_path, 'rb') as file:
-                md5_hash.update(file.read())
+    def request_body(limit):
+        """
+        Get the request body stream, decompressing it if it was sent with a Content-Encoding
+        :param limit: Maximum number of (decompressed) bytes expected
+        :return: File-like object
+        :raises KeyError: if the Content-Encoding is not supported, or an uncompressed body is larger than the limit
+        """
+        encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding == 'identity':
+            if request.content_length is not None and request.content_length > limit:
+                raise KeyError('Request body of {} bytes is larger than expected ({} bytes)'.format(
+                    request.content_length, limit))
+            return request.stream
+        return Compression.decompress_stream(request.stream, encoding, limit)
 
-            if md5 == md5_hash.hexdigest():
-                logging.info('File with identical MD5 found on the server:{}'.format(existing_path))
-                return 'Already exists', 200
-            else:
-                # If the DB's stored MD5 map does not match the file's actual MD5
-                # (This could happen if the file was modified server-side after it was originally synced)
-                hash_db.pop(md5, None)
-                hash_db[md5_hash.hexdigest()] = existing_path
-                hash_db.commit()
-                return 'Does not exist', 204
-        except KeyError:
-            # Give response 204 to say a copy of the file doesn't already exist
-            return 'Does not exist', 204
-        except FileNotFoundError:
-            return 'Does not exist', 204
+    def stream_file(path, log_message, meta=None, stream=None):
+        """
+        Create or update a file on the server from the binary streamed in the request body
+        :param path: Target file path from the route URL
+        :param log_message: Message to log on success, formatted with the path
+        :param meta: (optional) Dictionary of file metadata, if not sent in the header
+        :param stream: (optional) File-like object to read the binary from, if not the whole (decompressed) body
+        :return: 200 success. 400 invalid request. 422 file corrupted in transmission.
+        """
+        try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
+            if meta is None:
+                meta = stream_metadata()
+                stream = request_body(meta['size'])
+            ServerFileUtils.set_file_stream(hash_db, meta_db, target_path, meta, stream, ref_db=ref_db,
+                                            chunk_db=chunk_db)
+            logging.info(log_message.format(path))
+        except KeyError as e:
+            return str(e), 400
+        except IOError as e:
+            logging.warning('IOError when streaming a file. '
+                            'This is thrown if the MD5 checksum does not match a file. '
+                            'This may be because of corruption during transmission')
+            return str(e), 422
+        return 'OK', 200
 
-    @app.route('/sync/<path:path>', methods=['POST'])
-    def new_item(path):
+    def frame_item(path, handler, log_message):
         """
-        Create a new file or folder on the server
+        Create or update a file or folder from the binary frame in the request body. A file binary sent with the frame
+        follows it in the body as is, and is streamed to disk
         :param path: Target folder/file path from the route URL
-        :return: 200 success. 400 invalid request. 422 file corrupted in transmission.
+        :param handler: create_item or update_file, for items without a binary
+        :param log_message: Message to log once a file binary is written, formatted with the path
+        :return: 200 success. 400 invalid request. 415 compressed body. 422 file corrupted in transmission.
+        """
+        if request.headers.get('Content-Encoding', 'identity').strip().lower() != 'identity':
+            return 'Framed bodies cannot be compressed', 415
+        try:
+            record, body = Frame.read_stream(request.stream) or (None, None)
+            data = Frame.unpack_item(record, body)
+        except ValueError as e:
+            return str(e), 400
+        if record == ENCODING_RECORD:
+            return stream_file(path, log_message, data, request.stream)
+        return handler(path, data)
+
+    def check_exists(md5):
         """
-        data = json.loads(request.get_json(silent=False))
+        Check whether an exact copy of a file exists on the server
+        :param md5: md5 of file to check
+        :return: (message, status). 200 if exist, 204 if it doesn't
+        """
+        existing_path = ServerFileUtils.find_content(hash_db, ref_db, md5)
+        if existing_path is None:
+            # Give response 204 to say a copy of the file doesn't already exist
+            return 'Does not exist', 204
+        logging.info('File with identical MD5 found on the server:{}'.format(existing_path))
+        return 'Already exists', 200
 
-        target_path = os.path.normpath(os.path.join(sync_dir, path))
+    def create_item(path, data):
+        """
+        Create a new file or folder on the server from its JSON metadata (and optionally base64 binary)
+        :param path: Target folder/file path, relative to the sync directory
+        :param data: Dictionary of item metadata
+        :return: (message, status). 200 success. 400 invalid request. 422 file corrupted in transmission.
+        """
         try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
             if data['type'] == 'file':
-                ServerFileUtils.set_file(hash_db, meta_db, target_path, data)
+                ServerFileUtils.set_file(hash_db, meta_db, target_path, data, ref_db=ref_db, chunk_db=chunk_db)
                 logging.info('File created:{}'.format(path))
             elif data['type'] == 'folder':
                 ServerFileUtils.new_folder(meta_db, target_path, data)
@@ -86,18 +219,17 @@ def initialise(sync_dir, hash_db=None, meta_db=None):
             return str(e), 422
         return 'OK', 200
 
-    @app.route('/sync/<path:path>', methods=['PUT'])
-    def update_item(path):
+    def update_file(path, data):
         """
-        Update an edited file on the server
-        :param path: Target folder/file path from the route URL
-        :return: 200 success. 400 invalid request. 422 file corrupted in transmission.
+        Update an edited file on the server from its JSON metadata (and optionally base64 binary)
+        :param path: Target file path, relative to the sync directory
+        :param data: Dictionary of file metadata
+        :return: (message, status). 200 success. 400 invalid request. 422 file corrupted in transmission.
         """
-        data = json.loads(request.get_json(silent=False))
-        target_path = os.path.normpath(os.path.join(sync_dir, path))
         try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
             if data['type'] == 'file':
-                ServerFileUtils.set_file(hash_db, meta_db, target_path, data)
+                ServerFileUtils.set_file(hash_db, meta_db, target_path, data, ref_db=ref_db, chunk_db=chunk_db)
                 logging.info('File updated:{}'.format(path))
             else:
                 return 'Invalid data type received', 400
@@ -110,29 +242,363 @@ def initialise(sync_dir, hash_db=None, meta_db=None):
             return str(e), 422
         return 'OK', 200
 
-    @app.route('/sync/<path:path>', methods=['DELETE'])
-    def delete_item(path):
+    def delete_path(path, data):
         """
-        Delete a file on the server
-        :param path: Target folder/file path from the route URL
-        :return: 200 success. 400 invalid request. 422 IO error on server
+        Delete a file or folder on the server
+        :param path: Target folder/file path, relative to the sync directory
+        :param data: Dictionary with the item 'type'
+        :return: (message, status). 200 success. 400 invalid request. 422 IO error on server
         """
-        data = request.get_json(silent=False, force=True)
-        target_path = os.path.normpath(os.path.join(sync_dir, path))
-
         try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
             if data['type'] == 'file':
-                ServerFileUtils.remove_file(hash_db, meta_db, target_path)
+                ServerFileUtils.remove_file(hash_db, meta_db, target_path, ref_db=ref_db, chunk_db=chunk_db)
                 logging.info('File removed:{}'.format(path))
             elif data['type'] == 'folder':
-                ServerFileUtils.remove_folder(meta_db, target_path)
+                ServerFileUtils.remove_folder(meta_db, target_path, hash_db=hash_db, ref_db=ref_db, chunk_db=chunk_db)
                 logging.info('Folder removed:{}'.format(path))
             else:
                 return 'Invalid data type received', 400
+        except KeyError as e:
+            return str(e), 400
         except IOError as e:
             logging.warning('IOError when deleting a file or folder.')
             return str(e), 422
+        return 'OK', 200
 
+    def move_path(path, data):
+        """
+        Move or rename a file or folder on the server
+        :param path: Source folder/file path, relative to the sync directory
+        :param data: Dictionary with the path to move to, 'to', relative to the sync directory
+        :return: (message, status). 200 success. 400 invalid request. 404 nothing to move. 409 target already exists.
+                 422 IO error on server
+        """
+        try:
+            source_path = ServerFileUtils.resolve_path(sync_dir, path)
+            target_path = ServerFileUtils.resolve_path(sync_dir, data['to'])
+            ServerFileUtils.move_item(hash_db, meta_db, source_path, target_path, ref_db=ref_db)
+            logging.info('Moved:{} -> {}'.format(path, data['to']))
+        except (KeyError, TypeError) as e:
+            return str(e), 400
+        except FileNotFoundError as e:
+            return str(e), 404
+        except FileExistsError as e:
+            return str(e), 409
+        except IOError as e:
+            logging.warning('IOError when moving a file or folder.')
+            return str(e), 422
         return 'OK', 200
 
+    @app.route('/hashes', methods=['GET'])
+    def hash_algorithms():
+        """
+        Allows clients to choose a hash algorithm for file digests that the server can verify
+        :return: 200 with JSON {"algorithms": [name, ...]}, fastest first
+        """
+        return {'algorithms': ContentHash.available()}, 200
+
+    @app.route('/encodings', methods=['GET'])
+    def content_encodings():
+        """
+        Allows clients to choose a Content-Encoding to compress streamed uploads with
+        :return: 200 with JSON {"encodings": [name, ...]}, most preferred first
+        """
+        return {'encodings': Compression.available()}, 200
+
+    @app.route('/frames', methods=['GET'])
+    def frame_versions():
+        """
+        Allows clients to check the server accepts request bodies of binary frames (application/x-dropnot-frame)
+        :return: 200 with JSON {"versions": [version, ...]}
+        """
+        return {'versions': [FRAME_VERSION]}, 200
+
+    @app.route('/tree/', defaults={'path': ''}, methods=['GET'])
+    @app.route('/tree/<path:path>', methods=['GET'])
+    def folder_tree(path):
+        """
+        Allows clients to reconcile with the server after downtime by comparing folder hashes, descending only into
+        folders whose hash differs from their own copy. A file's digest covers its name, digest, size and modified
+        time, and a folder's digest its name and hash
+        :param path: Folder path from the route URL (empty for the sync directory)
+        :return: 200 with JSON {"hash": ..., "entries": {name: digest}}. 400 invalid path. 404 if the folder is not on
+                 the server
+        """
+        try:
+            folder = ServerFileUtils.resolve_path(sync_dir, path)
+        except KeyError as e:
+            return str(e), 400
+        try:
+            entries = meta_db.entries(folder)
+        except (FileNotFoundError, NotADirectoryError):
+            entries = None
+        if entries is None:
+            return 'Folder not found', 404
+        return {'hash': meta_db.tree_db.get(folder), 'entries': entries}, 200
+
+    @app.route('/sync/exists/<md5>', methods=['GET'])
+    def file_exists_check(md5):
+        """
+        Allows clients to check whether an exact copy of a file exists on the server before uploading.
+        :param md5: md5 of file to check
+        :return: 200 if exist, 204 if it doesn't
+        """
+        return check_exists(md5)
+
+    @app.route('/exists', methods=['POST'])
+    def bulk_exists_check():
+        """
+        Allows clients to check which of many files already exist on the server before uploading.
+        The body is JSON {"md5s": [md5, ...]}
+        :return: 200 with JSON {"present": [md5, ...]}, the subset of MD5s held by the server. 400 invalid request.
+        """
+        body = request.get_json(silent=True, force=True)
+        if not isinstance(body, dict) or not isinstance(body.get('md5s'), list):
+            return 'Expected JSON {"md5s": [...]}', 400
+        present = [md5 for md5 in dict.fromkeys(body['md5s'])
+                   if ServerFileUtils.find_content(hash_db, ref_db, md5) is not None]
+        return {'present': present}, 200
+
+    @app.route('/manifest', methods=['POST'])
+    def compare_manifest():
+        """
+        Allows a client with no record of what it has synced (e.g. a fresh install re-attached to an existing mirror)
+        to find what it must send, rather than hashing and sending every item. The body is JSON {"entries": [...]} of
+        {"path": ..., "type": "file", "size": ..., "modified": ..., "md5": ... (optional)} and
+        {"path": ..., "type": "folder"}, optionally compressed with a Content-Encoding
+        :return: 200 with JSON {"operations": [{"op": "create"|"update", "path": ..., "type": ...}, ...],
+                 "synced": {path: digest (null for folders)}}. 400 invalid request.
+        """
+        try:
+            body = json.load(request_body(MANIFEST_LIMIT))
+            operations, synced = ServerFileUtils.compare_manifest(meta_db, sync_dir, body['entries'])
+        except (KeyError, TypeError, ValueError, IOError) as e:
+            return 'Invalid manifest: {}'.format(e), 400
+        return {'operations': operations, 'synced': synced}, 200
+
+    @app.route('/pack', methods=['POST'])
+    def unpack_files():
+        """
+        Create or update many small files in one request, rather than one request each. The body is a pack of binary
+        frames (application/x-dropnot-frame): a file encoding record for each file, followed by the file binary.
+        The pack may be compressed with a Content-Encoding. Each file is checked against its digest and written
+        straight into place, and all of their metadata is committed together.
+        :return: 200 with JSON {"results": [{"status": ..., "message": ...}, ...]} in pack order, where the status of
+                 each file is 200 success, 400 path outside the sync directory or 422 file corrupted in transmission.
+                 A malformed frame ends the pack, with a 400 result after those of the files before it.
+                 400 unsupported Content-Encoding. 415 body not framed.
+        """
+        if not is_frame():
+            return 'Expected a body of {}'.format(FRAME_CONTENT_TYPE), 415
+        try:
+            stream = request_body(PACK_LIMIT)
+        except KeyError as e:
+            return str(e), 400
+        unpacked = []
+        try:
+            ServerFileUtils.unpack_files(hash_db, meta_db, sync_dir, stream, ref_db=ref_db, results=unpacked,
+                                         chunk_db=chunk_db)
+        except (ValueError, IOError) as e:
+            unpacked.append((None, 400, 'Invalid pack: {}'.format(e)))
+        logging.info('Unpacked {} files'.format(sum(status == 200 for _, status, _ in unpacked)))
+        return {'results': [{'status': status, 'message': message} for _, status, message in unpacked]}, 200
+
+    @app.route('/sync/<path:path>', methods=['POST'])
+    def new_item(path):
+        """
+        Create a new file or folder on the server
+        :param path: Target folder/file path from the route URL
+        :return: 200 success. 400 invalid request. 422 file corrupted in transmission.
+        """
+        if is_stream_upload():
+            # File binary is streamed in the request body, with its metadata in a header
+            return stream_file(path, 'File created:{}')
+        if is_frame():
+            # Metadata is sent as a binary frame, followed by the file binary (if any)
+            return frame_item(path, create_item, 'File created:{}')
+        return create_item(path, json_item())
+
+    @app.route('/sync/<path:path>', methods=['PUT'])
+    def update_item(path):
+        """
+        Update an edited file on the server
+        :param path: Target folder/file path from the route URL
+        :return: 200 success. 400 invalid request. 422 file corrupted in transmission.
+        """
+        if is_stream_upload():
+            return stream_file(path, 'File updated:{}')
+        if is_frame():
+            return frame_item(path, update_file, 'File updated:{}')
+        return update_file(path, json_item())
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        """
+        Apply many small operations in one request. The body is JSON {"operations": [...]}, where each operation is
+        {"op": "create"|"update", "path": ..., "data": {metadata}},
+        {"op": "delete", "path": ..., "data": {"type": ...}}, {"op": "move", "path": ..., "data": {"to": ...}}
+        or {"op": "exists", "md5": ...}. Operations are applied in order. The operations can instead be sent as a body
+        of binary operation frames (application/x-dropnot-frame).
+        :return: 200 with JSON {"results": [{"status": ..., "message": ...}, ...]} in operation order.
+                 400 if the body is not a list of operations.
+        """
+        if is_frame():
+            try:
+                body = {'operations': Frame.unpack_operations(request.get_data())}
+            except ValueError as e:
+                return str(e), 400
+        else:
+            body = request.get_json(silent=True, force=True)
+        if not isinstance(body, dict) or not isinstance(body.get('operations'), list):
+            return 'Expected JSON {"operations": [...]}', 400
+
+        handlers = {'create': create_item, 'update': update_file, 'delete': delete_path, 'move': move_path}
+        results = []
+        for operation in body['operations']:
+            try:
+                if operation['op'] == 'exists':
+                    message, status = check_exists(operation['md5'])
+                else:
+                    message, status = handlers[operation['op']](operation['path'], operation['data'])
+            except (KeyError, TypeError) as e:
+                message, status = 'Invalid operation: {}'.format(e), 400
+            results.append({'status': status, 'message': message})
+        return {'results': results}, 200
+
+    @app.route('/delta/<path:path>', methods=['POST'])
+    def delta_missing(path):
+        """
+        Allows clients to find which chunks of an edited file need uploading, before sending a delta
+        :param path: Target file path from the route URL
+        :return: 200 with JSON {"missing": [md5, ...]}. 400 invalid path. 404 if the server has no copy of the file to
+                 delta against.
+        """
+        try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
+        except KeyError as e:
+            return str(e), 400
+        body = request.get_json(silent=True, force=True)
+        if not isinstance(body, dict) or not isinstance(body.get('chunks'), list) or \
+                not all(isinstance(chunk, list) and len(chunk) == 2 for chunk in body['chunks']):
+            return 'Expected JSON {"chunks": [[md5, size], ...]}', 400
+        chunks = body['chunks']
+        try:
+            held = {md5 for md5, size in ServerFileUtils.get_chunks(meta_db, chunk_db, target_path)}
+        except (KeyError, FileNotFoundError):
+            return 'No existing file to delta against', 404
+        missing = []
+        for md5, size in chunks:
+            if md5 not in held:
+                held.add(md5)  # Each distinct chunk only needs sending once
+                missing.append(md5)
+        return {'missing': missing}, 200
+
+    @app.route('/delta/<path:path>', methods=['PUT'])
+    def delta_update(path):
+        """
+        Update an edited file on the server from a delta.
+        The body is a JSON chunk list on the first line, followed by the binary of each chunk the server is missing.
+        :param path: Target file path from the route URL
+        :return: 200 success. 400 invalid request. 404 no existing file. 422 file corrupted in transmission.
+        """
+        try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
+            meta = stream_metadata()
+            chunks = json.loads(request.stream.readline())
+            ServerFileUtils.set_file_delta(hash_db, meta_db, chunk_db, target_path, meta, chunks, request.stream,
+                                           ref_db=ref_db)
+            logging.info('File updated from delta:{}'.format(path))
+        except FileNotFoundError:
+            return 'No existing file to delta against', 404
+        except (KeyError, ValueError) as e:
+            return str(e), 400
+        except IOError as e:
+            logging.warning('IOError when applying a delta. '
+                            'This is thrown if a chunk or the file MD5 checksum does not match.')
+            return str(e), 422
+        return 'OK', 200
+
+    @app.route('/upload/<path:path>', methods=['POST'])
+    def open_upload(path):
+        """
+        Start a resumable upload of a file, or find where an interrupted upload of the same content got to.
+        The file's metadata is sent in a header, as for streamed uploads.
+        :param path: Target file path from the route URL
+        :return: 200 with JSON {"id": session ID, "offset": byte to continue from}. 400 invalid request. 409 if
+                 another request is still sending the upload.
+        """
+        try:
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
+            upload_id, offset = ServerFileUtils.open_upload(upload_db, target_path, stream_metadata())
+        except KeyError as e:
+            return str(e), 400
+        except UploadOffsetError as e:
+            return {'offset': e.offset}, 409
+        return {'id': upload_id, 'offset': offset}, 200
+
+    @app.route('/upload/<upload_id>', methods=['PUT'])
+    def append_upload(upload_id):
+        """
+        Continue a resumable upload. The body holds the file's binary from the offset given in a header onwards, and
+        may be compressed with a Content-Encoding. Bytes received before the connection drops are kept.
+        :param upload_id: Session ID from open_upload()
+        :return: 200 with JSON {"offset": size} once the file is complete, 202 with the offset received up to if not.
+                 400 invalid request. 404 unknown session. 409 with the offset to continue from if the request was out
+                 of step with the server. 422 file corrupted in transmission (the upload must start again).
+        """
+        try:
+            offset = int(request.headers[OFFSET_HEADER])
+        except (KeyError, ValueError):
+            return 'Missing or invalid {} header'.format(OFFSET_HEADER), 400
+        session = upload_db.get(upload_id)
+        if session is None:
+            return 'No upload session {}'.format(upload_id), 404
+        try:
+            # Checked before the session is claimed, which an unsupported Content-Encoding must leave untouched
+            stream = request_body(session['meta']['size'] - offset)
+        except KeyError as e:
+            return str(e), 400
+        try:
+            received = ServerFileUtils.append_upload(hash_db, meta_db, upload_db, upload_id, offset, stream,
+                                                     ref_db=ref_db, chunk_db=chunk_db)
+        except FileNotFoundError as e:
+            return str(e), 404
+        except UploadOffsetError as e:
+            return {'offset': e.offset}, 409
+        except KeyError as e:
+            return str(e), 400
+        except IOError as e:
+            logging.warning('IOError when continuing a resumable upload. '
+                            'This is thrown if the MD5 checksum does not match a file. '
+                            'This may be because of corruption during transmission')
+            return str(e), 422
+        if received < session['meta']['size']:
+            return {'offset': received}, 202
+        logging.info('File uploaded:{}'.format(session['meta']['path']))
+        return {'offset': received}, 200
+
+    @app.route('/move/<path:path>', methods=['POST'])
+    def move_item(path):
+        """
+        Move or rename a file or folder on the server, without its content being sent again.
+        The body is JSON {"to": new path}
+        :param path: Source folder/file path from the route URL
+        :return: 200 success. 400 invalid request. 404 nothing to move. 409 target already exists.
+                 422 IO error on server
+        """
+        data = request.get_json(silent=True, force=True)
+        if not isinstance(data, dict):
+            return 'Expected JSON {"to": ...}', 400
+        return move_path(path, data)
+
+    @app.route('/sync/<path:path>', methods=['DELETE'])
+    def delete_item(path):
+        """
+        Delete a file on the server
+        :param path: Target folder/file path from the route URL
+        :return: 200 success. 400 invalid request. 422 IO error on server
+        """
+        return delete_path(path, request.get_json(silent=False, force=True))
+
     return app
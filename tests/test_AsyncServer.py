@@ -0,0 +1,131 @@
+import unittest
+import asyncio
+import shutil
+import tempfile
+import os
+import hashlib
+import gzip
+import logging
+from utils.ServerStore import ServerStore
+from utils.Metadata import FileMetadata, METADATA_HEADER, OFFSET_HEADER
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+    from server.AsyncServer import AsyncServer
+except ImportError:
+    AsyncServer = None
+
+
+@unittest.skipIf(AsyncServer is None, 'aiohttp is not installed')
+class TestAsyncServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # Create test dir
+        self.tmp_dir = tempfile.mkdtemp()
+        self.test_dir = os.path.join(self.tmp_dir, 'test')
+        os.mkdir(self.test_dir)
+        self.store = ServerStore(os.path.join(self.tmp_dir, 'temp.db'))
+        self.server = AsyncServer(self.test_dir, threads=4, store=self.store)
+        self.client = TestClient(TestServer(self.server.app()))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        # Remove temp dir
+        shutil.rmtree(self.tmp_dir)
+
+    async def upload(self, path, binary, method='POST', encoding=None, md5=None):
+        meta = FileMetadata(path=path, modified=1608675488.0458164, md5=md5 or hashlib.md5(binary).hexdigest(),
+                            size=len(binary), sync=False)
+        headers = {'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+            binary = gzip.compress(binary)
+        return await self.client.request(method, '/sync/{}'.format(path), data=binary, headers=headers)
+
+    def read(self, path):
+        with open(os.path.join(self.test_dir, path), 'rb') as file:
+            return file.read()
+
+    # The app's handler arguments are accepted by the installed aiohttp (newer versions log and drop unknown ones)
+    async def test_app_handler(self):
+        runner = web.AppRunner(self.server.app(), handle_signals=False)
+        await runner.setup()
+        try:
+            with self.assertNoLogs('aiohttp.server', logging.WARNING):
+                self.assertIsInstance(runner.server(), web.RequestHandler)
+        finally:
+            await runner.cleanup()
+
+    # Streamed uploads are written to disk and found by their digest
+    async def test_stream_200(self):
+        resp = await self.upload('example/stream.txt', b'ABC123')
+        self.assertEqual(200, resp.status)
+        self.assertEqual(b'ABC123', self.read('example/stream.txt'))
+        resp = await self.client.get('/sync/exists/bbf2dead374654cbb32a917afd236656')
+        self.assertEqual(200, resp.status)
+
+    # Compressed uploads are decompressed as they arrive
+    async def test_stream_compressed_200(self):
+        binary = b'ABC123' * 100000
+        resp = await self.upload('example/stream.txt', binary, method='PUT', encoding='gzip')
+        self.assertEqual(200, resp.status)
+        self.assertEqual(binary, self.read('example/stream.txt'))
+
+    # A corrupt upload is rejected and leaves no file behind
+    async def test_stream_corrupt_422(self):
+        resp = await self.upload('example/stream.txt', b'ABC123', md5='INVALID-MD5')
+        self.assertEqual(422, resp.status)
+        self.assertEqual([], os.listdir(os.path.join(self.test_dir, 'example')))
+
+    # Missing metadata gives 400
+    async def test_stream_400(self):
+        resp = await self.client.post('/sync/example/stream.txt', data=b'ABC123',
+                                      headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(400, resp.status)
+
+    # Many uploads are kept open at once without a thread each
+    async def test_concurrent_uploads(self):
+        binaries = [os.urandom(1024) for i in range(200)]
+        responses = await asyncio.gather(*[self.upload('many/{} file.bin'.format(i), binary)
+                                           for i, binary in enumerate(binaries)])
+        self.assertEqual([200] * len(binaries), [resp.status for resp in responses])
+        for i, binary in enumerate(binaries):
+            self.assertEqual(binary, self.read('many/{} file.bin'.format(i)))
+
+    # Resumable uploads continue from the offset the server acknowledged
+    async def test_resumable_upload(self):
+        binary = os.urandom(300000)
+        meta = FileMetadata(path='example/large.bin', modified=1608675488.0458164,
+                            md5=hashlib.md5(binary).hexdigest(), size=len(binary), sync=False)
+        resp = await self.client.post('/upload/example/large.bin', headers={METADATA_HEADER: repr(meta)})
+        upload = await resp.json()
+        resp = await self.client.put('/upload/{}'.format(upload['id']), data=binary[:100000],
+                                     headers={'Content-Type': 'application/octet-stream', OFFSET_HEADER: '0'})
+        self.assertEqual(202, resp.status)
+        resp = await self.client.post('/upload/example/large.bin', headers={METADATA_HEADER: repr(meta)})
+        self.assertEqual(100000, (await resp.json())['offset'])
+        resp = await self.client.put('/upload/{}'.format(upload['id']), data=binary[100000:],
+                                     headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'br',
+                                              OFFSET_HEADER: '100000'})
+        self.assertEqual(400, resp.status)
+        resp = await self.client.put('/upload/{}'.format(upload['id']), data=gzip.compress(binary[100000:]),
+                                     headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip',
+                                              OFFSET_HEADER: '100000'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(binary, self.read('example/large.bin'))
+
+    # Other routes are served by the Flask app
+    async def test_delegated_routes(self):
+        await self.upload('example/stream.txt', b'ABC123')
+        resp = await self.client.get('/encodings')
+        self.assertIn('gzip', (await resp.json())['encodings'])
+        resp = await self.client.post('/exists', json={'md5s': ['INVALID-MD5', 'bbf2dead374654cbb32a917afd236656']})
+        self.assertEqual(['bbf2dead374654cbb32a917afd236656'], (await resp.json())['present'])
+        resp = await self.client.delete('/sync/example/stream.txt', json={'type': 'file'})
+        self.assertEqual(200, resp.status)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'example', 'stream.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
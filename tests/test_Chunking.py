@@ -0,0 +1,54 @@
+import unittest
+from unittest.mock import patch
+import io
+import random
+from utils import Chunking
+from utils.Chunking import ContentChunker
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        # Small chunk sizes keep the tests fast
+        self.chunker = ContentChunker(min_size=256, avg_size=1024, max_size=4096)
+        # Seeded, so the edit test sees the same chunk boundaries on every run
+        self.data = random.Random(0).randbytes(64 * 1024)
+
+    def test_split_reassembles(self):
+        chunks = list(self.chunker.split(io.BytesIO(self.data)))
+        self.assertEqual(self.data, b''.join(chunks))
+        # Every chunk except the last respects the size bounds
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 256)
+            self.assertLessEqual(len(chunk), 4096)
+
+    def test_split_empty(self):
+        self.assertEqual([], list(self.chunker.split(io.BytesIO(b''))))
+
+    def test_chunk_list_deterministic(self):
+        first = self.chunker.chunk_list(io.BytesIO(self.data))
+        second = self.chunker.chunk_list(io.BytesIO(self.data))
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.data), sum(size for md5, size in first))
+
+    # An insertion in the middle of a file only changes the chunks around the edit
+    def test_insert_changes_few_chunks(self):
+        edited = self.data[:30000] + b'inserted bytes' + self.data[30000:]
+        before = {md5 for md5, size in self.chunker.chunk_list(io.BytesIO(self.data))}
+        after = self.chunker.chunk_list(io.BytesIO(edited))
+        changed = [md5 for md5, size in after if md5 not in before]
+        self.assertLessEqual(len(changed), 3)
+        self.assertGreater(len(after), 10)
+
+
+    # Hashing whole blocks with numpy finds exactly the boundaries found byte by byte
+    @unittest.skipIf(Chunking.numpy is None, 'numpy is not installed')
+    def test_numpy_matches_bytewise(self):
+        data = self.data + bytes(8192) + b'abc' * 4096 + self.data[:9999]
+        with patch('utils.Chunking.SCAN_SIZE', 20000), patch('utils.Chunking.SCAN_BLOCK', 3000):
+            fast = self.chunker.chunk_list(io.BytesIO(data))
+        with patch('utils.Chunking.numpy', None):
+            self.assertEqual(self.chunker.chunk_list(io.BytesIO(data)), fast)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+from unittest.mock import Mock
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+from client.Client import DropNotClient
+from utils.Metadata import FolderEncoding
+from utils.DirectoryListener import DirectoryListener, ChangeType
+from utils.TrackerIndex import TrackedFile
+from utils.InotifyWatcher import InotifyWatcher
+from utils.ClientFileUtils import FileUtils
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        # The client keeps its tracker database in the working directory
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.test_dir = os.path.join(self.tmp_dir, 'test')
+        os.mkdir(self.test_dir)
+        self.client = DropNotClient(self.test_dir, '127.0.0.1', 5000)
+        self.client.session = Mock()
+
+    def tearDown(self):
+        for index in (self.client.file_db, self.client.folder_db, self.client.hash_cache.db, self.client.outbox.db):
+            index.db.close(force=True)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    # send_batch() sends JSON operations to servers that do not accept binary frames
+    def test_send_batch_json(self):
+        self.client.frames = False
+        self.client.session.post.return_value = Mock(status_code=200, json=lambda: {'results': [{'status': 200},
+                                                                                               {'status': 204}]})
+        on_result = Mock()
+        self.client.send_batch([
+            ({'op': 'create', 'path': 'folder', 'data': FolderEncoding('folder', 100000.0, False)}, on_result),
+            ({'op': 'exists', 'md5': 'INVALID-MD5'}, on_result)
+        ])
+        operations = self.client.session.post.call_args[1]['json']['operations']
+        self.assertEqual({'op': 'create', 'path': 'folder',
+                          'data': {'path': 'folder', 'modified': 100000.0, 'type': 'folder', 'sync': False}},
+                         operations[0])
+        self.assertEqual([((200,),), ((204,),)], on_result.call_args_list)
+
+    # Deleting a file drops its cached digest along with its tracker entry
+    def test_del_file_forgets_digest(self):
+        path = os.path.join(self.test_dir, 'deleted.txt')
+        with open(path, 'w') as file:
+            file.write('Hello')
+        os.utime(path, (12345.0, 12345.0))
+        stat = os.stat(path)
+        self.client.hash_cache.put(stat, 'blake2b:00ff')
+        self.client.file_db[path] = TrackedFile(12345.0, 5, 'blake2b:00ff', True, stat.st_mtime_ns,
+                                                FileUtils.get_inode(stat))
+        os.remove(path)
+        self.client.on_del_file_result(path, 'deleted.txt', 200)
+        self.assertNotIn(path, self.client.file_db)
+        self.assertIsNone(self.client.hash_cache.get(stat, 'blake2b'))
+
+    # Changes the outbox gives up retrying are reported by the listener again on its next scan
+    def test_give_up_rescanned(self):
+        callback = Mock()
+        listener = DirectoryListener(self.test_dir, callback, self.client.file_db, self.client.folder_db)
+        created = os.path.join(self.test_dir, 'created.txt')
+        with open(created, 'w') as file:
+            file.write('Hello')
+        listener.scan_directory(n_iter=1)
+        callback.assert_called_with(ChangeType.CreatedFile, created)
+        self.client.file_db[created] = TrackedFile(12345.0, 5, None, False)
+        deleted = os.path.join(self.test_dir, 'deleted')
+        for i in range(self.client.outbox.max_attempts + 1):
+            self.client.outbox.defer(created, ChangeType.CreatedFile)
+            self.client.outbox.defer(deleted, ChangeType.DeletedFolder)
+
+        callback.reset_mock()
+        listener.scan_directory(n_iter=1)
+        self.assertCountEqual([((ChangeType.CreatedFile, created),), ((ChangeType.DeletedFolder, deleted),)],
+                              callback.call_args_list)
+
+    # Changes the outbox gives up retrying are checked again by the inotify listener, which does not re-scan
+    @unittest.skipUnless(InotifyWatcher.is_supported(), 'inotify is only available on Linux')
+    def test_give_up_rechecked(self):
+        created = os.path.join(self.test_dir, 'created.txt')
+        with open(created, 'w') as file:
+            file.write('Hello')
+        self.client.file_db[created] = TrackedFile(None, 5, None, False, modified_ns=os.stat(created).st_mtime_ns)
+        callback = Mock()
+        scanned = threading.Event()
+        self.client.listener = DirectoryListener(self.test_dir, callback, self.client.file_db, self.client.folder_db,
+                                                 scan_callback=scanned.set)
+        watcher = threading.Thread(target=self.client.listener.watch_directory, kwargs={'n_iter': 1, 'timeout': 2})
+        watcher.start()
+        # Given up on once the listener's start-up scan has found nothing to report
+        self.assertTrue(scanned.wait(5))
+        deleted = os.path.join(self.test_dir, 'deleted')
+        for i in range(self.client.outbox.max_attempts + 1):
+            self.client.outbox.defer(created, ChangeType.CreatedFile)
+            self.client.outbox.defer(deleted, ChangeType.DeletedFolder)
+
+        watcher.join()
+        self.assertCountEqual([((ChangeType.CreatedFile, created),), ((ChangeType.DeletedFolder, deleted),)],
+                              callback.call_args_list)
+
+if __name__ == '__main__':
+    unittest.main()
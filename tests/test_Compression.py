@@ -0,0 +1,69 @@
+import unittest
+import tempfile
+import shutil
+import os
+import io
+from utils.Compression import Compression
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.text_file = os.path.join(self.tmp_dir, 'text.txt')
+        with open(self.text_file, 'wb') as file:
+            file.write(b'The quick brown fox jumps over the lazy dog\n' * 10000)
+        self.random_file = os.path.join(self.tmp_dir, 'random.bin')
+        with open(self.random_file, 'wb') as file:
+            file.write(os.urandom(100000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_negotiate(self):
+        self.assertIsNone(Compression.negotiate([]))
+        self.assertIsNone(Compression.negotiate(['gzip'], 'none'))
+        self.assertEqual('gzip', Compression.negotiate(['gzip']))
+        self.assertEqual('gzip', Compression.negotiate(['gzip', 'zstd'], 'gzip'))
+
+    # Small files, compressed formats and incompressible content are sent as they are
+    def test_should_compress(self):
+        self.assertTrue(Compression.should_compress(self.text_file, os.path.getsize(self.text_file)))
+        self.assertFalse(Compression.should_compress(self.random_file, os.path.getsize(self.random_file)))
+        self.assertFalse(Compression.should_compress(self.text_file, 100))
+        zip_file = os.path.join(self.tmp_dir, 'text.zip')
+        shutil.copyfile(self.text_file, zip_file)
+        self.assertFalse(Compression.should_compress(zip_file, os.path.getsize(zip_file)))
+
+    def test_round_trip(self):
+        with open(self.text_file, 'rb') as file:
+            expected = file.read()
+        for encoding in Compression.available():
+            compressed = b''.join(Compression.compress_file(self.text_file, encoding))
+            self.assertLess(len(compressed), len(expected) / 5)
+            stream = Compression.decompress_stream(io.BytesIO(compressed), encoding, len(expected))
+            self.assertEqual(expected, b''.join(iter(lambda: stream.read(65536), b'')))
+
+    # Request bodies held in memory compress the same way as files
+    def test_compress(self):
+        data = b'The quick brown fox jumps over the lazy dog\n' * 100
+        for encoding in Compression.available():
+            stream = Compression.decompress_stream(io.BytesIO(Compression.compress(data, encoding)), encoding,
+                                                   len(data))
+            self.assertEqual(data, stream.read())
+
+    # Decompression stops once more than the expected size is produced
+    def test_decompress_limit(self):
+        compressed = b''.join(Compression.compress_file(self.text_file, 'gzip'))
+        stream = Compression.decompress_stream(io.BytesIO(compressed), 'gzip', 1000)
+        with self.assertRaises(IOError):
+            while stream.read(65536):
+                pass
+
+    def test_decompress_corrupt(self):
+        stream = Compression.decompress_stream(io.BytesIO(b'not gzip data'), 'gzip', 1000)
+        with self.assertRaises(IOError):
+            stream.read(65536)
+
+
+if __name__ == '__main__':
+    unittest.main()
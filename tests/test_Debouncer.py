@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+from threading import Event
+from utils.Debouncer import Debouncer
+from utils.DirectoryListener import ChangeType
+
+
+class TestDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.changes = []
+        self.settled = Event()
+        self.debouncer = Debouncer(lambda change, path, source=None: self.changes.append((change, path)),
+                                   settle_time=300, settled_callback=self.settled.set)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, binary, age=0):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'ab') as file:
+            file.write(binary)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    # Files that have not changed within the settle time are passed on straight away
+    def test_settled_file(self):
+        path = self.write('a.txt', b'ABC123', age=60)
+        self.debouncer.on_change(ChangeType.ModifiedFile, path)
+        self.assertEqual([(ChangeType.ModifiedFile, path)], self.changes)
+
+    # Deletions and folder changes are never held
+    def test_passes_deletions(self):
+        self.debouncer.on_change(ChangeType.DeletedFile, '/a.txt')
+        self.debouncer.on_change(ChangeType.CreatedFolder, self.tmp_dir)
+        self.assertEqual([(ChangeType.DeletedFile, '/a.txt'), (ChangeType.CreatedFolder, self.tmp_dir)],
+                         self.changes)
+
+    # A file created and then edited is passed on once, as a creation, after it settles
+    def test_merges_edits(self):
+        path = self.write('a.txt', b'ABC')
+        self.debouncer.on_change(ChangeType.CreatedFile, path)
+        self.write('a.txt', b'123')
+        self.debouncer.on_change(ChangeType.ModifiedFile, path)
+        self.assertEqual([], self.changes)
+        self.assertTrue(self.settled.wait(5))
+        self.assertEqual([(ChangeType.CreatedFile, path)], self.changes)
+        self.assertEqual(0, len(self.debouncer))
+
+    # A file that keeps growing is held until it stops
+    def test_growing_file(self):
+        path = self.write('a.log', b'line\n')
+        self.debouncer.on_change(ChangeType.ModifiedFile, path)
+        for i in range(5):
+            time.sleep(0.1)
+            self.write('a.log', b'line\n')
+        self.assertEqual([], self.changes)
+        self.assertTrue(self.settled.wait(5))
+        self.assertEqual([(ChangeType.ModifiedFile, path)], self.changes)
+
+    # A file created and deleted before it settles is never synced
+    def test_cancels_deleted(self):
+        path = self.write('a.txt', b'ABC123')
+        self.debouncer.on_change(ChangeType.CreatedFile, path)
+        os.remove(path)
+        self.debouncer.on_change(ChangeType.DeletedFile, path)
+        self.assertEqual(0, len(self.debouncer))
+        self.assertEqual([], self.changes)
+
+    # The deletion of a held edit is passed on straight away
+    def test_deleted_edit(self):
+        path = self.write('a.txt', b'ABC123')
+        self.debouncer.on_change(ChangeType.ModifiedFile, path)
+        self.debouncer.on_change(ChangeType.DeletedFile, path)
+        self.assertEqual([(ChangeType.DeletedFile, path)], self.changes)
+        self.assertEqual(0, len(self.debouncer))
+
+    # Moves are passed on straight away, and a held change follows its file to the new path
+    def test_move(self):
+        path = self.write('a.txt', b'ABC123')
+        self.debouncer.on_change(ChangeType.ModifiedFile, path)
+        moved = os.path.join(self.tmp_dir, 'b.txt')
+        os.rename(path, moved)
+        self.debouncer.on_change(ChangeType.MovedFile, moved, path)
+        self.assertEqual([(ChangeType.MovedFile, moved)], self.changes)
+        self.assertTrue(self.settled.wait(5))
+        self.assertEqual([(ChangeType.MovedFile, moved), (ChangeType.ModifiedFile, moved)], self.changes)
+
+    # A settle time of 0 passes every change straight on
+    def test_disabled(self):
+        debouncer = Debouncer(lambda change, path: self.changes.append((change, path)), settle_time=0)
+        path = self.write('a.txt', b'ABC123')
+        debouncer.on_change(ChangeType.CreatedFile, path)
+        self.assertEqual([(ChangeType.CreatedFile, path)], self.changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,15 @@
-from unittest.mock import Mock
+from unittest.mock import Mock, call, patch
 from sqlitedict import SqliteDict
 import unittest
 import tempfile
 import shutil
 import os
 import json
+import threading
+import time
 from utils.DirectoryListener import DirectoryListener, ChangeType
+from utils.InotifyWatcher import InotifyWatcher
+from utils.ClientFileUtils import FileUtils
 
 
 
@@ -64,6 +68,189 @@ class TestDirectoryListener(unittest.TestCase):
         listener.scan_directory(n_iter=1)
         callback.assert_called_with(ChangeType.DeletedFile, new_file)
 
+    # A file is only reported as modified if its modified time changed, compared to the nanosecond
+    def test_file_modified_ns(self):
+        callback = Mock()
+        new_file = os.path.join(self.test_dir, 'fileTest.txt')
+        with open(new_file, 'w') as file:
+            file.write('Hello')
+        stat = os.stat(new_file)
+        self.file_db[new_file] = {'modified': stat.st_mtime, 'modified_ns': stat.st_mtime_ns}
+        self.file_db.commit()
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        listener.scan_directory(n_iter=1)
+        callback.assert_not_called()
+
+        os.utime(new_file, ns=(stat.st_mtime_ns + 1, stat.st_mtime_ns + 1))
+        listener.scan_directory(n_iter=1)
+        callback.assert_called_with(ChangeType.ModifiedFile, new_file)
+
+    def test_check_paths(self):
+        callback = Mock()
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        new_dir = os.path.join(self.test_dir, 'folderTest')
+        new_file = os.path.join(new_dir, 'fileTest.txt')
+        os.mkdir(new_dir)
+        with open(new_file, 'w') as file:
+            file.write('Hello')
+
+        # A new folder is walked, so files inside it are reported too
+        listener.check_paths({new_dir})
+        callback.assert_any_call(ChangeType.CreatedFolder, new_dir)
+        callback.assert_any_call(ChangeType.CreatedFile, new_file)
+        self.folder_db[new_dir] = json.dumps({})
+        self.folder_db.commit()
+        self.file_db[new_file] = json.dumps({'modified': 12345})
+        self.file_db.commit()
+
+        callback.reset_mock()
+        listener.check_paths({new_file})
+        callback.assert_called_once_with(ChangeType.ModifiedFile, new_file)
+
+        # Removing a folder reports the folder and every tracked file inside it
+        callback.reset_mock()
+        shutil.rmtree(new_dir)
+        listener.check_paths({new_dir})
+        callback.assert_any_call(ChangeType.DeletedFolder, new_dir)
+        callback.assert_any_call(ChangeType.DeletedFile, new_file)
+        self.assertEqual(2, callback.call_count)
+
+    # Removed files are reported without scanning every tracked path, and removed folders with one scan
+    def test_check_paths_removed(self):
+        callback = Mock()
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        top = os.path.join(self.test_dir, 'top')
+        nested = os.path.join(top, 'nested')
+        files = [os.path.join(self.test_dir, 'a.txt'), os.path.join(nested, 'b.txt'), os.path.join(top, 'c.txt')]
+        for folder in (top, nested):
+            self.folder_db[folder] = {}
+        for file in files:
+            self.file_db[file] = {'modified': 12345}
+        self.file_db[os.path.join(self.test_dir, 'topless.txt')] = {'modified': 12345}
+        self.folder_db.commit()
+        self.file_db.commit()
+
+        with patch.object(self.file_db, 'keys', wraps=self.file_db.keys) as keys:
+            listener.check_paths({files[0]})
+            keys.assert_not_called()
+        callback.assert_called_once_with(ChangeType.DeletedFile, files[0])
+
+        callback.reset_mock()
+        with patch.object(self.file_db, 'keys', wraps=self.file_db.keys) as keys:
+            listener.check_paths({top, files[0]})
+            self.assertEqual(1, keys.call_count)
+        self.assertCountEqual([call(ChangeType.DeletedFolder, top), call(ChangeType.DeletedFolder, nested),
+                               call(ChangeType.DeletedFile, files[0]), call(ChangeType.DeletedFile, files[1]),
+                               call(ChangeType.DeletedFile, files[2])], callback.call_args_list)
+
+    def track_file(self, path):
+        stat = os.stat(path)
+        self.file_db[path] = {'modified': stat.st_mtime, 'modified_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                              'inode': FileUtils.get_inode(stat)}
+        self.file_db.commit()
+
+    def apply_move(self, change, path, source=None):
+        # Move the tracked state, as the client does once the server has moved its copy
+        if source is None:
+            return
+        for db in (self.folder_db, self.file_db):
+            for key in list(db.keys()):
+                if key == source or key.startswith(os.path.join(source, '')):
+                    db[path + key[len(source):]] = db.pop(key)
+            db.commit()
+
+    # A renamed file is matched to its tracked entry by inode and size, and reported as a single move
+    def test_file_moved(self):
+        callback = Mock(side_effect=self.apply_move)
+        old_file = os.path.join(self.test_dir, 'old.txt')
+        new_file = os.path.join(self.test_dir, 'new.txt')
+        with open(old_file, 'w') as file:
+            file.write('Hello')
+        self.track_file(old_file)
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        os.rename(old_file, new_file)
+        listener.scan_directory(n_iter=1)
+        callback.assert_called_once_with(ChangeType.MovedFile, new_file, old_file)
+
+    # A moved folder carries its contents along, and a file edited as it moved is reported as modified afterwards
+    def test_folder_moved(self):
+        callback = Mock(side_effect=self.apply_move)
+        old_dir = os.path.join(self.test_dir, 'old')
+        new_dir = os.path.join(self.test_dir, 'new')
+        os.makedirs(os.path.join(old_dir, 'sub'))
+        for name in ('a.txt', os.path.join('sub', 'b.txt')):
+            with open(os.path.join(old_dir, name), 'w') as file:
+                file.write('Hello')
+            self.track_file(os.path.join(old_dir, name))
+        for folder in (old_dir, os.path.join(old_dir, 'sub')):
+            self.folder_db[folder] = FileUtils.get_folder_encoding(folder, folder).to_value()
+        self.folder_db.commit()
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+
+        os.rename(old_dir, new_dir)
+        os.utime(os.path.join(new_dir, 'a.txt'), (1000000000, 1000000000))
+        listener.check_paths({old_dir, new_dir})
+        self.assertEqual([call(ChangeType.MovedFolder, new_dir, old_dir),
+                          call(ChangeType.ModifiedFile, os.path.join(new_dir, 'a.txt'))],
+                         callback.call_args_list)
+
+    # A move the callback does not apply is reported as a deletion and a creation
+    def test_move_not_applied(self):
+        callback = Mock()
+        old_file = os.path.join(self.test_dir, 'old.txt')
+        new_file = os.path.join(self.test_dir, 'new.txt')
+        with open(old_file, 'w') as file:
+            file.write('Hello')
+        self.track_file(old_file)
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        os.rename(old_file, new_file)
+        listener.scan_directory(n_iter=1)
+        callback.assert_any_call(ChangeType.MovedFile, new_file, old_file)
+        callback.assert_any_call(ChangeType.DeletedFile, old_file)
+        callback.assert_any_call(ChangeType.CreatedFile, new_file)
+
+    # Incremental scans only re-list folders whose modified time changed
+    def test_scan_incremental(self):
+        callback = Mock()
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        sub_dir = os.path.join(self.test_dir, 'folderTest')
+        os.mkdir(sub_dir)
+        old_file = os.path.join(sub_dir, 'old.txt')
+        with open(old_file, 'w') as file:
+            file.write('Hello')
+        # Backdate the folders so their listings are cached
+        os.utime(sub_dir, (1000000000, 1000000000))
+        os.utime(self.test_dir, (1000000000, 1000000000))
+        listener.scan_once(full=True)
+        self.assertIn(sub_dir, listener.dir_cache)
+
+        # A file added to a folder changes the folder's modified time, so it is found
+        callback.reset_mock()
+        new_file = os.path.join(sub_dir, 'new.txt')
+        with open(new_file, 'w') as file:
+            file.write('Hello')
+        listener.scan_once(full=False)
+        callback.assert_any_call(ChangeType.CreatedFile, new_file)
+
+        # Folders removed from the tree are dropped from the cache
+        shutil.rmtree(sub_dir)
+        listener.scan_once(full=False)
+        self.assertNotIn(sub_dir, listener.dir_cache)
+
+    @unittest.skipUnless(InotifyWatcher.is_supported(), 'inotify is only available on Linux')
+    def test_watch_directory(self):
+        callback = Mock()
+        listener = DirectoryListener(self.test_dir, callback, self.file_db, self.folder_db)
+        new_file = os.path.join(self.test_dir, 'fileTest.txt')
+
+        watcher = threading.Thread(target=listener.watch_directory, kwargs={'n_iter': 1, 'timeout': 5})
+        watcher.start()
+        time.sleep(0.2)
+        with open(new_file, 'w') as file:
+            file.write('Hello')
+        watcher.join()
+        callback.assert_called_with(ChangeType.CreatedFile, new_file)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+from sqlitedict import SqliteDict
+from utils.HashCache import HashCache
+from utils.TrackerIndex import TrackerIndex
+from utils.ClientFileUtils import FileUtils
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='hashes', encode=json.dumps,
+                             decode=json.loads)
+        self.cache = HashCache(TrackerIndex(self.db))
+        self.test_file = os.path.join(self.tmp_dir, 'testFile.txt')
+        with open(self.test_file, 'w') as file:
+            file.write('abc123')
+        # Settle the file's modified time, so its digest can be cached
+        os.utime(self.test_file, (12345.0, 12345.0))
+
+    def tearDown(self):
+        self.db.close(force=True)
+        shutil.rmtree(self.tmp_dir)
+
+    # Digests are reused while the size and modified time are unchanged, and only for the same algorithm
+    def test_get(self):
+        stat = os.stat(self.test_file)
+        self.cache.put(stat, 'blake2b:00ff')
+        self.assertEqual('blake2b:00ff', self.cache.get(stat, 'blake2b'))
+        self.assertIsNone(self.cache.get(stat, 'md5'))
+        os.utime(self.test_file, ns=(stat.st_mtime_ns + 1, stat.st_mtime_ns + 1))
+        self.assertIsNone(self.cache.get(os.stat(self.test_file), 'blake2b'))
+
+    # Files modified in the last couple of seconds are not cached, as they could change again unnoticed
+    def test_put_recently_modified(self):
+        os.utime(self.test_file)
+        stat = os.stat(self.test_file)
+        self.cache.put(stat, 'e99a18c428cb38d5f260853678922e03')
+        self.assertIsNone(self.cache.get(stat, 'md5'))
+
+    # A cached digest is used without reading the file
+    def test_get_file_metadata_cached(self):
+        meta = FileUtils.get_file_metadata(self.test_file, 'testFile.txt', hash_cache=self.cache)
+        self.assertEqual('e99a18c428cb38d5f260853678922e03', meta.md5)
+        self.assertEqual(os.stat(self.test_file).st_mtime_ns, meta.modified_ns)
+        self.cache.put(os.stat(self.test_file), 'not-read-again')
+        meta = FileUtils.get_file_metadata(self.test_file, 'testFile.txt', hash_cache=self.cache)
+        self.assertEqual('not-read-again', meta.md5)
+
+    # The cache persists once flushed
+    def test_flush(self):
+        stat = os.stat(self.test_file)
+        self.cache.put(stat, 'e99a18c428cb38d5f260853678922e03')
+        self.cache.flush()
+        cache = HashCache(TrackerIndex(self.db))
+        self.assertEqual('e99a18c428cb38d5f260853678922e03', cache.get(stat, 'md5'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+import hashlib
+from utils.Hashing import ContentHash
+
+
+class TestHashing(unittest.TestCase):
+
+    # MD5 digests stay plain hex, other algorithms are named in the digest
+    def test_digest(self):
+        content_hash = ContentHash('md5')
+        content_hash.update(b'ABC123')
+        self.assertEqual('bbf2dead374654cbb32a917afd236656', content_hash.digest())
+        content_hash = ContentHash('blake2b')
+        content_hash.update(b'ABC123')
+        self.assertEqual('blake2b:' + hashlib.blake2b(b'ABC123', digest_size=16).hexdigest(), content_hash.digest())
+
+    def test_for_digest(self):
+        self.assertEqual('md5', ContentHash.for_digest('bbf2dead374654cbb32a917afd236656').algorithm)
+        self.assertEqual('blake2b', ContentHash.for_digest('blake2b:00ff').algorithm)
+        with self.assertRaises(KeyError):
+            ContentHash.for_digest('sha999:00ff')
+
+    # The requested algorithm is used if both sides support it, otherwise the fastest common one, otherwise MD5
+    def test_negotiate(self):
+        self.assertEqual('md5', ContentHash.negotiate([]))
+        self.assertEqual('md5', ContentHash.negotiate(['md5', 'blake2b'], 'md5'))
+        self.assertEqual('blake2b', ContentHash.negotiate(['md5', 'blake2b'], 'sha999'))
+        self.assertEqual('md5', ContentHash.negotiate(['md5', 'sha999']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import tempfile
+import os
+import shutil
+import json
+import hashlib
+import io
+from sqlitedict import SqliteDict
+from utils.MerkleTree import MerkleTree
+from utils.ServerFileUtils import ServerFileUtils
+
+
+class TestMerkleTree(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.test_dir = os.path.join(self.tmp_dir, 'test')
+        os.mkdir(self.test_dir)
+        self.meta_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='metadata', encode=json.dumps,
+                                  decode=json.loads)
+        self.hash_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='hashmap', encode=json.dumps,
+                                  decode=json.loads)
+        self.ref_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='refs', encode=json.dumps,
+                                 decode=json.loads)
+        self.tree = MerkleTree(self.meta_db, {}, self.test_dir)
+        self.tree.rebuild()
+
+    def tearDown(self):
+        self.meta_db.close(force=True)
+        self.hash_db.close(force=True)
+        self.ref_db.close(force=True)
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, binary, modified=1608675488.0):
+        meta = {'path': path, 'modified': modified, 'md5': hashlib.md5(binary).hexdigest(), 'size': len(binary),
+                'type': 'file', 'sync': False}
+        ServerFileUtils.set_file_stream(self.hash_db, self.tree, os.path.join(self.test_dir, path), meta,
+                                        io.BytesIO(binary), ref_db=self.ref_db)
+
+    def folder_hash(self, path=''):
+        return self.tree.tree_db[os.path.normpath(os.path.join(self.test_dir, path))]
+
+    def assert_consistent(self):
+        # Hashes kept up to date with each change match those computed from scratch
+        rebuilt = MerkleTree(self.meta_db, {}, self.test_dir)
+        rebuilt.rebuild()
+        self.assertEqual(rebuilt.tree_db, self.tree.tree_db)
+
+    # Creating, editing, moving and removing items keeps every folder hash up to date
+    def test_incremental(self):
+        self.write('a/b/one.txt', b'ABC123')
+        self.write('a/two.txt', b'HelloWorld')
+        self.write('c/three.txt', b'ABC123')
+        ServerFileUtils.new_folder(self.tree, os.path.join(self.test_dir, 'empty'), {'path': 'empty', 'type': 'folder'})
+        self.assert_consistent()
+        self.write('a/b/one.txt', b'Edited')
+        self.assert_consistent()
+        ServerFileUtils.move_item(self.hash_db, self.tree, os.path.join(self.test_dir, 'a'),
+                                  os.path.join(self.test_dir, 'moved', 'a'), ref_db=self.ref_db)
+        self.assertNotIn(os.path.join(self.test_dir, 'a', 'b'), self.tree.tree_db)
+        self.assert_consistent()
+        ServerFileUtils.remove_file(self.hash_db, self.tree, os.path.join(self.test_dir, 'c', 'three.txt'),
+                                    ref_db=self.ref_db)
+        self.assert_consistent()
+        ServerFileUtils.remove_folder(self.tree, os.path.join(self.test_dir, 'moved'), self.hash_db, self.ref_db)
+        self.assertNotIn(os.path.join(self.test_dir, 'moved', 'a', 'b'), self.tree.tree_db)
+        self.assert_consistent()
+
+    # Removing a folder forgets the hashes of the folders inside it with a single pass over the tree
+    def test_remove_folder_scans_once(self):
+        class ScanCounter(dict):
+            scans = 0
+
+            def keys(self):
+                ScanCounter.scans += 1
+                return super().keys()
+
+        for i in range(10):
+            self.write('a/{}/{}/one.txt'.format(i, i), b'ABC123')
+        self.tree.tree_db = ScanCounter(self.tree.tree_db)
+        ServerFileUtils.remove_folder(self.tree, os.path.join(self.test_dir, 'a'), self.hash_db, self.ref_db)
+        self.assertEqual(1, ScanCounter.scans)
+        self.assertEqual({self.test_dir}, set(self.tree.tree_db.keys()))
+        self.assert_consistent()
+
+    # A change only alters the hashes of the folders above it, and undoing it restores them
+    def test_change_propagates(self):
+        self.write('a/one.txt', b'ABC123')
+        self.write('b/two.txt', b'ABC123')
+        root, a, b = self.folder_hash(), self.folder_hash('a'), self.folder_hash('b')
+        self.write('a/one.txt', b'ABC123', modified=1608675499.0)
+        self.assertNotEqual(root, self.folder_hash())
+        self.assertNotEqual(a, self.folder_hash('a'))
+        self.assertEqual(b, self.folder_hash('b'))
+        self.write('a/one.txt', b'ABC123')
+        self.assertEqual((root, a), (self.folder_hash(), self.folder_hash('a')))
+
+    # Identical content in differently named files or folders gives different hashes
+    def test_names_hashed(self):
+        self.write('a/one.txt', b'ABC123')
+        self.write('b/two.txt', b'ABC123')
+        self.assertNotEqual(self.folder_hash('a'), self.folder_hash('b'))
+        self.assertEqual({'a', 'b'}, set(self.tree.entries(self.test_dir)))
+        self.assertIsNone(self.tree.entries(os.path.join(self.test_dir, 'missing')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from utils.Metadata import FileMetadata, FileEncoding, FolderEncoding
+from utils.Metadata import FileMetadata, FileEncoding, FolderEncoding, Frame, FILE_RECORD, FOLDER_RECORD, \
+    ENCODING_RECORD
 
 
 class TestMetadata(unittest.TestCase):
@@ -39,3 +40,55 @@ class TestMetadata(unittest.TestCase):
         encoding = FolderEncoding('test/path', 12345.00, False)
         self.assertEqual('{"path": "test/path", "modified": 12345.0, "type": "folder", "sync": false}',
                          repr(encoding))
+
+    def test_slots(self):
+        meta = FileMetadata('test/path', 12345.00, 'ABC00AA123', 128, False)
+        self.assertFalse(hasattr(meta, '__dict__'))
+        self.assertIsNone(meta.inode)
+        with self.assertRaises(AttributeError):
+            meta.unknown = True
+
+    def test_pack_file_metadata(self):
+        meta = FileMetadata('test/pāth/example.txt', 12345.25, 'blake2b:ABC00AA123', 128, True)
+        record, body, end = Frame.read(meta.pack())
+        self.assertEqual(FILE_RECORD, record)
+        self.assertEqual(meta, FileMetadata.unpack(body))
+        self.assertEqual(len(meta.pack()), end)
+
+    def test_pack_folder_encoding(self):
+        encoding = FolderEncoding('test/path', 12345.00, False)
+        record, body, end = Frame.read(encoding.pack())
+        self.assertEqual(FOLDER_RECORD, record)
+        self.assertEqual(encoding, FolderEncoding.unpack(body))
+
+    def test_pack_file_encoding(self):
+        # The binary is not part of the frame, it follows it
+        encoding = FileEncoding(b'ABC123', 'test/path/example.txt', 12345.00, 'ABC00AA123', 6)
+        buffer = encoding.pack() + encoding.bin
+        record, body, end = Frame.read(buffer)
+        self.assertEqual(ENCODING_RECORD, record)
+        self.assertEqual({'path': 'test/path/example.txt', 'modified': 12345.00, 'md5': 'ABC00AA123', 'size': 6,
+                          'type': 'file', 'sync': False}, Frame.unpack_item(record, body))
+        self.assertEqual(b'ABC123', buffer[end:])
+
+    def test_pack_operations(self):
+        operations = [
+            {'op': 'create', 'path': 'a.txt', 'data': FileMetadata('a.txt', 12345.00, 'ABC00AA123', 128, False)},
+            {'op': 'update', 'path': 'folder', 'data': FolderEncoding('folder', 12345.00, False)},
+            {'op': 'delete', 'path': 'folder', 'data': {'type': 'folder'}},
+            {'op': 'move', 'path': 'a.txt', 'data': {'to': 'b.txt'}},
+            {'op': 'exists', 'md5': 'ABC00AA123'}
+        ]
+        expected = [dict(operation, data=operation['data'].to_dict()) if 'data' in operation and
+                    hasattr(operation['data'], 'to_dict') else operation for operation in operations]
+        self.assertEqual(expected, Frame.unpack_operations(Frame.pack_operations(operations)))
+
+    def test_unpack_malformed(self):
+        buffer = FileMetadata('a.txt', 12345.00, 'ABC00AA123', 128, False).pack()
+        with self.assertRaises(ValueError):
+            Frame.read(buffer[:-1])
+        buffer[0] = 99
+        with self.assertRaises(ValueError):
+            Frame.read(buffer)
+        with self.assertRaises(ValueError):
+            FileMetadata.unpack(b'\x00')
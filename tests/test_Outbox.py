@@ -0,0 +1,114 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+import time
+from sqlitedict import SqliteDict
+from utils.TrackerIndex import TrackerIndex
+from utils.Outbox import Outbox
+from utils.DirectoryListener import ChangeType
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'temp.db')
+        self.outbox_db = SqliteDict(self.db_path, tablename='outbox', encode=json.dumps, decode=json.loads)
+        self.outbox = Outbox(TrackerIndex(self.outbox_db), retry_delay=10, max_retry_delay=40, max_attempts=4)
+
+    def tearDown(self):
+        self.outbox_db.close(force=True)
+        shutil.rmtree(self.tmp_dir)
+
+    def make_due(self, path):
+        self.outbox.db[path] = dict(self.outbox.db[path], due=0)
+
+    # Failed operations are retried after a delay that doubles with each failure, up to the limit
+    def test_defer_backoff(self):
+        delays = []
+        for i in range(4):
+            now = time.time()
+            self.assertTrue(self.outbox.defer('/a.txt', ChangeType.CreatedFile))
+            delays.append(round(self.outbox.db['/a.txt']['due'] - now))
+        self.assertEqual([10, 20, 40, 40], delays)
+        self.assertEqual([], self.outbox.take_due())
+
+    # Operations are given up on once the retry budget is spent
+    def test_defer_gives_up(self):
+        for i in range(4):
+            self.outbox.defer('/a.txt', ChangeType.CreatedFile)
+        self.assertFalse(self.outbox.defer('/a.txt', ChangeType.CreatedFile))
+        self.assertNotIn('/a.txt', self.outbox)
+
+    # The operation given up on, with any change merged into it, is passed to the give-up callback
+    def test_give_up_callback(self):
+        given_up = []
+        self.outbox.give_up_callback = lambda path, change: given_up.append((path, change))
+        for i in range(4):
+            self.outbox.defer('/a.txt', ChangeType.ModifiedFile)
+        self.outbox.coalesce('/a.txt', ChangeType.DeletedFile)
+        self.assertEqual([], given_up)
+        self.assertFalse(self.outbox.defer('/a.txt', ChangeType.ModifiedFile))
+        self.assertEqual([('/a.txt', ChangeType.DeletedFile)], given_up)
+
+    # Pending operations survive a restart
+    def test_persisted(self):
+        self.outbox.defer('/a.txt', ChangeType.DeletedFile)
+        outbox = Outbox(TrackerIndex(SqliteDict(self.db_path, tablename='outbox', encode=json.dumps,
+                                                decode=json.loads)))
+        self.assertIn('/a.txt', outbox)
+        outbox.db['/a.txt'] = dict(outbox.db['/a.txt'], due=0)
+        self.assertEqual([('/a.txt', ChangeType.DeletedFile)], outbox.take_due())
+
+    # Only paths with a pending operation are coalesced
+    def test_coalesce_nothing_pending(self):
+        self.assertFalse(self.outbox.coalesce('/a.txt', ChangeType.ModifiedFile))
+
+    # Further edits to a file waiting to be created collapse into its creation
+    def test_coalesce_edits(self):
+        self.outbox.defer('/a.txt', ChangeType.CreatedFile)
+        self.assertTrue(self.outbox.coalesce('/a.txt', ChangeType.ModifiedFile))
+        self.assertTrue(self.outbox.coalesce('/a.txt', ChangeType.ModifiedFile))
+        self.make_due('/a.txt')
+        self.assertEqual([('/a.txt', ChangeType.CreatedFile)], self.outbox.take_due())
+
+    # Deleting an item the server never received cancels its pending creation
+    def test_coalesce_cancels(self):
+        self.outbox.defer('/a', ChangeType.CreatedFolder)
+        self.assertTrue(self.outbox.coalesce('/a', ChangeType.DeletedFolder))
+        self.assertNotIn('/a', self.outbox)
+
+    # A deletion during a retry of the creation is still sent afterwards
+    def test_coalesce_while_retrying(self):
+        self.outbox.defer('/a.txt', ChangeType.CreatedFile)
+        self.make_due('/a.txt')
+        self.assertEqual([('/a.txt', ChangeType.CreatedFile)], self.outbox.take_due())
+        self.assertTrue(self.outbox.coalesce('/a.txt', ChangeType.DeletedFile))
+        self.outbox.complete('/a.txt')
+        self.assertEqual([('/a.txt', ChangeType.DeletedFile)], self.outbox.take_due())
+        self.outbox.complete('/a.txt')
+        self.assertNotIn('/a.txt', self.outbox)
+
+    # A successful retry clears the pending operation
+    def test_complete(self):
+        self.outbox.defer('/a.txt', ChangeType.ModifiedFile)
+        self.make_due('/a.txt')
+        self.assertTrue(self.outbox.wait(timeout=0))
+        self.outbox.take_due()
+        self.assertFalse(self.outbox.wait(timeout=0))
+        self.outbox.complete('/a.txt')
+        self.assertEqual(0, len(self.outbox))
+
+    # A retry that fails again keeps its attempts and backs off further
+    def test_retry_fails(self):
+        self.outbox.defer('/a.txt', ChangeType.ModifiedFile)
+        self.make_due('/a.txt')
+        self.outbox.take_due()
+        self.outbox.defer('/a.txt', ChangeType.ModifiedFile)
+        self.assertEqual(2, self.outbox.db['/a.txt']['attempts'])
+        self.assertEqual([], self.outbox.take_due())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,17 @@
+from unittest.mock import patch
 import unittest
 import shutil
 import tempfile
 import os
 import json
 import hashlib
+import io
+import gzip
 from sqlitedict import SqliteDict
 from server import Server
-from utils.Metadata import FileEncoding
+from utils.Metadata import FileEncoding, FileMetadata, FolderEncoding, METADATA_HEADER, OFFSET_HEADER, \
+    FRAME_CONTENT_TYPE, Frame
+from utils.Chunking import ContentChunker, MAX_CHUNK_SIZE
 
 
 class TestServer(unittest.TestCase):
@@ -19,13 +24,23 @@ class TestServer(unittest.TestCase):
                                   decode=json.loads)
         self.hash_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='hashmap', encode=json.dumps,
                                   decode=json.loads)
+        self.chunk_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='chunks', encode=json.dumps,
+                                   decode=json.loads)
+        self.ref_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='refs', encode=json.dumps,
+                                 decode=json.loads)
+        self.upload_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='uploads', encode=json.dumps,
+                                    decode=json.loads)
         # Launch Flask server in test client mode
-        self.server = Server.initialise(self.test_dir, self.hash_db, self.meta_db).test_client()
+        self.server = Server.initialise(self.test_dir, self.hash_db, self.meta_db, self.chunk_db,
+                                        self.ref_db, self.upload_db).test_client()
         self.server.testing = True
 
     def tearDown(self):
         self.meta_db.close(force=True)
         self.hash_db.close(force=True)
+        self.chunk_db.close(force=True)
+        self.ref_db.close(force=True)
+        self.upload_db.close(force=True)
         # Remove temp dir
         shutil.rmtree(self.test_dir)
 
@@ -47,6 +62,84 @@ class TestServer(unittest.TestCase):
         resp = self.server.get('/sync/exists/{}'.format(md5))
         self.assertEqual(200, resp.status_code)
 
+    # bulk_exists_check() returns the subset of requested hashes held by the server
+    def test_bulk_exists_200(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        resp = self.server.post('/exists', json={'md5s': ['INVALID-MD5', 'bbf2dead374654cbb32a917afd236656']})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['bbf2dead374654cbb32a917afd236656'], resp.get_json()['present'])
+
+    # Files hashed with a negotiated algorithm are verified and found by their tagged digest
+    def test_stream_blake2b_200(self):
+        self.assertIn('blake2b', self.server.get('/hashes').get_json()['algorithms'])
+        digest = 'blake2b:' + hashlib.blake2b(b'ABC123', digest_size=16).hexdigest()
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164, md5=digest, size=6, sync=False)
+        resp = self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                                headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        self.assertEqual(200, resp.status_code)
+        resp = self.server.post('/exists', json={'md5s': [digest, 'bbf2dead374654cbb32a917afd236656']})
+        self.assertEqual([digest], resp.get_json()['present'])
+
+    # Streamed uploads can be compressed with a negotiated Content-Encoding
+    def test_stream_compressed_200(self):
+        self.assertIn('gzip', self.server.get('/encodings').get_json()['encodings'])
+        binary = b'ABC123' * 1000
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5=hashlib.md5(binary).hexdigest(), size=len(binary), sync=False)
+        resp = self.server.post('/sync/example/stream.txt', data=io.BytesIO(gzip.compress(binary)),
+                                headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip',
+                                         METADATA_HEADER: repr(meta)})
+        self.assertEqual(200, resp.status_code)
+        with open(os.path.join(self.test_dir, 'example', 'stream.txt'), 'rb') as file:
+            self.assertEqual(binary, file.read())
+
+    # append_upload() continues a resumable upload from the offset the server acknowledged
+    def test_resumable_upload_200(self):
+        binary = b'ABC123' * 1000
+        meta = FileMetadata(path='example/large.bin', modified=1608675488.0458164,
+                            md5=hashlib.md5(binary).hexdigest(), size=len(binary), sync=False)
+        resp = self.server.post('/upload/example/large.bin', headers={METADATA_HEADER: repr(meta)})
+        self.assertEqual(200, resp.status_code)
+        upload = resp.get_json()
+        self.assertEqual(0, upload['offset'])
+
+        # Part of the file is received before the client stops sending
+        resp = self.server.put('/upload/{}'.format(upload['id']), data=io.BytesIO(binary[:2500]),
+                               headers={'Content-Type': 'application/octet-stream', OFFSET_HEADER: '0'})
+        self.assertEqual(202, resp.status_code)
+        self.assertEqual(2500, resp.get_json()['offset'])
+        resp = self.server.post('/upload/example/large.bin', headers={METADATA_HEADER: repr(meta)})
+        self.assertEqual({'id': upload['id'], 'offset': 2500}, resp.get_json())
+
+        # Sending from the wrong offset is refused
+        resp = self.server.put('/upload/{}'.format(upload['id']), data=io.BytesIO(binary),
+                               headers={'Content-Type': 'application/octet-stream', OFFSET_HEADER: '0'})
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual(2500, resp.get_json()['offset'])
+
+        # An unsupported Content-Encoding is refused, leaving the session to be continued
+        resp = self.server.put('/upload/{}'.format(upload['id']), data=io.BytesIO(binary[2500:]),
+                               headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'br',
+                                        OFFSET_HEADER: '2500'})
+        self.assertEqual(400, resp.status_code)
+
+        resp = self.server.put('/upload/{}'.format(upload['id']), data=io.BytesIO(gzip.compress(binary[2500:])),
+                               headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip',
+                                        OFFSET_HEADER: '2500'})
+        self.assertEqual(200, resp.status_code)
+        with open(os.path.join(self.test_dir, 'example', 'large.bin'), 'rb') as file:
+            self.assertEqual(binary, file.read())
+        self.assertEqual(404, self.server.put('/upload/{}'.format(upload['id']), data=b'',
+                                              headers={OFFSET_HEADER: '0'}).status_code)
+
+    # bulk_exists_check() gives 400 if no list of hashes is given
+    def test_bulk_exists_400(self):
+        resp = self.server.post('/exists', json={'md5': 'bbf2dead374654cbb32a917afd236656'})
+        self.assertEqual(400, resp.status_code)
+
     # file_exists() gives 204 if requested hash does not exist
     def test_file_exists_204(self):
         resp = self.server.get('/sync/exists/INVALID-MD5')
@@ -79,6 +172,273 @@ class TestServer(unittest.TestCase):
         resp = self.server.post('/sync/{}'.format(item.path), json=repr(item))
         self.assertEqual(422, resp.status_code)
 
+    # new_item() gives 200 and writes the file when the binary is streamed in the request body
+    def test_new_item_stream_200(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        resp = self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                                headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        self.assertEqual(200, resp.status_code)
+        with open(os.path.join(self.test_dir, 'example', 'stream.txt'), 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+
+    # new_item() gives 400 if a streamed upload has no metadata header
+    def test_new_item_stream_400(self):
+        resp = self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                                headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(400, resp.status_code)
+
+    # update_item() gives 422 if a streamed binary does not match its MD5
+    def test_update_item_stream_422(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='NOT-MATCHING-BIN', size=6, sync=False)
+        resp = self.server.put('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                               headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        self.assertEqual(422, resp.status_code)
+
+    # A delta upload rebuilds an edited file from the server's existing chunks plus the new ones
+    def test_delta_update_200(self):
+        chunker = ContentChunker()
+        original = os.urandom(512 * 1024)
+        edited = original[:200000] + b'edited' + original[200000:]
+        meta = FileMetadata(path='example/big.bin', modified=1608675488.0458164,
+                            md5=hashlib.md5(original).hexdigest(), size=len(original), sync=False)
+        self.server.post('/sync/example/big.bin', data=io.BytesIO(original),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+
+        chunks = chunker.chunk_list(io.BytesIO(edited))
+        resp = self.server.post('/delta/example/big.bin', json={'chunks': chunks})
+        self.assertEqual(200, resp.status_code)
+        missing = resp.get_json()['missing']
+        self.assertLess(len(missing), len(chunks))
+
+        body = (json.dumps(chunks) + '\n').encode('utf-8')
+        body += b''.join(chunk for chunk in chunker.split(io.BytesIO(edited))
+                         if hashlib.md5(chunk).hexdigest() in missing)
+        meta = FileMetadata(path='example/big.bin', modified=1608675488.0458164,
+                            md5=hashlib.md5(edited).hexdigest(), size=len(edited), sync=False)
+        resp = self.server.put('/delta/example/big.bin', data=io.BytesIO(body),
+                               headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        self.assertEqual(200, resp.status_code)
+        with open(os.path.join(self.test_dir, 'example', 'big.bin'), 'rb') as file:
+            self.assertEqual(edited, file.read())
+        # Chunk lists are only kept for content still on the server
+        self.assertEqual([hashlib.md5(edited).hexdigest()], list(self.chunk_db.keys()))
+        resp = self.server.delete('/sync/example/big.bin', json={'type': 'file'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(0, len(self.chunk_db))
+
+    # Delta requests give 400 for a malformed chunk list, or chunks larger than the chunker makes
+    def test_delta_400(self):
+        original = b'ABC123' * 1000
+        meta = FileMetadata(path='example/small.bin', modified=1608675488.0458164,
+                            md5=hashlib.md5(original).hexdigest(), size=len(original), sync=False)
+        self.server.post('/sync/example/small.bin', data=io.BytesIO(original),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        for body in (b'not json', b'{"chunks": 1}', b'{"chunks": [["ABC123"]]}'):
+            resp = self.server.post('/delta/example/small.bin', data=body)
+            self.assertEqual(400, resp.status_code)
+
+        chunks = [[hashlib.md5(b'').hexdigest(), MAX_CHUNK_SIZE + 1]]
+        resp = self.server.put('/delta/example/small.bin', data=io.BytesIO((json.dumps(chunks) + '\n').encode('utf-8')),
+                               headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        self.assertEqual(400, resp.status_code)
+
+    # delta_missing() gives 404 if the server has no copy of the file to delta against
+    def test_delta_missing_404(self):
+        resp = self.server.post('/delta/example/nonexistent.bin', json={'chunks': [['ABC123', 6]]})
+        self.assertEqual(404, resp.status_code)
+
+    # batch() applies each operation in order and returns a result per operation
+    def test_batch_200(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+
+        copy_meta = json.loads(repr(meta))
+        copy_meta['path'] = 'example/copy.txt'
+        resp = self.server.post('/batch', json={'operations': [
+            {'op': 'create', 'path': 'folder', 'data': {'path': 'folder', 'modified': 100000.00,
+                                                        'type': 'folder', 'sync': False}},
+            {'op': 'exists', 'md5': 'bbf2dead374654cbb32a917afd236656'},
+            {'op': 'exists', 'md5': 'INVALID-MD5'},
+            {'op': 'create', 'path': 'example/copy.txt', 'data': copy_meta},
+            {'op': 'delete', 'path': 'example/stream.txt', 'data': {'type': 'file'}},
+            {'op': 'delete', 'path': 'folder', 'data': {'type': 'invalid-type'}},
+            {'op': 'invalid-op'}
+        ]})
+        self.assertEqual(200, resp.status_code)
+        statuses = [result['status'] for result in resp.get_json()['results']]
+        self.assertEqual([200, 200, 204, 200, 200, 400, 400], statuses)
+        self.assertTrue(os.path.isdir(os.path.join(self.test_dir, 'folder')))
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'example', 'stream.txt')))
+        with open(os.path.join(self.test_dir, 'example', 'copy.txt'), 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+
+    # move_item() renames a folder on the server, so its files are still found by their MD5 at the new path
+    def test_move_item_200(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        resp = self.server.post('/move/example', json={'to': 'moved/example'})
+        self.assertEqual(200, resp.status_code)
+        moved = os.path.join(self.test_dir, 'moved', 'example', 'stream.txt')
+        with open(moved, 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+        self.assertEqual(moved, self.hash_db['bbf2dead374654cbb32a917afd236656'])
+        self.assertIn(moved, self.meta_db)
+        resp = self.server.get('/sync/exists/bbf2dead374654cbb32a917afd236656')
+        self.assertEqual(200, resp.status_code)
+
+    # move_item() gives 404 if there is nothing to move, and 409 if the target exists
+    def test_move_item_404_409(self):
+        resp = self.server.post('/move/missing.txt', json={'to': 'moved.txt'})
+        self.assertEqual(404, resp.status_code)
+        os.mkdir(os.path.join(self.test_dir, 'first'))
+        os.mkdir(os.path.join(self.test_dir, 'second'))
+        resp = self.server.post('/batch', json={'operations': [
+            {'op': 'move', 'path': 'first', 'data': {'to': 'second'}},
+            {'op': 'move', 'path': 'first', 'data': {}}
+        ]})
+        self.assertEqual([409, 400], [result['status'] for result in resp.get_json()['results']])
+        # Neither end of a move may be outside the sync directory
+        outside = os.path.join(self.tmp_dir, 'outside')
+        self.assertEqual(400, self.server.post('/move/first', json={'to': outside}).status_code)
+        self.assertEqual(400, self.server.post('/move/first', json={'to': '../outside'}).status_code)
+        self.assertEqual(400, self.server.post('/move/..', json={'to': 'moved'}).status_code)
+        self.assertFalse(os.path.exists(outside))
+        self.assertTrue(os.path.isdir(os.path.join(self.test_dir, 'first')))
+
+    # new_item() and batch() accept binary frames
+    def test_batch_frames_200(self):
+        encoding = FileEncoding(bin=b'ABC123', path='example/stream.txt', modified=1608675488.0458164,
+                                md5='bbf2dead374654cbb32a917afd236656', size=6)
+        # The file binary follows its frame as is
+        resp = self.server.post('/sync/example/stream.txt', data=bytes(encoding.pack() + encoding.bin),
+                                headers={'Content-Type': FRAME_CONTENT_TYPE})
+        self.assertEqual(200, resp.status_code)
+        meta = FileMetadata(path='example/copy.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        body = Frame.pack_operations([
+            {'op': 'create', 'path': 'folder', 'data': FolderEncoding('folder', 100000.00, False)},
+            {'op': 'exists', 'md5': 'INVALID-MD5'},
+            {'op': 'create', 'path': 'example/copy.txt', 'data': meta},
+            {'op': 'move', 'path': 'example/copy.txt', 'data': {'to': 'folder/copy.txt'}},
+            {'op': 'delete', 'path': 'example/stream.txt', 'data': {'type': 'file'}}
+        ])
+        resp = self.server.post('/batch', data=body, headers={'Content-Type': FRAME_CONTENT_TYPE})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([200, 204, 200, 200, 200], [result['status'] for result in resp.get_json()['results']])
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'example', 'stream.txt')))
+        with open(os.path.join(self.test_dir, 'folder', 'copy.txt'), 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+
+        resp = self.server.post('/batch', data=body[:-1], headers={'Content-Type': FRAME_CONTENT_TYPE})
+        self.assertEqual(400, resp.status_code)
+
+    # compare_manifest() returns what the client must send, and the digests of the files the server already holds
+    def test_manifest_200(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        manifest = json.dumps({'entries': [
+            {'path': 'example', 'type': 'folder'},
+            {'path': 'missing', 'type': 'folder'},
+            {'path': 'example/stream.txt', 'type': 'file', 'size': 6, 'modified': 1608675488.0458164},
+            {'path': 'example/new.txt', 'type': 'file', 'size': 6, 'modified': 1608675488.0458164},
+        ]}).encode('utf-8')
+        resp = self.server.post('/manifest', data=io.BytesIO(gzip.compress(manifest)),
+                                headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'example': None, 'example/stream.txt': 'bbf2dead374654cbb32a917afd236656'},
+                         resp.get_json()['synced'])
+        self.assertEqual([{'op': 'create', 'path': 'missing', 'type': 'folder'},
+                          {'op': 'create', 'path': 'example/new.txt', 'type': 'file'}], resp.get_json()['operations'])
+
+        # A file whose size, modified time or digest differs is sent as an update
+        resp = self.server.post('/manifest', json={'entries': [
+            {'path': 'example/stream.txt', 'type': 'file', 'size': 6, 'modified': 1608675490.0},
+            {'path': 'example/stream.txt', 'type': 'file', 'size': 6, 'modified': 1608675488.0458164,
+             'md5': 'ABC123AA00'}
+        ]})
+        self.assertEqual([{'op': 'update', 'path': 'example/stream.txt', 'type': 'file'}] * 2,
+                         resp.get_json()['operations'])
+        self.assertEqual(400, self.server.post('/manifest', json={'entries': [{'path': 'a.txt'}]}).status_code)
+
+    # unpack_files() writes each file in a pack, failing only the corrupt ones
+    def test_pack_200(self):
+        files = [('a/one.txt', b'ABC123'), ('a/b/two.txt', b'HelloWorld'), ('a/b/corrupt.txt', b'ABC123'),
+                 ('../outside/evil.txt', b'ABC123')]
+        body = bytearray()
+        for path, binary in files:
+            md5 = 'INVALID-MD5' if 'corrupt' in path else hashlib.md5(binary).hexdigest()
+            meta = FileMetadata(path=path, modified=1608675488.0, md5=md5, size=len(binary), sync=False)
+            body += meta.pack(binary=True) + binary
+        resp = self.server.post('/pack', data=io.BytesIO(gzip.compress(bytes(body))),
+                                headers={'Content-Type': FRAME_CONTENT_TYPE, 'Content-Encoding': 'gzip'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([200, 200, 422, 400], [result['status'] for result in resp.get_json()['results']])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'outside')))
+        with open(os.path.join(self.test_dir, 'a', 'b', 'two.txt'), 'rb') as file:
+            self.assertEqual(b'HelloWorld', file.read())
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'a', 'b', 'corrupt.txt')))
+        self.assertEqual(6, self.meta_db[os.path.join(self.test_dir, 'a', 'one.txt')]['size'])
+
+        # A pack that ends inside a file keeps the files before it
+        resp = self.server.post('/pack', data=bytes(body[:-1]), headers={'Content-Type': FRAME_CONTENT_TYPE})
+        self.assertEqual([200, 200, 422, 400], [result['status'] for result in resp.get_json()['results']])
+        self.assertEqual(415, self.server.post('/pack', json={}).status_code)
+
+    # Uncompressed bodies larger than the request allows give 400 before any of the body is read
+    def test_body_too_large_400(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=3, sync=False)
+        resp = self.server.post('/sync/example/stream.txt', data=b'ABC123',
+                                headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        self.assertEqual(400, resp.status_code)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'example', 'stream.txt')))
+        with patch('server.Server.PACK_LIMIT', 10), patch('server.Server.MANIFEST_LIMIT', 10):
+            resp = self.server.post('/pack', data=b'A' * 11, headers={'Content-Type': FRAME_CONTENT_TYPE})
+            self.assertEqual(400, resp.status_code)
+            self.assertEqual(400, self.server.post('/manifest', json={'entries': []}).status_code)
+
+    # folder_tree() gives the hash of a folder and the digest of each entry in it
+    def test_tree_200_404(self):
+        meta = FileMetadata(path='example/stream.txt', modified=1608675488.0458164,
+                            md5='bbf2dead374654cbb32a917afd236656', size=6, sync=False)
+        root = self.server.get('/tree/').get_json()['hash']
+        self.server.post('/sync/example/stream.txt', data=io.BytesIO(b'ABC123'),
+                         headers={'Content-Type': 'application/octet-stream', METADATA_HEADER: repr(meta)})
+        resp = self.server.get('/tree/')
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(root, resp.get_json()['hash'])
+        self.assertEqual(['example'], list(resp.get_json()['entries']))
+        resp = self.server.get('/tree/example')
+        self.assertEqual(['stream.txt'], list(resp.get_json()['entries']))
+        self.assertEqual(404, self.server.get('/tree/missing').status_code)
+
+    # batch() gives 400 if the body is not a list of operations
+    def test_batch_400(self):
+        resp = self.server.post('/batch', json={'not-operations': []})
+        self.assertEqual(400, resp.status_code)
+
+    # Paths sent by clients cannot lead outside the sync directory
+    def test_outside_sync_dir_400(self):
+        outside = os.path.join(self.tmp_dir, 'outside')
+        os.mkdir(outside)
+        resp = self.server.post('/batch', json={'operations': [
+            {'op': 'delete', 'path': outside, 'data': {'type': 'folder'}},
+            {'op': 'delete', 'path': '../outside', 'data': {'type': 'folder'}},
+            {'op': 'create', 'path': '../outside/new', 'data': {'type': 'folder'}}
+        ]})
+        self.assertEqual([400, 400, 400], [result['status'] for result in resp.get_json()['results']])
+        self.assertEqual([], os.listdir(outside))
+        self.assertEqual(400, self.server.get('/tree/../outside').status_code)
+        shutil.rmtree(outside)
+
     # update_item() gives 200 if provided request was valid
     def test_update_item_200(self):
         # Create an item to update
@@ -5,8 +5,9 @@ import shutil
 import json
 import hashlib
 import filecmp
+import io
 from sqlitedict import SqliteDict
-from utils.ServerFileUtils import ServerFileUtils
+from utils.ServerFileUtils import ServerFileUtils, UploadOffsetError
 
 
 class TestServerFileUtils(unittest.TestCase):
@@ -17,14 +18,27 @@ class TestServerFileUtils(unittest.TestCase):
         self.test_dir = os.path.join(self.tmp_dir, 'test')
         self.meta_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='metadata', encode=json.dumps, decode=json.loads)
         self.hash_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='hashmap', encode=json.dumps, decode=json.loads)
+        self.ref_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='refs', encode=json.dumps, decode=json.loads)
+        self.upload_db = SqliteDict(os.path.join(self.tmp_dir, 'temp.db'), tablename='uploads', encode=json.dumps, decode=json.loads)
         os.mkdir(self.test_dir)
 
     def tearDown(self):
         self.meta_db.close(force=True)
         self.hash_db.close(force=True)
+        self.ref_db.close(force=True)
+        self.upload_db.close(force=True)
         # Remove temp dir
         shutil.rmtree(self.tmp_dir)
 
+    def test_resolve_path(self):
+        self.assertEqual(os.path.join(self.test_dir, 'a', 'b.txt'),
+                         ServerFileUtils.resolve_path(self.test_dir, 'a/./c/../b.txt'))
+        self.assertEqual(self.test_dir, ServerFileUtils.resolve_path(self.test_dir, ''))
+        os.symlink(self.tmp_dir, os.path.join(self.test_dir, 'link'))
+        for path in ('../temp.db', self.tmp_dir, 'link/temp.db', None):
+            with self.assertRaises(KeyError):
+                ServerFileUtils.resolve_path(self.test_dir, path)
+
     def test_new_folder(self):
         meta_str = json.dumps({'test1': 'value1'})
         new_folder_test = os.path.join(self.test_dir, 'test1', 'test1')
@@ -42,9 +56,35 @@ class TestServerFileUtils(unittest.TestCase):
 
         self.assertFalse(os.path.exists(test_dir))
         # Check metadata has been removed
-        with self.assertRaises(KeyError):
-            str = self.meta_db[test_dir]
+        self.assertNotIn(test_dir, self.meta_db)
+
+
+    # Moving a folder carries the metadata and content references of the files inside it to their new paths
+    def test_move_item(self):
+        md5 = 'bbf2dead374654cbb32a917afd236656'
+        file = os.path.join(self.test_dir, 'parent', 'sub', 'test.txt')
+        data_dict = {'bin': 'QUJDMTIz', 'path': 'parent/sub/test.txt', 'modified': 1608675488.0458164, 'md5': md5,
+                     'size': 6}
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, file, data_dict, ref_db=self.ref_db)
+        self.meta_db[os.path.join(self.test_dir, 'parent')] = {'type': 'folder'}
+        self.meta_db.commit()
+
+        target = os.path.join(self.test_dir, 'renamed')
+        ServerFileUtils.move_item(self.hash_db, self.meta_db, os.path.join(self.test_dir, 'parent'), target,
+                                  ref_db=self.ref_db)
+        moved = os.path.join(target, 'sub', 'test.txt')
+        self.assertTrue(os.path.isfile(moved))
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'parent')))
+        self.assertEqual(data_dict, self.meta_db[moved])
+        self.assertIn(target, self.meta_db)
+        self.assertNotIn(file, self.meta_db)
+        self.assertEqual(moved, self.hash_db[md5])
+        self.assertEqual([moved], list(self.ref_db[md5]))
+        self.assertEqual(moved, ServerFileUtils.find_content(self.hash_db, self.ref_db, md5))
 
+        # The target must not exist already
+        with self.assertRaises(FileExistsError):
+            ServerFileUtils.move_item(self.hash_db, self.meta_db, moved, target)
 
     def test_set_file(self):
         test_file = os.path.join(self.test_dir, 'parent', 'test3.txt')
@@ -76,6 +116,36 @@ class TestServerFileUtils(unittest.TestCase):
         # Check file modified has been set correctly.
         self.assertAlmostEqual(1608675488.0458164, os.stat(test_file).st_mtime)
 
+    def test_set_file_stream(self):
+        test_file = os.path.join(self.test_dir, 'parent', 'stream.txt')
+        meta = {
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': 'bbf2dead374654cbb32a917afd236656',
+            'size': 6,
+            'type': 'file'
+        }
+        ServerFileUtils.set_file_stream(self.hash_db, self.meta_db, test_file, dict(meta), io.BytesIO(b'ABC123'))
+
+        self.assertEqual(meta, self.meta_db[test_file])
+        self.assertEqual(test_file, self.hash_db['bbf2dead374654cbb32a917afd236656'])
+        with open(test_file, 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+        self.assertAlmostEqual(1608675488.0458164, os.stat(test_file).st_mtime)
+
+    # A streamed binary that does not match the metadata's MD5 is rejected
+    def test_set_file_stream_corrupt_ioerror(self):
+        test_file = os.path.join(self.test_dir, 'parent', 'stream.txt')
+        meta = {
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': 'md5-doesnt-match',
+            'size': 6,
+            'type': 'file'
+        }
+        with self.assertRaises(OSError):
+            ServerFileUtils.set_file_stream(self.hash_db, self.meta_db, test_file, meta, io.BytesIO(b'ABC123'))
+
     # This test simulates a file with binary content that was corrupted in transmission
     def test_set_file_corrupt_ioerror(self):
         test_file = os.path.join(self.test_dir, 'parent', 'test4.txt')
@@ -89,6 +159,24 @@ class TestServerFileUtils(unittest.TestCase):
         with self.assertRaises(OSError):
             ServerFileUtils.set_file(self.hash_db, self.meta_db, test_file, data_dict)
 
+    # A corrupted update must leave the existing copy of the file untouched, and no temporary file behind
+    def test_set_file_corrupt_keeps_existing(self):
+        test_file = os.path.join(self.test_dir, 'parent', 'test4.txt')
+        data_dict = {
+            'bin': 'QUJDMTIz',  # 'ABC123' encoded in base64
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': 'bbf2dead374654cbb32a917afd236656',
+            'size': 6
+        }
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, test_file, dict(data_dict))
+        data_dict['bin'] = 'WFlaNDU2'  # 'XYZ456', which does not match the MD5
+        with self.assertRaises(OSError):
+            ServerFileUtils.set_file(self.hash_db, self.meta_db, test_file, data_dict)
+        with open(test_file, 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+        self.assertEqual(['test4.txt'], os.listdir(os.path.dirname(test_file)))
+
     # This test simulates the feature that set_file will clone files with matching MD5s even if binary data is missing
     def test_set_file_md5_match(self):
         # Write a file normally
@@ -129,8 +217,141 @@ class TestServerFileUtils(unittest.TestCase):
         # Check it's removed
         self.assertFalse(os.path.isfile(file))
         # Check hash DB's value is gone
-        with self.assertRaises(KeyError):
-            val = self.hash_db['bbf2dead374654cbb32a917afd236656']
+        self.assertNotIn('bbf2dead374654cbb32a917afd236656', self.hash_db)
         # Check metatata DB's value is gone
-        with self.assertRaises(KeyError):
-            meta = self.meta_db[file]
+        self.assertNotIn(file, self.meta_db)
+
+    # Removing one of several files with identical content keeps the content mapped for the others
+    def test_remove_file_shared_content(self):
+        md5 = 'bbf2dead374654cbb32a917afd236656'
+        first = os.path.join(self.test_dir, 'parent', 'shared1.txt')
+        second = os.path.join(self.test_dir, 'parent', 'shared2.txt')
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, first, {
+            'bin': 'QUJDMTIz',  # 'ABC123' encoded in base64
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': md5,
+            'size': 6
+        }, ref_db=self.ref_db)
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, second, {'md5': md5}, ref_db=self.ref_db)
+        self.assertTrue(filecmp.cmp(first, second, shallow=False))
+        self.assertEqual({first, second}, set(self.ref_db[md5].keys()))
+
+        ServerFileUtils.remove_file(self.hash_db, self.meta_db, first, ref_db=self.ref_db)
+        self.assertFalse(os.path.isfile(first))
+        self.assertEqual(second, self.hash_db[md5])
+        self.assertEqual([second], list(self.ref_db[md5].keys()))
+        with open(second, 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+
+        ServerFileUtils.remove_file(self.hash_db, self.meta_db, second, ref_db=self.ref_db)
+        self.assertNotIn(md5, self.hash_db)
+        self.assertNotIn(md5, self.ref_db)
+
+    # Overwriting a file that shares its content with another file does not modify the other file
+    def test_set_file_shared_content_not_modified(self):
+        md5 = 'bbf2dead374654cbb32a917afd236656'
+        first = os.path.join(self.test_dir, 'parent', 'shared1.txt')
+        second = os.path.join(self.test_dir, 'parent', 'shared2.txt')
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, first, {
+            'bin': 'QUJDMTIz',  # 'ABC123' encoded in base64
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': md5,
+            'size': 6
+        }, ref_db=self.ref_db)
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, second, {'md5': md5}, ref_db=self.ref_db)
+        ServerFileUtils.set_file_stream(self.hash_db, self.meta_db, second, {
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': '68e109f0f40ca72a15e05cc22786f8e6',
+            'size': 10
+        }, io.BytesIO(b'HelloWorld'), ref_db=self.ref_db)
+
+        with open(first, 'rb') as file:
+            self.assertEqual(b'ABC123', file.read())
+        self.assertEqual([first], list(self.ref_db[md5].keys()))
+        self.assertEqual(first, self.hash_db[md5])
+
+    # Removing a folder drops the metadata and content references of the files inside it
+    def test_remove_folder_releases_files(self):
+        folder = os.path.join(self.test_dir, 'folder')
+        file = os.path.join(folder, 'file.txt')
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, file, {
+            'bin': 'QUJDMTIz',  # 'ABC123' encoded in base64
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': 'bbf2dead374654cbb32a917afd236656',
+            'size': 6
+        }, ref_db=self.ref_db)
+        ServerFileUtils.remove_folder(self.meta_db, folder, hash_db=self.hash_db, ref_db=self.ref_db)
+        self.assertFalse(os.path.exists(folder))
+        self.assertNotIn(file, self.meta_db)
+        self.assertNotIn('bbf2dead374654cbb32a917afd236656', self.hash_db)
+
+    # find_content() verifies holders by their stat fingerprint and forgets files changed outside DropNot
+    def test_find_content(self):
+        md5 = 'bbf2dead374654cbb32a917afd236656'
+        file = os.path.join(self.test_dir, 'parent', 'find.txt')
+        ServerFileUtils.set_file(self.hash_db, self.meta_db, file, {
+            'bin': 'QUJDMTIz',  # 'ABC123' encoded in base64
+            'path': 'example/path',
+            'modified': 1608675488.0458164,
+            'md5': md5,
+            'size': 6
+        }, ref_db=self.ref_db)
+        self.assertEqual(file, ServerFileUtils.find_content(self.hash_db, self.ref_db, md5))
+
+        # Modify the file behind DropNot's back
+        with open(file, 'a') as f:
+            f.write('changed')
+        self.assertIsNone(ServerFileUtils.find_content(self.hash_db, self.ref_db, md5))
+        self.assertNotIn(md5, self.hash_db)
+
+    # An interrupted resumable upload keeps the bytes it received, and continues from there
+    def test_resumable_upload(self):
+        binary = os.urandom(300000)
+        target = os.path.join(self.test_dir, 'example', 'large.bin')
+        meta = {'path': 'example/large.bin', 'modified': 1608675488.0458164, 'md5': hashlib.md5(binary).hexdigest(),
+                'size': len(binary), 'type': 'file'}
+
+        class DroppedStream(io.BytesIO):
+            # Stream whose connection drops after its data
+            def read(self, size=-1):
+                data = super().read(size)
+                if not data:
+                    raise ConnectionResetError()
+                return data
+
+        upload_id, offset = ServerFileUtils.open_upload(self.upload_db, target, meta)
+        self.assertEqual(0, offset)
+        with self.assertRaises(ConnectionResetError):
+            ServerFileUtils.append_upload(self.hash_db, self.meta_db, self.upload_db, upload_id, 0,
+                                          DroppedStream(binary[:100000]), ref_db=self.ref_db)
+        self.assertFalse(os.path.exists(target))
+
+        # The same content resumes the same session from the acknowledged offset
+        self.assertEqual((upload_id, 100000), ServerFileUtils.open_upload(self.upload_db, target, meta))
+        with self.assertRaises(UploadOffsetError):
+            ServerFileUtils.append_upload(self.hash_db, self.meta_db, self.upload_db, upload_id, 0,
+                                          io.BytesIO(binary), ref_db=self.ref_db)
+        received = ServerFileUtils.append_upload(self.hash_db, self.meta_db, self.upload_db, upload_id, 100000,
+                                                 io.BytesIO(binary[100000:]), ref_db=self.ref_db)
+        self.assertEqual(len(binary), received)
+        with open(target, 'rb') as file:
+            self.assertEqual(binary, file.read())
+        self.assertEqual(meta['md5'], self.meta_db[target]['md5'])
+        self.assertNotIn(upload_id, self.upload_db)
+        self.assertEqual(['large.bin'], os.listdir(os.path.join(self.test_dir, 'example')))
+
+    # A resumable upload whose content does not match its digest is discarded
+    def test_resumable_upload_corrupt(self):
+        target = os.path.join(self.test_dir, 'example', 'large.bin')
+        meta = {'path': 'example/large.bin', 'modified': 1608675488.0458164, 'md5': hashlib.md5(b'ABC123').hexdigest(),
+                'size': 6, 'type': 'file'}
+        upload_id, offset = ServerFileUtils.open_upload(self.upload_db, target, meta)
+        with self.assertRaises(IOError):
+            ServerFileUtils.append_upload(self.hash_db, self.meta_db, self.upload_db, upload_id, 0,
+                                          io.BytesIO(b'ABC124'), ref_db=self.ref_db)
+        self.assertNotIn(upload_id, self.upload_db)
+        self.assertEqual([], os.listdir(os.path.join(self.test_dir, 'example')))
@@ -0,0 +1,152 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+import threading
+import io
+import hashlib
+from sqlitedict import SqliteDict
+from server import Server
+from utils.ServerStore import ServerStore
+from utils.ServerFileUtils import ServerFileUtils
+from utils.Metadata import FileEncoding, FileMetadata
+
+
+class TestServerStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'temp.db')
+        self.store = ServerStore(self.db_path)
+        self.meta_db = self.store.table('metadata')
+        self.hash_db = self.store.table('hashmap')
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    # Writes outside of a transaction are committed straight away
+    def test_autocommit(self):
+        self.meta_db['/a.txt'] = {'type': 'file'}
+        other = ServerStore(self.db_path)
+        self.assertEqual({'type': 'file'}, other.table('metadata')['/a.txt'])
+        other.close()
+
+    # Writes in a transaction are visible to the writer at once, and to others only once committed
+    def test_transaction(self):
+        other = ServerStore(self.db_path).table('metadata')
+        with self.store.transaction():
+            self.meta_db['/a.txt'] = {'type': 'file'}
+            self.hash_db['ABC'] = '/a.txt'
+            self.assertEqual({'type': 'file'}, self.meta_db['/a.txt'])
+            self.assertEqual(['/a.txt'], self.meta_db.keys())
+            self.assertNotIn('/a.txt', other)
+        self.assertIn('/a.txt', other)
+        self.assertEqual('/a.txt', self.hash_db['ABC'])
+
+    # Keys with a prefix are found with a range query, including keys just past the prefix's separator
+    def test_keys_with_prefix(self):
+        for path in ('/a', '/a/b.txt', '/a/c/d.txt', '/a0.txt', '/a-b.txt', '/a/\U0001F600.txt', '/b.txt'):
+            self.meta_db[path] = {'type': 'file'}
+        self.assertCountEqual(['/a/b.txt', '/a/c/d.txt', '/a/\U0001F600.txt'], self.meta_db.keys_with_prefix('/a/'))
+        self.assertCountEqual(self.meta_db.keys(), self.meta_db.keys_with_prefix(''))
+        self.assertEqual(['/a/c/d.txt'], ServerFileUtils.keys_with_prefix({'/a/c/d.txt': 1, '/a.txt': 2}, '/a/c/'))
+
+    # Writes are discarded if the transaction raises
+    def test_rollback(self):
+        self.meta_db['/a.txt'] = {'type': 'file'}
+        with self.assertRaises(IOError):
+            with self.store.transaction():
+                self.meta_db.pop('/a.txt')
+                self.hash_db['ABC'] = '/a.txt'
+                self.assertNotIn('/a.txt', self.meta_db)
+                raise IOError('Corrupted')
+        self.assertIn('/a.txt', self.meta_db)
+        self.assertNotIn('ABC', self.hash_db)
+
+    # Writes persisted with a checkpoint survive a later rollback of the transaction
+    def test_checkpoint(self):
+        with self.assertRaises(IOError):
+            with self.store.transaction():
+                self.meta_db['/a.txt'] = {'type': 'file'}
+                self.meta_db.checkpoint()
+                self.hash_db['ABC'] = '/a.txt'
+                raise IOError('Disconnected')
+        self.assertIn('/a.txt', self.meta_db)
+        self.assertNotIn('ABC', self.hash_db)
+
+    # Concurrent transactions updating the same holder map do not lose each other's changes
+    def test_concurrent_references(self):
+        ref_db = self.store.table('refs')
+        files = [os.path.join(self.tmp_dir, 'file{}.txt'.format(i)) for i in range(20)]
+        barrier = threading.Barrier(len(files))
+
+        def add(path):
+            with open(path, 'w') as file:
+                file.write('same content')
+            barrier.wait()
+            with self.store.transaction():
+                ServerFileUtils.add_reference(self.hash_db, ref_db, 'ABC', path)
+
+        threads = [threading.Thread(target=add, args=(path,)) for path in files]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(files), set(ref_db['ABC']))
+
+    # The write lock is not held while the rest of a pack is still being read, so other writers are not blocked
+    def test_pack_not_locked_while_reading(self):
+        test_dir = os.path.join(self.tmp_dir, 'test')
+        body = b''
+        for name in ('a.txt', 'b.txt'):
+            binary = name.encode('utf-8')
+            meta = FileMetadata(path=name, modified=12345.0, md5=hashlib.md5(binary).hexdigest(), size=len(binary),
+                                sync=False)
+            body += bytes(meta.pack(binary=True)) + binary
+        other = ServerStore(self.db_path, timeout=0.1)
+        store = self
+
+        class SlowPack(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() == len(body) // 2:
+                    # Another request writes while the second file is still to arrive
+                    other.table('metadata')['/other.txt'] = {'type': 'file'}
+                    store.assertNotIn(os.path.join(test_dir, 'a.txt'), store.meta_db)
+                return super().read(size)
+
+        with self.store.transaction():
+            results = ServerFileUtils.unpack_files(self.hash_db, self.meta_db, test_dir, SlowPack(body),
+                                                   ref_db=self.store.table('refs'))
+        other.close()
+        self.assertEqual([200, 200], [status for path, status, message in results])
+        self.assertIn(os.path.join(test_dir, 'b.txt'), self.meta_db)
+        self.assertIn('/other.txt', self.meta_db)
+
+    # Tables written by SqliteDict can be read, so existing server databases keep working
+    def test_sqlitedict_compatible(self):
+        legacy_path = os.path.join(self.tmp_dir, 'legacy.db')
+        legacy = SqliteDict(legacy_path, tablename='refs', encode=json.dumps, decode=json.loads)
+        legacy['ABC'] = {'/a.txt': [1, 2, 3]}
+        legacy.commit()
+        legacy.close()
+        store = ServerStore(legacy_path)
+        self.assertEqual({'/a.txt': [1, 2, 3]}, store.table('refs')['ABC'])
+        store.close()
+
+    # A whole request is committed in one transaction
+    def test_request_transaction(self):
+        test_dir = os.path.join(self.tmp_dir, 'test')
+        os.mkdir(test_dir)
+        server = Server.initialise(test_dir, store=self.store).test_client()
+        data = FileEncoding(bin=b'test', path='a.txt', modified=12345.0, md5='098f6bcd4621d373cade4e832627b4f6',
+                            size=4)
+        res = server.post('sync/a.txt', json=repr(data))
+        self.assertEqual(200, res.status_code)
+        self.assertIn(os.path.join(test_dir, 'a.txt'), self.meta_db)
+        self.assertEqual(os.path.join(test_dir, 'a.txt'), self.hash_db['098f6bcd4621d373cade4e832627b4f6'])
+        self.assertFalse(self.store.in_transaction())
+
+
+if __name__ == '__main__':
+    unittest.main()
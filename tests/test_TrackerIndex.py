@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+from sqlitedict import SqliteDict
+from utils.TrackerIndex import TrackerIndex, TrackedFile
+from utils.Metadata import FileMetadata
+
+
+class TestTrackerIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'temp.db')
+        self.file_db = SqliteDict(self.db_path, tablename='files', encode=json.dumps, decode=json.loads)
+
+    def tearDown(self):
+        self.file_db.close(force=True)
+        shutil.rmtree(self.tmp_dir)
+
+    def new_index(self, **kwargs):
+        return TrackerIndex(self.file_db, decode=TrackedFile.from_value, encode=TrackedFile.to_value, **kwargs)
+
+    # Entries stored by older versions as JSON strings are loaded into TrackedFile records
+    def test_load_legacy_values(self):
+        self.file_db['/a.txt'] = repr(FileMetadata('a.txt', 12345.0, 'ABC123AA00', 128, True))
+        self.file_db.commit()
+        index = self.new_index()
+        self.assertIn('/a.txt', index)
+        self.assertEqual(12345.0, index['/a.txt'].modified)
+        self.assertEqual('ABC123AA00', index['/a.txt'].md5)
+        self.assertEqual({'/a.txt'}, index.keys())
+
+    # Writes are visible straight away, but only reach the database when written back
+    def test_batched_write_back(self):
+        index = self.new_index(batch_size=2, interval=3600)
+        index['/a.txt'] = TrackedFile(1.0, 1, 'A', True)
+        index.commit()
+        self.assertIn('/a.txt', index)
+        with self.assertRaises(KeyError):
+            self.file_db['/a.txt']
+
+        index['/b.txt'] = TrackedFile(2.0, 2, 'B', True)
+        index.commit()
+        self.assertEqual({'modified': 1.0, 'size': 1, 'md5': 'A', 'sync': True}, self.file_db['/a.txt'])
+        self.assertEqual('B', self.file_db['/b.txt']['md5'])
+
+    def test_pop_flush(self):
+        self.file_db['/a.txt'] = {'modified': 1.0, 'size': 1, 'md5': 'A', 'sync': True}
+        self.file_db.commit()
+        index = self.new_index()
+        index.pop('/a.txt')
+        self.assertNotIn('/a.txt', index)
+        index.flush()
+        self.assertNotIn('/a.txt', self.file_db)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import threading
+import time
+from utils.TransferPool import TransferPool
+
+
+class TestTransferPool(unittest.TestCase):
+
+    # Tasks for the same key run in submission order, one at a time
+    def test_same_key_ordered(self):
+        pool = TransferPool(workers=4)
+        results = []
+
+        def task(i):
+            time.sleep(0.001 * (5 - i))
+            results.append(i)
+
+        for i in range(5):
+            pool.submit('same/path', task, i)
+        pool.join()
+        self.assertEqual([0, 1, 2, 3, 4], results)
+
+    # Tasks for different keys run concurrently
+    def test_different_keys_concurrent(self):
+        pool = TransferPool(workers=3)
+        barrier = threading.Barrier(3, timeout=5)
+        for i in range(3):
+            pool.submit('path/{}'.format(i), barrier.wait)
+        pool.join()
+        self.assertFalse(barrier.broken)
+
+    # A task with several keys runs after the tasks queued before it on any of them, and before those after it
+    def test_multiple_keys_ordered(self):
+        pool = TransferPool(workers=4)
+        results = []
+        release = threading.Event()
+        pool.submit('a', lambda: (release.wait(5), results.append('a')))
+        pool.submit(['a', 'b', 'c'], results.append, 'abc')
+        pool.submit('b', results.append, 'b')
+        pool.submit('d', results.append, 'd')
+        time.sleep(0.1)
+        self.assertEqual(['d'], results)
+        release.set()
+        pool.join()
+        self.assertEqual(['d', 'a', 'abc', 'b'], results)
+        self.assertEqual({}, pool.pending)
+
+    # submit() blocks once max_pending tasks are queued
+    def test_backpressure(self):
+        pool = TransferPool(workers=1, max_pending=2)
+        release = threading.Event()
+        pool.submit('a', release.wait)
+        pool.submit('b', release.wait)
+
+        submitted = threading.Event()
+        producer = threading.Thread(target=lambda: (pool.submit('c', lambda: None), submitted.set()))
+        producer.start()
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        pool.join()
+
+    # A failing task does not stop later tasks from running
+    def test_task_exception(self):
+        pool = TransferPool(workers=1)
+        results = []
+        pool.submit('a', lambda: 1 / 0)
+        pool.submit('a', results.append, 'ran')
+        pool.join()
+        self.assertEqual(['ran'], results)
+
+
+if __name__ == '__main__':
+    unittest.main()
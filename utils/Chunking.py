@@ -0,0 +1,163 @@
+import hashlib
+from utils.Metadata import CHUNK_SIZE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Content-defined chunk size bounds. The client and server must use identical values to find the same boundaries
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+# Files smaller than this are always uploaded whole, as a delta would not save a meaningful amount of bandwidth
+DELTA_MIN_SIZE = 4 * 1024 * 1024
+
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+# Gear table of 256 pseudo-random 64-bit values. Derived from MD5 so it is identical on every platform/Python version
+_GEAR = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], 'big') for i in range(256)]
+# Bytes covered by the gear hash: each byte is shifted out of the 64-bit hash 64 bytes after it is added
+WINDOW = 64
+# With numpy, the gear hash of every position in this many bytes of a stream is computed at once, in blocks of
+# SCAN_BLOCK positions so each pass over a block stays in the CPU cache
+SCAN_SIZE = 8 * 1024 * 1024
+SCAN_BLOCK = 64 * 1024
+_GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+
+class ContentChunker:
+    """
+    FastCDC-style content-defined chunker. Boundaries are chosen by a gear rolling hash over the content itself,
+    so inserting or removing bytes in a file only changes the chunks around the edit.
+    """
+
+    def __init__(self, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        """
+        Initialise the chunker
+        :param min_size: Smallest chunk that will be emitted (except for the final chunk of a stream)
+        :param avg_size: Target average chunk size, must be a power of two
+        :param max_size: Largest chunk that will be emitted
+        """
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = avg_size.bit_length() - 1
+        # Normalised chunking: a stricter mask before the average size and a looser one after it,
+        # which narrows the chunk size distribution around avg_size
+        self.mask_small = ((1 << (bits + 2)) - 1) << (48 - bits)
+        self.mask_large = ((1 << (bits - 2)) - 1) << (48 - bits)
+
+    def cut_point(self, buf, start, end, candidates=None):
+        """
+        Find the end of the chunk beginning at buf[start]
+        :param buf: Buffer holding at least max_size bytes after start, or the remainder of the stream
+        :param start: Index of the first byte of the chunk
+        :param end: Index one past the last byte available in buf
+        :param candidates: (optional) Positions in buf whose gear hash matches each mask, from find_candidates(). The
+                           hash is then only computed byte by byte until it covers a full window
+        :return: Index one past the last byte of the chunk
+        """
+        end = min(end, start + self.max_size)
+        if end - start <= self.min_size:
+            return end
+
+        gear, mask_small, mask_large = _GEAR, self.mask_small, self.mask_large
+        normal = min(start + self.avg_size, end)
+        h = 0
+        i = start + self.min_size
+        stop = end if candidates is None else min(end, i + WINDOW - 1)
+        while i < min(normal, stop):
+            h = ((h << 1) + gear[buf[i]]) & _MASK_64
+            if not h & mask_small:
+                return i + 1
+            i += 1
+        while i < stop:
+            h = ((h << 1) + gear[buf[i]]) & _MASK_64
+            if not h & mask_large:
+                return i + 1
+            i += 1
+        if i >= end:
+            return end
+
+        # The hash now covers a full window, so it equals the one computed for the whole buffer
+        small, large = candidates
+        found = small[numpy.searchsorted(small, i):][:1]
+        if len(found) and found[0] < normal:
+            return int(found[0]) + 1
+        found = large[numpy.searchsorted(large, max(i, normal)):][:1]
+        if len(found) and found[0] < end:
+            return int(found[0]) + 1
+        return end
+
+    def find_candidates(self, buf):
+        """
+        Compute the gear hash of the window ending at every position of a buffer at once, with numpy. The hash of a
+        window of 2n bytes is the hash of its last n bytes plus the hash of its first n shifted left by n, so a full
+        window takes log2(WINDOW) passes over the buffer rather than a Python loop iteration per byte
+        :param buf: Buffer of bytes
+        :return: (small, large) sorted arrays of the positions, at least a full window into buf, whose hash matches
+                 mask_small and mask_large
+        """
+        codes = numpy.frombuffer(buf, dtype=numpy.uint8)
+        mask_small, mask_large = numpy.uint64(self.mask_small), numpy.uint64(self.mask_large)
+        shifted = numpy.empty(SCAN_BLOCK + WINDOW, dtype=numpy.uint64)
+        small, large = [], []
+        for offset in range(0, len(codes), SCAN_BLOCK):
+            # Each block starts with the window before its first position
+            begin = max(offset - (WINDOW - 1), 0)
+            h = _GEAR_ARRAY.take(codes[begin:offset + SCAN_BLOCK])
+            width = 1
+            while width < WINDOW:
+                n = len(h) - width
+                numpy.left_shift(h[:n], numpy.uint64(width), out=shifted[:n])
+                numpy.add(h[width:], shifted[:n], out=h[width:])
+                width *= 2
+            first = max(offset, WINDOW - 1)
+            h = h[first - begin:]
+            small.append(numpy.flatnonzero((h & mask_small) == 0) + first)
+            large.append(numpy.flatnonzero((h & mask_large) == 0) + first)
+        if not small:
+            return numpy.empty(0, dtype=numpy.intp), numpy.empty(0, dtype=numpy.intp)
+        return numpy.concatenate(small), numpy.concatenate(large)
+
+    def split(self, stream):
+        """
+        Split a binary stream into content-defined chunks
+        :param stream: File-like object to read from
+        :return: Generator of chunk bytes
+        """
+        # With numpy, cut points are found for a large block of the stream at a time
+        buffered = self.max_size if numpy is None else max(self.max_size, SCAN_SIZE)
+        buf = b''
+        pos = 0
+        eof = False
+        candidates = None
+        while True:
+            # Keep at least max_size bytes buffered so a cut point can always be found
+            if not eof and len(buf) - pos < self.max_size:
+                parts = [buf[pos:]]
+                size = len(parts[0])
+                while not eof and size < buffered:
+                    data = stream.read(CHUNK_SIZE)
+                    if not data:
+                        eof = True
+                    parts.append(data)
+                    size += len(data)
+                buf = b''.join(parts)
+                pos = 0
+                if numpy is not None:
+                    candidates = self.find_candidates(buf)
+            if pos >= len(buf):
+                return
+            cut = self.cut_point(buf, pos, len(buf), candidates)
+            yield buf[pos:cut]
+            pos = cut
+
+    def chunk_list(self, stream):
+        """
+        Get the list of chunk digests and sizes making up a binary stream
+        :param stream: File-like object to read from
+        :return: List of [md5, size] for each chunk, in order
+        """
+        return [[hashlib.md5(chunk).hexdigest(), len(chunk)] for chunk in self.split(stream)]
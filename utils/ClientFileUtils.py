@@ -1,27 +1,80 @@
 import os
-import hashlib
-from utils.Metadata import FileEncoding, FolderEncoding, FileMetadata
+from utils.Metadata import FileEncoding, FolderEncoding, FileMetadata, CHUNK_SIZE
+from utils.Chunking import ContentChunker
+from utils.Hashing import ContentHash, DEFAULT_ALGORITHM
+
+
+class GeneratorStream:
+    """
+    File-like wrapper around a generator of bytes with a known total length.
+    Lets requests stream a generated body with a Content-Length header rather than chunked transfer encoding.
+    """
+
+    def __init__(self, generator, length):
+        """
+        :param generator: Generator yielding the body bytes
+        :param length: Total number of bytes the generator yields
+        """
+        self.generator = generator
+        self.length = length
+        self.buffer = b''
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.generator)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
 
 
 class FileUtils:
 
     @staticmethod
-    def get_file_metadata(path: str, rel_path: str) -> FileMetadata:
+    def get_file_metadata(path: str, rel_path: str, algorithm=DEFAULT_ALGORITHM, hash_cache=None) -> FileMetadata:
         """
         Get the FileMetadata for a given file path
         :param path: Absolute path of file
         :param rel_path: Relative path from sync dir
+        :param algorithm: (optional) Hash algorithm for the file's digest
+        :param hash_cache: (optional) HashCache to reuse the digest of an unchanged file from, instead of reading it
         :return: FileMetadata for the file
         """
-        md5_hash = hashlib.md5()
         with open(path, 'rb') as f:
-            md5_hash.update(f.read())
-            f.seek(0)
-            return FileMetadata(path=rel_path,
-                                modified=os.stat(path).st_mtime,
-                                md5=md5_hash.hexdigest(),
-                                size=os.stat(path).st_size,
-                                sync=False)
+            stat = os.fstat(f.fileno())
+            digest = hash_cache.get(stat, algorithm) if hash_cache is not None else None
+            if digest is None:
+                content_hash = ContentHash(algorithm)
+                # Hash the file in fixed-size blocks so memory use does not grow with the file size
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    content_hash.update(chunk)
+                digest = content_hash.digest()
+                if hash_cache is not None:
+                    hash_cache.put(stat, digest)
+        return FileMetadata(path=rel_path,
+                            modified=stat.st_mtime,
+                            md5=digest,
+                            size=stat.st_size,
+                            sync=False,
+                            modified_ns=stat.st_mtime_ns,
+                            inode=FileUtils.get_inode(stat))
+
+    @staticmethod
+    def get_inode(stat):
+        """
+        Get the identity of a file or folder, which stays the same when it is renamed or moved within the file system
+        :param stat: os.stat_result of the file/folder
+        :return: 'device:inode', or None if the file system does not give files a stable inode number
+        """
+        if not stat.st_ino:
+            return None
+        return '{}:{}'.format(stat.st_dev, stat.st_ino)
 
     @staticmethod
     def get_metadata(encoding: FileEncoding) -> FileMetadata:
@@ -38,22 +91,54 @@ class FileUtils:
             sync=False)
 
     @staticmethod
-    def get_file_encoding(path, rel_path) -> FileEncoding:
+    def get_file_encoding(path, rel_path, algorithm=DEFAULT_ALGORITHM) -> FileEncoding:
         """
         Get the FileEncoding for a given file path
         :param path: Absolute path of file
         :param rel_path: Relative path from sync dir
+        :param algorithm: (optional) Hash algorithm for the file's digest
         :return: FileEncoding for the file
         """
-        md5_hash = hashlib.md5()
         with open(path, 'rb') as f:
-            md5_hash.update(f.read())
-            f.seek(0)
-            return FileEncoding(bin=f.read(),
-                                path=rel_path,
-                                modified=os.stat(path).st_mtime,
-                                md5=md5_hash.hexdigest(),
-                                size=os.stat(path).st_size)
+            # Stat the open file once, and hash the same bytes that are sent
+            stat = os.fstat(f.fileno())
+            binary = f.read()
+        content_hash = ContentHash(algorithm)
+        content_hash.update(binary)
+        return FileEncoding(bin=binary,
+                            path=rel_path,
+                            modified=stat.st_mtime,
+                            md5=content_hash.digest(),
+                            size=len(binary))
+
+    @staticmethod
+    def get_file_chunks(path) -> list:
+        """
+        Split a file into content-defined chunks for delta synchronisation
+        :param path: Absolute path of file
+        :return: List of [md5, size] for each chunk, in file order
+        """
+        with open(path, 'rb') as f:
+            return ContentChunker().chunk_list(f)
+
+    @staticmethod
+    def read_chunks(path, chunks, wanted):
+        """
+        Read the binary of selected chunks of a file, sending each distinct chunk only once
+        :param path: Absolute path of file
+        :param chunks: List of [md5, size] for each chunk, as returned by get_file_chunks
+        :param wanted: Set of chunk md5s to read
+        :return: Generator of chunk bytes, in file order
+        """
+        sent = set()
+        offset = 0
+        with open(path, 'rb') as f:
+            for md5, size in chunks:
+                if md5 in wanted and md5 not in sent:
+                    sent.add(md5)
+                    f.seek(offset)
+                    yield f.read(size)
+                offset += size
 
     @staticmethod
     def get_folder_encoding(path, rel_path) -> FolderEncoding:
@@ -63,8 +148,10 @@ class FileUtils:
         :param rel_path: Relative path from sync dir
         :return: FolderEncoding for the path
         """
+        stat = os.stat(path)
         return FolderEncoding(
             path=rel_path,
-            modified=os.stat(path).st_mtime,
-            sync=False
+            modified=stat.st_mtime,
+            sync=False,
+            inode=FileUtils.get_inode(stat)
         )
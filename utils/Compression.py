@@ -0,0 +1,215 @@
+import os
+import gzip
+import zlib
+from utils.Metadata import CHUNK_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-Encodings supported by this installation, most preferred first
+ENCODINGS = (['zstd'] if zstandard is not None else []) + ['gzip']
+
+# Errors raised when reading corrupt compressed data
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Files smaller than this are sent as they are, as compression would save little
+MIN_COMPRESS_SIZE = 4 * 1024
+# Bytes from the start of a file that are test-compressed to estimate how well the file compresses
+SAMPLE_SIZE = 64 * 1024
+# Files are only compressed if the sample shrinks to at most this fraction of its size
+MAX_SAMPLE_RATIO = 0.9
+# Extensions of formats that are already compressed
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.aac', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz4',
+    '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.pdf', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.xlsx',
+    '.xz', '.zip', '.zst'
+}
+
+
+class Compression:
+    """
+    Utility functions for compressing file uploads with a Content-Encoding negotiated between client and server
+    """
+
+    @staticmethod
+    def available():
+        """
+        Get the Content-Encodings supported by this installation
+        :return: List of encodings, most preferred first
+        """
+        return list(ENCODINGS)
+
+    @staticmethod
+    def negotiate(supported, requested=None):
+        """
+        Choose the Content-Encoding to compress uploads to a remote with
+        :param supported: Encodings the remote supports
+        :param requested: (optional) Encoding to use if both sides support it. 'none' disables compression
+        :return: Encoding name, or None to send uploads uncompressed
+        """
+        if requested == 'none':
+            return None
+        common = [encoding for encoding in ENCODINGS if encoding in supported]
+        if requested in common:
+            return requested
+        return common[0] if common else None
+
+    @staticmethod
+    def should_compress(path, size):
+        """
+        Decide whether a file is worth compressing: not too small, not an already-compressed format, and a sample
+        from the start of the file compresses well
+        :param path: Path of the file
+        :param size: Size of the file
+        :return: True if the file should be compressed
+        """
+        if size < MIN_COMPRESS_SIZE or os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+            return False
+        with open(path, 'rb') as file:
+            sample = file.read(SAMPLE_SIZE)
+        return len(zlib.compress(sample, 1)) <= len(sample) * MAX_SAMPLE_RATIO
+
+    @staticmethod
+    def compressor(encoding):
+        """
+        Get an incremental compressor for a Content-Encoding
+        :param encoding: Content-Encoding to compress with
+        :return: Object with compress(data) and flush() methods
+        """
+        if encoding == 'zstd' and zstandard is not None:
+            return zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == 'gzip':
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        raise KeyError('Unsupported Content-Encoding: {}'.format(encoding))
+
+    @staticmethod
+    def compress(data, encoding):
+        """
+        Compress a request body held in memory
+        :param data: Bytes to compress
+        :param encoding: Content-Encoding to compress with
+        :return: Compressed bytes
+        """
+        compressor = Compression.compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def compress_file(path, encoding, offset=0):
+        """
+        Compress a file as it is read
+        :param path: Path of the file
+        :param encoding: Content-Encoding to compress with
+        :param offset: (optional) Byte offset to start reading the file from
+        :return: Generator of compressed bytes
+        """
+        compressor = Compression.compressor(encoding)
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+        yield compressor.flush()
+
+    @staticmethod
+    def decompress_stream(stream, encoding, limit):
+        """
+        Wrap a compressed stream to read it decompressed
+        :param stream: File-like object holding the compressed bytes
+        :param encoding: Content-Encoding of the stream
+        :param limit: Maximum number of decompressed bytes expected
+        :return: DecompressedStream
+        """
+        if encoding == 'zstd' and zstandard is not None:
+            reader = zstandard.ZstdDecompressor().stream_reader(stream)
+        elif encoding == 'gzip':
+            reader = gzip.GzipFile(fileobj=stream, mode='rb')
+        else:
+            raise KeyError('Unsupported Content-Encoding: {}'.format(encoding))
+        return DecompressedStream(reader, limit)
+
+    @staticmethod
+    def decompressor(encoding, limit):
+        """
+        Get a decompressor that is fed a compressed upload piece by piece, as its bytes arrive
+        :param encoding: Content-Encoding of the upload
+        :param limit: Maximum number of decompressed bytes expected
+        :return: Decompressor
+        """
+        if encoding == 'zstd' and zstandard is not None:
+            return Decompressor(zstandard.ZstdDecompressor().decompressobj(), limit)
+        elif encoding == 'gzip':
+            return Decompressor(zlib.decompressobj(16 + zlib.MAX_WBITS), limit)
+        raise KeyError('Unsupported Content-Encoding: {}'.format(encoding))
+
+
+class DecompressedStream:
+    """
+    File-like reader of a decompressed stream, which refuses to produce more than the expected number of bytes so a
+    small upload cannot expand to fill the server's disk
+    """
+
+    def __init__(self, reader, limit):
+        """
+        :param reader: File-like object reading the decompressed bytes
+        :param limit: Maximum number of bytes to read
+        """
+        self.reader = reader
+        self.limit = limit
+        self.total = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.limit + 1 - self.total
+        try:
+            data = self.reader.read(max(0, min(size, self.limit + 1 - self.total)))
+        except DECOMPRESS_ERRORS as e:
+            raise IOError('Compressed upload is corrupt: {}'.format(e))
+        self.total += len(data)
+        if self.total > self.limit:
+            raise IOError('Decompressed upload is larger than expected')
+        return data
+
+
+class Decompressor:
+    """
+    Incremental decompressor, which like DecompressedStream refuses to produce more than the expected number of bytes
+    """
+
+    def __init__(self, decompressobj, limit):
+        """
+        :param decompressobj: zlib or zstandard decompression object
+        :param limit: Maximum number of bytes to produce
+        """
+        self.decompressobj = decompressobj
+        self.limit = limit
+        self.total = 0
+
+    def decompress(self, data):
+        """
+        Decompress the next piece of the upload
+        :param data: Compressed bytes
+        :return: Decompressed bytes
+        """
+        try:
+            if hasattr(self.decompressobj, 'unconsumed_tail'):
+                # zlib can stop early, so a highly compressed piece is never expanded far past the limit
+                output = self.decompressobj.decompress(data, self.limit + 1 - self.total)
+            else:
+                output = self.decompressobj.decompress(data)
+        except DECOMPRESS_ERRORS as e:
+            raise IOError('Compressed upload is corrupt: {}'.format(e))
+        self.total += len(output)
+        if self.total > self.limit:
+            raise IOError('Decompressed upload is larger than expected')
+        return output
+
+    def finish(self):
+        """
+        Check the whole upload was received
+        :return: None
+        """
+        if not self.decompressobj.eof:
+            raise IOError('Compressed upload is truncated')
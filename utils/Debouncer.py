@@ -0,0 +1,150 @@
+from threading import Thread, Condition
+from utils.DirectoryListener import ChangeType
+from utils.Outbox import Outbox
+import os
+import time
+import logging
+
+# Milliseconds a file's size and modified time must be unchanged before its creation/modification is synced
+SETTLE_TIME = 2000
+
+
+class Debouncer:
+    """
+    Holds back file creations and modifications until the file has stopped changing, so a file that is being written
+    continuously is synced once it settles rather than on every scan. Further changes to a held file are merged into
+    its held change (a creation followed by edits is synced as one creation), and a file created and deleted again
+    before it settles is never synced. Deletions, moves and folder changes are passed on straight away.
+    """
+
+    def __init__(self, change_callback, settle_time=SETTLE_TIME, settled_callback=None):
+        """
+        Initialise the Debouncer and start its release thread
+        :param change_callback: Callback taking (ChangeType, path), called for each change once it has settled. Moves
+                                are passed on with the path moved from as a third argument
+        :param settle_time: Milliseconds a file's size and modified time must be unchanged. 0 passes every change on
+                            straight away
+        :param settled_callback: (optional) Callback after the held changes that settled together have been passed on
+        """
+        self.change_callback = change_callback
+        self.settle_time = settle_time / 1000
+        self.settled_callback = settled_callback
+        self.condition = Condition()
+        # Path -> (ChangeType, (size, modified ns), time the change can be passed on)
+        self.held = {}
+        if self.settle_time > 0:
+            Thread(name='debouncer', target=self.release, daemon=True).start()
+
+    def __len__(self):
+        return len(self.held)
+
+    def on_change(self, change: ChangeType, path, source=None):
+        """
+        Handle a change in the synced folder. Callback for the DirectoryListener.
+        :param change: Value of ChangeType defining what was changed
+        :param path: Absolute path of changed file/folder
+        :param source: (optional) Absolute path the file/folder moved from, for moves
+        :return: None
+        """
+        if source is not None:
+            self.move(path, source)
+            self.change_callback(change, path, source)
+            return
+        if self.settle_time <= 0:
+            self.change_callback(change, path)
+            return
+        with self.condition:
+            held = self.held.pop(path, None)
+            if held is not None:
+                change = Outbox.merge(held[0], change)
+                if change is None:
+                    logging.info('Change cancelled before it settled:{}'.format(path))
+                    return
+            if change in (ChangeType.CreatedFile, ChangeType.ModifiedFile) and self.hold(change, path, held):
+                return
+            self.change_callback(change, path)
+
+    def move(self, path, source):
+        """
+        Carry the held changes of a moved file/folder, and everything inside it, over to its new path
+        :param path: Absolute path moved to
+        :param source: Absolute path moved from
+        :return: None
+        """
+        prefix = os.path.join(source, '')
+        with self.condition:
+            for held_path in [held_path for held_path in self.held
+                              if held_path == source or held_path.startswith(prefix)]:
+                self.held[path + held_path[len(source):]] = self.held.pop(held_path)
+
+    def hold(self, change, path, held):
+        """
+        Hold a file creation/modification back if the file has changed within the settle time
+        :param change: ChangeType.CreatedFile or ChangeType.ModifiedFile
+        :param path: Absolute path of the file
+        :param held: The file's previously held change, or None
+        :return: True if the change is held (or dropped as the file no longer exists), False if it can be passed on
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # The listener reports the deletion if the file was tracked
+            return True
+        state = (stat.st_size, stat.st_mtime_ns)
+        now = time.time()
+        if held is None:
+            due = min(stat.st_mtime_ns / 10 ** 9, now) + self.settle_time
+        elif held[1] == state:
+            due = held[2]
+        else:
+            # Changed since it was last checked, which may not show in a coarse modified time
+            due = now + self.settle_time
+        if due <= now:
+            return False
+        self.held[path] = (change, state, due)
+        self.condition.notify_all()
+        return True
+
+    def release(self):
+        """
+        Pass on held changes as their files settle. Runs on its own thread
+        :return: None
+        """
+        while True:
+            with self.condition:
+                settled = self.wait_settled()
+                for change, path in settled:
+                    try:
+                        self.change_callback(change, path)
+                    except Exception:
+                        logging.exception('Failed to handle settled change:{}'.format(path))
+            if self.settled_callback is not None:
+                try:
+                    self.settled_callback()
+                except Exception:
+                    logging.exception('Failed to handle settled changes')
+
+    def wait_settled(self):
+        """
+        Block until at least one held file has settled. Must be called with the condition held
+        :return: List of (ChangeType, path) that have settled, no longer held
+        """
+        while True:
+            now = time.time()
+            settled = []
+            for path, (change, state, due) in list(self.held.items()):
+                if due > now:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self.held[path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != state:
+                    self.held[path] = (change, (stat.st_size, stat.st_mtime_ns), now + self.settle_time)
+                    continue
+                del self.held[path]
+                settled.append((change, path))
+            if settled:
+                return settled
+            self.condition.wait(min(due for change, state, due in self.held.values()) - now if self.held else None)
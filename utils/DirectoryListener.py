@@ -1,55 +1,348 @@
 import os
 import time
 import json
+import logging
+from threading import Lock
+from utils.InotifyWatcher import InotifyWatcher
+from utils.TrackerIndex import TrackedFile
+from utils.ClientFileUtils import FileUtils
 
 
 class DirectoryListener:
 
-    def __init__(self, dir, change_callback, file_db, folder_db):
+    def __init__(self, dir, change_callback, file_db, folder_db, scan_callback=None, full_scan_interval=12):
         """
         Initialise the DirectoryListener, which is used to detect changes in the client sync folder
         :param dir: Directory to scan for changes
-        :param change_callback: Callback function when change is detected
-        :param file_db: SqliteDict database to store tracked file metadata
-        :param folder_db: SqliteDict database to store tracked folder metadata
+        :param change_callback: Callback function when change is detected. Moves are reported with the path moved
+                                from as a third argument
+        :param file_db: TrackerIndex (or SqliteDict) of tracked file metadata
+        :param folder_db: TrackerIndex (or SqliteDict) of tracked folder metadata
+        :param scan_callback: (optional) Callback function after the changes of each scan have been reported
+        :param full_scan_interval: When polling, re-stat every file once per this many scans. Other scans only
+                                   re-list folders whose modified time changed, which misses in-place file edits
         """
         self.dir = dir
         self.change_callback = change_callback
+        self.scan_callback = scan_callback
+        self.full_scan_interval = full_scan_interval
+        # Folder path -> (modified ns, subfolder paths, {file path: modified ns}) from the last time it was listed
+        self.dir_cache = {}
         self.file_db = file_db
         self.folder_db = folder_db
+        # Paths to check again the next time the listener wakes, added from other threads by recheck()
+        self.rechecks = set()
+        self.recheck_lock = Lock()
         try:
             folder_db[dir]
         except KeyError:
             folder_db[dir] = 'sync_dir'
             folder_db.commit()
 
+    def listen(self):
+        """
+        Listen for changes continuously, using inotify events where available and periodic scans otherwise
+        :return: None
+        """
+        if InotifyWatcher.is_supported():
+            try:
+                self.watch_directory()
+                return
+            except OSError as e:
+                # e.g. the inotify watch limit was reached
+                logging.warning('Could not watch directory with inotify, falling back to polling:{}'.format(e))
+        self.scan_directory()
+
     def scan_directory(self, n_iter=-1):
         """
         Scan the directory for new files/folders, deleted files/folders, or file edits
         :param n_iter: How many times to scan. Leave at default (-1) for continuous operation
         :return:
         """
+        scans = 0
         while n_iter != 0:
-            file_meta_new = {}
-            folder_meta_new = set()
+            self.scan_once(full=scans % self.full_scan_interval == 0)
+            scans += 1
+            time.sleep(5)
+            n_iter -= 1
 
-            # Walk the entire folder structure within the directory
-            for dir, subdirs, files in os.walk(self.dir):
-                # Create a set of all folders
-                folder_meta_new.add(dir)
+    def scan_once(self, full=True):
+        """
+        Scan the directory once, and report every change since the tracked state
+        :param full: Re-list every folder and re-stat every file. Otherwise only folders whose modified time changed
+                     since they were last listed are re-listed, and the rest reuse their cached listing
+        :return: None
+        """
+        # Paths waiting to be checked again are covered by the scan
+        self.take_rechecks()
+        file_meta_new = {}
+        folder_meta_new = set()
 
-                for fname in files:
-                    fpath = os.path.join(dir, fname)
-                    # Create a dict of the last modified time for each file
-                    file_meta_new[fpath] = os.stat(fpath).st_mtime
+        # Walk the entire folder structure within the directory
+        stack = [self.dir]
+        while stack:
+            dir = stack.pop()
+            listing = self.list_folder(dir, full)
+            if listing is None:
+                continue
+            modified, subdirs, files = listing
+            # Create a set of all folders, and a dict of the last modified time for each file
+            folder_meta_new.add(dir)
+            file_meta_new.update(files)
+            stack.extend(subdirs)
 
-            # Scan for folder changes
-            self.find_diff_folders(folder_meta_new)
-            # Scan for file changes (excluding first scan on start)
-            self.find_diff_files(file_meta_new)
+        # Forget cached listings of folders that no longer exist
+        for dir in self.dir_cache.keys() - folder_meta_new:
+            del self.dir_cache[dir]
 
-            time.sleep(5)
-            n_iter -= 1
+        # Scan for moves first, so moved items are not also reported as deleted and created
+        folders_before = set(self.folder_db.keys())
+        files_before = set(self.file_db.keys())
+        self.find_moves(folders_before - folder_meta_new, folder_meta_new - folders_before,
+                        files_before - file_meta_new.keys(), file_meta_new.keys() - files_before)
+        # Scan for folder changes
+        self.find_diff_folders(folder_meta_new)
+        # Scan for file changes (excluding first scan on start)
+        self.find_diff_files(file_meta_new)
+        if self.scan_callback is not None:
+            self.scan_callback()
+
+    def list_folder(self, dir, full):
+        """
+        List the subfolders and files of a folder using os.scandir, reusing the cached listing if the folder's
+        modified time has not changed (files or folders are added, removed or renamed)
+        :param dir: Folder path
+        :param full: Ignore the cached listing
+        :return: (modified ns, subfolder paths, {file path: modified ns}), or None if the folder no longer exists
+        """
+        try:
+            modified = os.stat(dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        cached = self.dir_cache.get(dir)
+        if not full and cached is not None and cached[0] == modified:
+            return cached
+
+        subdirs = []
+        files = {}
+        try:
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file():
+                            files[entry.path] = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        # Removed while listing
+                        pass
+        except FileNotFoundError:
+            return None
+
+        listing = (modified, subdirs, files)
+        # A folder changed within the last couple of seconds could change again without its modified time visibly
+        # changing (coarse timestamp granularity), so it is only cached once it has settled
+        if time.time_ns() - modified > 2 * 10 ** 9:
+            self.dir_cache[dir] = listing
+        else:
+            self.dir_cache.pop(dir, None)
+        return listing
+
+    def watch_directory(self, n_iter=-1, timeout=5):
+        """
+        Watch the directory for changes with inotify. Only paths named in kernel events are checked, and the whole
+        directory is only re-scanned at start-up and if the kernel event queue overflows.
+        :param n_iter: How many times to wait for events. Leave at default (-1) for continuous operation
+        :param timeout: Seconds to wait for events each time
+        :return: None
+        """
+        watcher = InotifyWatcher(self.dir)
+        try:
+            # Catch up with changes made while the client was not running
+            self.scan_once()
+            while n_iter != 0:
+                paths, overflow = watcher.read_changes(timeout)
+                paths |= self.take_rechecks()
+                if overflow:
+                    logging.warning('inotify event queue overflowed, re-scanning directory')
+                    self.scan_once()
+                elif paths:
+                    self.check_paths(paths)
+                n_iter -= 1
+        finally:
+            watcher.close()
+
+    def recheck(self, path):
+        """
+        Have a path checked for changes again, as if an event had been received for it. Safe to call from other
+        threads: the path is checked by the listener's own thread within one event timeout, or by its next scan
+        :param path: Absolute file/folder path
+        :return: None
+        """
+        with self.recheck_lock:
+            self.rechecks.add(path)
+
+    def take_rechecks(self):
+        """
+        Take the paths waiting to be checked again
+        :return: Set of absolute file/folder paths
+        """
+        with self.recheck_lock:
+            paths, self.rechecks = self.rechecks, set()
+        return paths
+
+    def check_paths(self, paths):
+        """
+        Check specific paths for changes and report them, without scanning the rest of the directory.
+        Folders that have appeared are walked so that their contents are reported too.
+        :param paths: Iterable of absolute file/folder paths that may have changed
+        :return: None
+        """
+        folders_after = set()
+        folders_gone = set()
+        files_after = {}
+        files_gone = set()
+        removed = set()
+
+        for path in paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                for dir, subdirs, files in os.walk(path):
+                    folders_after.add(dir)
+                    for fname in files:
+                        fpath = os.path.join(dir, fname)
+                        try:
+                            files_after[fpath] = os.stat(fpath).st_mtime_ns
+                        except FileNotFoundError:
+                            files_gone.add(fpath)
+            else:
+                try:
+                    files_after[path] = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    # Removed file, or removed folder along with everything tracked inside it
+                    files_gone.add(path)
+                    folders_gone.add(path)
+                    if path not in self.file_db:
+                        removed.add(path)
+        if removed:
+            # Everything tracked inside the removed folders is found in one pass over the tracked paths
+            files_gone.update(DirectoryListener.tracked_inside(self.file_db, removed))
+            folders_gone.update(DirectoryListener.tracked_inside(self.folder_db, removed))
+
+        self.find_moves({folder for folder in folders_gone if folder in self.folder_db},
+                        {folder for folder in folders_after if folder not in self.folder_db},
+                        {file for file in files_gone if file in self.file_db},
+                        {file for file in files_after if file not in self.file_db})
+        for folder in folders_gone:
+            if folder in self.folder_db:
+                self.change_callback(ChangeType.DeletedFolder, folder)
+        for folder in folders_after:
+            if folder not in self.folder_db:
+                self.change_callback(ChangeType.CreatedFolder, folder)
+
+        for file in files_gone:
+            if file in self.file_db:
+                self.change_callback(ChangeType.DeletedFile, file)
+        for file, modified in files_after.items():
+            try:
+                if TrackedFile.from_value(self.file_db[file]).is_modified(modified):
+                    self.change_callback(ChangeType.ModifiedFile, file)
+            except KeyError:
+                self.change_callback(ChangeType.CreatedFile, file)
+
+        if self.scan_callback is not None:
+            self.scan_callback()
+
+    @staticmethod
+    def tracked_inside(db, folders):
+        """
+        Find the tracked paths inside any of a set of folders, looking each tracked path's parent folders up in the set
+        :param db: file_db or folder_db
+        :param folders: Set of absolute folder paths
+        :return: Set of the tracked paths inside them
+        """
+        inside = set()
+        for path in db.keys():
+            child, parent = path, os.path.dirname(path)
+            while parent != child:
+                if parent in folders:
+                    inside.add(path)
+                    break
+                child, parent = parent, os.path.dirname(parent)
+        return inside
+
+    def find_moves(self, folders_gone, folders_new, files_gone, files_new):
+        """
+        Match tracked folders/files that have gone with untracked ones that have appeared by their inode (and size, for
+        files), and report each match as a move. A moved folder carries everything inside it along.
+        The change callback must apply a move to file_db/folder_db before it returns, or leave them unchanged to have
+        the items reported as deleted and created instead.
+        :param folders_gone: Tracked folders that no longer exist
+        :param folders_new: Untracked folders that exist
+        :param files_gone: Tracked files that no longer exist
+        :param files_new: Untracked files that exist
+        :return: None
+        """
+        if folders_gone and folders_new:
+            gone = {}
+            for folder in folders_gone:
+                inode = DirectoryListener.folder_inode(self.folder_db.get(folder))
+                if inode is not None:
+                    gone[inode] = folder
+            moved = []
+            # Parents sort before the folders inside them
+            for folder in sorted(folders_new):
+                if any(folder.startswith(os.path.join(target, '')) for target in moved):
+                    continue
+                source = gone.pop(DirectoryListener.get_inode(folder), None)
+                if source is not None:
+                    self.change_callback(ChangeType.MovedFolder, folder, source)
+                    moved.append(folder)
+
+        if files_gone and files_new:
+            gone = {}
+            for file in files_gone:
+                value = self.file_db.get(file)
+                if value is None:
+                    # Moved along with its folder
+                    continue
+                tracked = TrackedFile.from_value(value)
+                if tracked.inode is not None:
+                    gone[tracked.inode] = (file, tracked.size)
+            for file in files_new:
+                if file in self.file_db:
+                    continue
+                try:
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    continue
+                inode = FileUtils.get_inode(stat)
+                if inode in gone and gone[inode][1] == stat.st_size:
+                    self.change_callback(ChangeType.MovedFile, file, gone.pop(inode)[0])
+
+    @staticmethod
+    def get_inode(path):
+        """
+        :param path: Absolute path of a file/folder
+        :return: 'device:inode' of the file/folder, or None if it does not exist
+        """
+        try:
+            return FileUtils.get_inode(os.stat(path))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def folder_inode(value):
+        """
+        Get the inode recorded for a tracked folder
+        :param value: Tracked folder value, as stored by FolderEncoding.to_value() (or a JSON string by older versions)
+        :return: 'device:inode', or None if it was not recorded
+        """
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return None
+        return value.get('inode') if isinstance(value, dict) else None
 
     def find_diff_folders(self, folders_after: set):
         """
@@ -72,7 +365,7 @@ class DirectoryListener:
         """
         Check for the creation, deletion, or modification of files.
         Upon detection of a new/edited/deleted file the change callback is called
-        :param files_after: Dictionary of {path: modified} after last directory scan
+        :param files_after: Dictionary of {path: modified ns} after last directory scan
         :return: None
         """
         # Check for file creation and removal
@@ -87,7 +380,7 @@ class DirectoryListener:
         # Check for file modifications
         for file, modified in files_after.items():
             try:
-                if modified != json.loads(self.file_db[file])['modified']:
+                if TrackedFile.from_value(self.file_db[file]).is_modified(modified):
                     self.change_callback(ChangeType.ModifiedFile, file)
             except KeyError:
                 # If it's a new file it'll result in a KeyError as the existing file_meta won't have tracked it yet
@@ -98,4 +391,4 @@ class ChangeType(set):
     """
     Enum-like object to represent file system change type
     """
-    CreatedFile, DeletedFile, ModifiedFile, CreatedFolder, DeletedFolder = range(0, 5)
+    CreatedFile, DeletedFile, ModifiedFile, CreatedFolder, DeletedFolder, MovedFile, MovedFolder = range(0, 7)
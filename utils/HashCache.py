@@ -0,0 +1,65 @@
+import time
+from utils.Hashing import ContentHash
+from utils.ClientFileUtils import FileUtils
+
+
+class HashCache:
+    """
+    Persistent cache of file digests, keyed by device and inode. A digest is reused while the file's size and
+    nanosecond modified time are unchanged, so unchanged files are never re-read to hash them.
+    """
+
+    def __init__(self, db):
+        """
+        :param db: TrackerIndex storing 'device:inode' -> [size, modified ns, digest]
+        """
+        self.db = db
+
+    def get(self, stat, algorithm):
+        """
+        Get the cached digest of a file
+        :param stat: os.stat_result of the file
+        :param algorithm: Hash algorithm the digest must use
+        :return: Digest, or None if not cached or the file may have changed since
+        """
+        key = FileUtils.get_inode(stat)
+        entry = self.db.get(key) if key is not None else None
+        if entry is None:
+            return None
+        size, modified_ns, digest = entry
+        if size != stat.st_size or modified_ns != stat.st_mtime_ns or ContentHash.algorithm_of(digest) != algorithm:
+            return None
+        return digest
+
+    def put(self, stat, digest):
+        """
+        Cache the digest of a file
+        :param stat: os.stat_result of the file, taken before it was hashed
+        :param digest: Digest of the file
+        :return: None
+        """
+        key = FileUtils.get_inode(stat)
+        # A file modified within the last couple of seconds could change again without its modified time visibly
+        # changing (coarse timestamp granularity), so its digest is only cached once it has settled
+        if key is None or time.time_ns() - stat.st_mtime_ns <= 2 * 10 ** 9:
+            return
+        self.db[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        self.db.commit()
+
+    def forget(self, inode):
+        """
+        Drop the cached digest of a file that has been deleted, so the cache does not keep an entry for every file
+        ever hashed
+        :param inode: 'device:inode' of the file (see FileUtils.get_inode), or None if it is not known
+        :return: None
+        """
+        if inode is not None:
+            self.db.pop(inode, None)
+            self.db.commit()
+
+    def flush(self):
+        """
+        Write the cache back to disk
+        :return: None
+        """
+        self.db.flush()
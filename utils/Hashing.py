@@ -0,0 +1,96 @@
+import hashlib
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Algorithm used when none is negotiated. Its digests are plain hex so they match those of older clients and servers
+DEFAULT_ALGORITHM = 'md5'
+
+# Algorithm name -> constructor of a hash object with update() and hexdigest()
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    # Faster than MD5 on 64-bit CPUs, and always available
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),
+}
+if blake3 is not None:
+    ALGORITHMS['blake3'] = blake3.blake3
+if xxhash is not None:
+    ALGORITHMS['xxh128'] = xxhash.xxh3_128
+
+# Algorithms to prefer when negotiating, fastest first
+PREFERENCE = ['blake3', 'xxh128', 'blake2b', 'md5']
+
+
+class ContentHash:
+    """
+    Hash of a file's content using a pluggable algorithm.
+    Digests name their algorithm as '<algorithm>:<hex>', except MD5 digests which stay plain hex for compatibility,
+    so every stored or transmitted digest records which algorithm produced it.
+    """
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM):
+        """
+        :param algorithm: Name of the hash algorithm
+        """
+        if algorithm not in ALGORITHMS:
+            raise KeyError('Unsupported hash algorithm: {}'.format(algorithm))
+        self.algorithm = algorithm
+        self.hash = ALGORITHMS[algorithm]()
+
+    @staticmethod
+    def algorithm_of(digest):
+        """
+        Get the name of the algorithm that produced a digest
+        :param digest: Digest as returned by ContentHash.digest
+        :return: Algorithm name
+        """
+        algorithm, separator, _ = digest.rpartition(':')
+        return algorithm if separator else DEFAULT_ALGORITHM
+
+    @staticmethod
+    def for_digest(digest):
+        """
+        Create a ContentHash using the same algorithm as an existing digest, to verify content against it
+        :param digest: Digest as returned by ContentHash.digest
+        :return: ContentHash
+        """
+        return ContentHash(ContentHash.algorithm_of(digest))
+
+    @staticmethod
+    def available():
+        """
+        Get the hash algorithms supported by this installation
+        :return: List of algorithm names, fastest first
+        """
+        return [algorithm for algorithm in PREFERENCE if algorithm in ALGORITHMS]
+
+    @staticmethod
+    def negotiate(supported, requested=None):
+        """
+        Choose the algorithm to use with a remote
+        :param supported: Algorithm names the remote supports
+        :param requested: (optional) Algorithm to use if both sides support it
+        :return: The requested algorithm if possible, else the fastest supported by both sides, else MD5
+        """
+        common = [algorithm for algorithm in ContentHash.available() if algorithm in supported]
+        if requested in common:
+            return requested
+        return common[0] if common else DEFAULT_ALGORITHM
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def digest(self):
+        """
+        :return: Digest of the content hashed so far, naming its algorithm
+        """
+        if self.algorithm == DEFAULT_ALGORITHM:
+            return self.hash.hexdigest()
+        return '{}:{}'.format(self.algorithm, self.hash.hexdigest())
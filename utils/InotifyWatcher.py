@@ -0,0 +1,170 @@
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def _load_libc():
+    """
+    Load the C library functions used for inotify
+    :return: ctypes CDLL, or None if inotify is unavailable on this platform
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+class InotifyWatcher:
+    """
+    Watches a directory tree for changes using Linux inotify, so changes are found without re-scanning the tree
+    """
+
+    @staticmethod
+    def is_supported():
+        """
+        Check whether inotify is available on this platform
+        :return: True if an InotifyWatcher can be created
+        """
+        return _libc is not None
+
+    def __init__(self, root):
+        """
+        Initialise the InotifyWatcher, adding a watch to every folder in the tree
+        :param root: Directory to watch
+        """
+        if _libc is None:
+            raise OSError('inotify is not supported on this platform')
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.root = root
+        self.watches = {}  # Watch descriptor -> folder path
+        self.add_tree(root)
+
+    def add_watch(self, path):
+        """
+        Watch a single folder
+        :param path: Folder path
+        :return: None
+        """
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # The folder was removed before it could be watched
+                return
+            # e.g. ENOSPC when fs.inotify.max_user_watches is reached
+            raise OSError(err, '{}: {}'.format(os.strerror(err), path))
+        self.watches[wd] = path
+
+    def add_tree(self, path):
+        """
+        Watch a folder and every folder inside it
+        :param path: Folder path
+        :return: None
+        """
+        for dir, subdirs, files in os.walk(path):
+            self.add_watch(dir)
+
+    def remove_tree(self, path):
+        """
+        Stop watching a folder and every folder inside it (e.g. after it was moved out of its parent)
+        :param path: Folder path
+        :return: None
+        """
+        prefix = os.path.join(path, '')
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(prefix):
+                _libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_changes(self, timeout):
+        """
+        Wait for changes and read every queued event
+        :param timeout: Seconds to wait for the first event
+        :return: (paths, overflow). paths is the set of changed file/folder paths. Folders are only included when
+                 created, moved or deleted. overflow is True if the kernel queue overflowed and events were lost,
+                 in which case the caller must re-scan the whole tree.
+        """
+        changed = set()
+        overflow = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                folder = self.watches.get(wd)
+                if folder is None:
+                    continue
+                path = os.path.join(folder, name) if name else folder
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(path)
+                    elif mask & IN_MOVED_FROM:
+                        self.remove_tree(path)
+                    elif not mask & (IN_DELETE | IN_DELETE_SELF):
+                        # Attribute changes on folders are not tracked
+                        continue
+                changed.add(path)
+            readable, _, _ = select.select([self.fd], [], [], 0)
+        return changed, overflow
+
+    def close(self):
+        """
+        Stop watching and release the inotify file descriptor
+        :return: None
+        """
+        os.close(self.fd)
+        self.watches = {}
@@ -0,0 +1,183 @@
+from collections.abc import MutableMapping
+from utils.ServerFileUtils import ServerFileUtils
+import hashlib
+import os
+
+# Bytes in each entry digest and folder hash
+DIGEST_SIZE = 16
+# Hash of a folder with nothing in it
+EMPTY = '0' * (DIGEST_SIZE * 2)
+
+
+class MerkleTree(MutableMapping):
+    """
+    Per-folder Merkle hashes over the server's file and folder metadata, so a client can tell whether a whole subtree
+    matches its own copy with one comparison, and find what differs by descending only into folders whose hash
+    differs. Wraps the metadata table: every entry set or removed updates the hashes of the folders above it. Folders
+    are in the tree if they have metadata of their own or hold something that does.
+    A folder's hash combines the digests of the entries in it by XOR, so an update costs one read and write per
+    ancestor folder, however many entries each folder holds.
+    """
+
+    def __init__(self, meta_db, tree_db, sync_dir):
+        """
+        :param meta_db: SqliteDict database (or ServerStore table) for tracked file and folder metadata
+        :param tree_db: SqliteDict database (or ServerStore table, or dict) for folder path -> folder hash
+        :param sync_dir: Server sync directory, the root of the tree
+        """
+        self.db = meta_db
+        self.tree_db = tree_db
+        self.root = os.path.normpath(sync_dir)
+
+    def __getitem__(self, key):
+        return self.db[key]
+
+    def __setitem__(self, key, meta):
+        old = self.db.get(key)
+        self.db[key] = meta
+        if isinstance(meta, dict) and meta.get('type') == 'folder':
+            if self.tree_db.get(key) is None:
+                self.tree_db[key] = EMPTY
+                self.update(key, None, MerkleTree.folder_digest(os.path.basename(key), EMPTY))
+        else:
+            self.update(key, MerkleTree.file_digest(os.path.basename(key), old),
+                        MerkleTree.file_digest(os.path.basename(key), meta))
+
+    def __delitem__(self, key):
+        if self.pop(key, None) is None:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.db)
+
+    def __len__(self):
+        return len(self.db)
+
+    def keys(self):
+        return self.db.keys()
+
+    def keys_with_prefix(self, prefix):
+        return ServerFileUtils.keys_with_prefix(self.db, prefix)
+
+    def get_for_update(self, key, default=None):
+        return getattr(self.db, 'get_for_update', self.db.get)(key, default)
+
+    def commit(self):
+        self.db.commit()
+        if hasattr(self.tree_db, 'commit'):
+            self.tree_db.commit()
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry. Removing a folder also forgets the hashes of every folder inside it, even folders that were
+        only created to hold files (and so have no metadata of their own)
+        :param key: Path of the file/folder
+        :param default: Value if the key is not present
+        :return: Metadata of the entry, or default
+        """
+        meta = self.db.pop(key, default)
+        folder_hash = self.tree_db.get(key)
+        if folder_hash is not None:
+            prefix = os.path.join(key, '')
+            for path in ServerFileUtils.keys_with_prefix(self.tree_db, prefix):
+                self.tree_db.pop(path, None)
+            self.tree_db.pop(key, None)
+            self.update(key, MerkleTree.folder_digest(os.path.basename(key), folder_hash), None)
+        elif meta is not default:
+            self.update(key, MerkleTree.file_digest(os.path.basename(key), meta), None)
+        return meta
+
+    def update(self, path, old, new):
+        """
+        Replace the digest of an entry in its folder's hash, and carry the change up to the root
+        :param path: Path of the file/folder
+        :param old: Previous digest of the entry, or None if it was not in the tree
+        :param new: New digest of the entry, or None if it has been removed
+        :return: None
+        """
+        while old != new and path != self.root and path.startswith(os.path.join(self.root, '')):
+            folder = os.path.dirname(path)
+            folder_hash = self.tree_db.get(folder)
+            if folder_hash is None and new is None:
+                # The folder (and so the entry's digest) was already removed
+                return
+            combined = int(folder_hash or EMPTY, 16) ^ int(old or EMPTY, 16) ^ int(new or EMPTY, 16)
+            new_hash = '{:0{}x}'.format(combined, DIGEST_SIZE * 2)
+            name = os.path.basename(folder)
+            old = None if folder_hash is None else MerkleTree.folder_digest(name, folder_hash)
+            if new_hash == EMPTY and folder != self.root and self.db.get(folder) is None:
+                # A folder only created to hold files leaves the tree once it is empty, as if it was never recorded
+                self.tree_db.pop(folder, None)
+                new = None
+            else:
+                self.tree_db[folder] = new_hash
+                new = MerkleTree.folder_digest(name, new_hash)
+            path = folder
+
+    def rebuild(self):
+        """
+        Recompute every folder hash from the metadata table, e.g. for a database written before the tree was kept
+        :return: None
+        """
+        for path in list(self.tree_db.keys()):
+            self.tree_db.pop(path, None)
+        self.tree_db[self.root] = EMPTY
+        for path in list(self.db.keys()):
+            meta = self.db[path]
+            if isinstance(meta, dict) and meta.get('type') == 'folder':
+                if self.tree_db.get(path) is None:
+                    self.tree_db[path] = EMPTY
+                    self.update(path, None, MerkleTree.folder_digest(os.path.basename(path), EMPTY))
+            else:
+                self.update(path, None, MerkleTree.file_digest(os.path.basename(path), meta))
+        self.commit()
+
+    def entries(self, folder):
+        """
+        Get the digest of each entry in a folder, to find which differ from a client's copy
+        :param folder: Folder path
+        :return: Dictionary of name -> digest, or None if the folder is not in the tree
+        """
+        if self.tree_db.get(folder) is None:
+            return None
+        entries = {}
+        with os.scandir(folder) as listing:
+            for entry in listing:
+                folder_hash = self.tree_db.get(entry.path) if entry.is_dir(follow_symlinks=False) else None
+                if folder_hash is not None:
+                    entries[entry.name] = MerkleTree.folder_digest(entry.name, folder_hash)
+                elif not entry.is_dir(follow_symlinks=False):
+                    digest = MerkleTree.file_digest(entry.name, self.db.get(entry.path))
+                    if digest is not None:
+                        entries[entry.name] = digest
+        return entries
+
+    @staticmethod
+    def file_digest(name, meta):
+        """
+        Get the digest of a file entry, over its name and the metadata clients hold for it
+        :param name: File name
+        :param meta: Dictionary of file metadata (md5, size and modified), or None
+        :return: Hex digest, or None if there is no file
+        """
+        if not isinstance(meta, dict) or meta.get('type') != 'file':
+            return None
+        return MerkleTree.digest('file', name, meta['md5'], str(meta['size']), repr(float(meta['modified'])))
+
+    @staticmethod
+    def folder_digest(name, folder_hash):
+        """
+        Get the digest of a folder entry, over its name and the hash of everything in it
+        :param name: Folder name
+        :param folder_hash: Hash of the folder
+        :return: Hex digest
+        """
+        return MerkleTree.digest('folder', name, folder_hash)
+
+    @staticmethod
+    def digest(*fields):
+        """
+        :param fields: Strings to hash
+        :return: Hex digest
+        """
+        return hashlib.blake2b('\0'.join(fields).encode('utf-8'), digest_size=DIGEST_SIZE).hexdigest()
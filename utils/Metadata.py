@@ -1,35 +1,130 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 import json
 import base64
+import struct
 
+# Size of each block read from disk or from a request stream when transferring file binaries
+CHUNK_SIZE = 1024 * 1024
+# HTTP header carrying the JSON metadata of a streamed (application/octet-stream) upload
+METADATA_HEADER = 'X-DropNot-Metadata'
+# HTTP header carrying the byte offset a resumable upload continues from
+OFFSET_HEADER = 'X-DropNot-Offset'
 
+# Content-Type of request bodies holding binary frames rather than JSON
+FRAME_CONTENT_TYPE = 'application/x-dropnot-frame'
+# Version of the frame format, bumped whenever a record layout changes
+FRAME_VERSION = 1
+# Every frame starts with the format version, the record type and the length of the record body that follows
+FRAME_HEADER = struct.Struct('!BBI')
+# Record types. An encoding record is a file record whose binary follows the frame, sent as is (size bytes long)
+FILE_RECORD, FOLDER_RECORD, ENCODING_RECORD, OPERATION_RECORD = range(1, 5)
+# File record: modified, size, sync, path length, digest length. Followed by the UTF-8 path and the ASCII digest
+FILE_FIELDS = struct.Struct('!dQ?HB')
+# Folder record: modified, sync, path length. Followed by the UTF-8 path
+FOLDER_FIELDS = struct.Struct('!d?H')
+# Operation record: op code, path length. Followed by the UTF-8 path and the operation's argument
+OPERATION_FIELDS = struct.Struct('!BH')
+# Batch operation -> op code in an operation record
+OPERATION_CODES = {'create': 1, 'update': 2, 'delete': 3, 'move': 4, 'exists': 5}
+
+
+def slotted(cls):
+    """
+    Recreate a dataclass with __slots__ instead of a per-instance __dict__, like dataclass(slots=True) on Python 3.10+
+    :param cls: Dataclass
+    :return: Equivalent dataclass with __slots__
+    """
+    names = tuple(field.name for field in fields(cls))
+    # Field defaults are already baked into the generated __init__, and would clash with the slots as class attributes
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names and key not in ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+def pack_file_record(record, path, modified, md5, size, sync):
+    """
+    Write a file's metadata as a binary frame
+    :param record: FILE_RECORD, or ENCODING_RECORD if the file binary follows the frame
+    :return: bytearray
+    """
+    path_bytes = path.encode('utf-8')
+    digest = md5.encode('ascii')
+    offset = FRAME_HEADER.size + FILE_FIELDS.size
+    frame = bytearray(offset + len(path_bytes) + len(digest))
+    FRAME_HEADER.pack_into(frame, 0, FRAME_VERSION, record, len(frame) - FRAME_HEADER.size)
+    FILE_FIELDS.pack_into(frame, FRAME_HEADER.size, modified, size, sync, len(path_bytes), len(digest))
+    frame[offset:offset + len(path_bytes)] = path_bytes
+    frame[offset + len(path_bytes):] = digest
+    return frame
+
+
+@slotted
 @dataclass
 class FileMetadata:
     """
-    Represent a file's metadata and serialise it to a JSON string
+    Represent a file's metadata and serialise it to a JSON string or a binary frame.
+    md5 holds the content digest: plain hex for MD5, or '<algorithm>:<hex>' for other hash algorithms
     """
     path: str
     modified: float
     md5: str
     size: int
     sync: False  # Whether the item is synced to the server, false by default.
+    modified_ns: int = None  # Exact modified time in nanoseconds, only tracked locally (not transmitted)
+    inode: str = None  # 'device:inode' of the file, only tracked locally to detect moves (not transmitted)
 
     # Define JSON representation for REST transmission
     def __repr__(self):
-        return json.dumps({
+        return json.dumps(self.to_dict())
+
+    def to_dict(self):
+        """
+        Get the metadata as transmitted in JSON
+        :return: dict
+        """
+        return {
             'path': self.path,
             'modified': self.modified,
             'md5': self.md5,
             'size': self.size,
             'type': 'file',
             'sync': self.sync
-        })
+        }
+
+    def pack(self, binary=False):
+        """
+        Serialise the metadata to a binary frame
+        :param binary: (optional) Whether the file binary is sent straight after the frame (an encoding record)
+        :return: bytearray
+        """
+        return pack_file_record(ENCODING_RECORD if binary else FILE_RECORD, self.path, self.modified, self.md5,
+                                self.size, self.sync)
 
+    @classmethod
+    def unpack(cls, body):
+        """
+        Read the metadata from the body of a file (or encoding) record
+        :param body: Bytes-like record body
+        :return: FileMetadata
+        :raises ValueError: if the record is malformed
+        """
+        try:
+            modified, size, sync, path_length, digest_length = FILE_FIELDS.unpack_from(body)
+            offset = FILE_FIELDS.size + path_length
+            if len(body) != offset + digest_length:
+                raise ValueError('File record has the wrong length')
+            return cls(str(body[FILE_FIELDS.size:offset], 'utf-8'), modified, str(body[offset:], 'ascii'), size,
+                       sync)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError('Malformed file record: {}'.format(e))
 
+
+@slotted
 @dataclass
 class FileEncoding:
     """
-    Represent a file's binary content + metadata, and serialise it to a JSON string
+    Represent a file's binary content + metadata, and serialise it to a JSON string or a binary frame
     """
     bin: bytes
     path: str
@@ -39,16 +134,32 @@ class FileEncoding:
 
     # Define JSON representation for REST transmission
     def __repr__(self):
-        return json.dumps({
+        return json.dumps(self.to_dict())
+
+    def to_dict(self):
+        """
+        Get the file as transmitted in JSON, with the binary base64 encoded
+        :return: dict
+        """
+        return {
             'bin': base64.b64encode(self.bin).decode('ascii'),
             'path': self.path,
             'modified': self.modified,
             'md5': self.md5,
             'size': self.size,
             'type': 'file'
-        })
+        }
+
+    def pack(self):
+        """
+        Serialise the metadata to a binary frame. The binary is not copied into the frame: it is sent as is, straight
+        after the frame
+        :return: bytearray
+        """
+        return pack_file_record(ENCODING_RECORD, self.path, self.modified, self.md5, self.size, False)
 
 
+@slotted
 @dataclass
 class FolderEncoding:
     """
@@ -57,12 +168,213 @@ class FolderEncoding:
     path: str
     modified: float
     sync: False  # Whether the item is synced to the server, false by default.
+    inode: str = None  # 'device:inode' of the folder, only tracked locally to detect moves (not transmitted)
 
     # Define JSON representation for REST transmission
     def __repr__(self):
-        return json.dumps({
+        return json.dumps(self.to_dict())
+
+    def to_dict(self):
+        """
+        Get the metadata as transmitted in JSON
+        :return: dict
+        """
+        return {
             'path': self.path,
             'modified': self.modified,
             'type': 'folder',
             'sync': self.sync
-        })
+        }
+
+    def to_value(self):
+        """
+        Get the value to store in the client tracker database
+        :return: dict
+        """
+        value = self.to_dict()
+        if self.inode is not None:
+            value['inode'] = self.inode
+        return value
+
+    def pack(self):
+        """
+        Serialise the metadata to a binary frame
+        :return: bytearray
+        """
+        path_bytes = self.path.encode('utf-8')
+        offset = FRAME_HEADER.size + FOLDER_FIELDS.size
+        frame = bytearray(offset + len(path_bytes))
+        FRAME_HEADER.pack_into(frame, 0, FRAME_VERSION, FOLDER_RECORD, len(frame) - FRAME_HEADER.size)
+        FOLDER_FIELDS.pack_into(frame, FRAME_HEADER.size, self.modified, self.sync, len(path_bytes))
+        frame[offset:] = path_bytes
+        return frame
+
+    @classmethod
+    def unpack(cls, body):
+        """
+        Read the metadata from the body of a folder record
+        :param body: Bytes-like record body
+        :return: FolderEncoding
+        :raises ValueError: if the record is malformed
+        """
+        try:
+            modified, sync, path_length = FOLDER_FIELDS.unpack_from(body)
+            if len(body) != FOLDER_FIELDS.size + path_length:
+                raise ValueError('Folder record has the wrong length')
+            return cls(str(body[FOLDER_FIELDS.size:], 'utf-8'), modified, sync)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError('Malformed folder record: {}'.format(e))
+
+
+class Frame:
+    """
+    Reads binary frames, and reads/writes batches of operations as frames
+    """
+
+    @staticmethod
+    def read(buffer, offset=0):
+        """
+        Read the frame starting at an offset in a buffer
+        :param buffer: Bytes-like object
+        :param offset: Position of the frame in the buffer
+        :return: (record type, memoryview of the record body, offset of the next frame)
+        :raises ValueError: if the frame is truncated or of an unsupported version
+        """
+        if len(buffer) - offset < FRAME_HEADER.size:
+            raise ValueError('Truncated frame')
+        version, record, length = FRAME_HEADER.unpack_from(buffer, offset)
+        if version != FRAME_VERSION:
+            raise ValueError('Unsupported frame version: {}'.format(version))
+        start = offset + FRAME_HEADER.size
+        if len(buffer) < start + length:
+            raise ValueError('Truncated frame')
+        return record, memoryview(buffer)[start:start + length], start + length
+
+    @staticmethod
+    def read_stream(stream):
+        """
+        Read one frame from a stream, leaving anything after it (e.g. a file binary) unread
+        :param stream: File-like object
+        :return: (record type, record body), or None if the stream has ended
+        :raises ValueError: if the frame is truncated or of an unsupported version
+        """
+        header = stream.read(FRAME_HEADER.size)
+        if not header:
+            return None
+        header += Frame.read_exactly(stream, FRAME_HEADER.size - len(header))
+        version, record, length = FRAME_HEADER.unpack(header)
+        if version != FRAME_VERSION:
+            raise ValueError('Unsupported frame version: {}'.format(version))
+        return record, Frame.read_exactly(stream, length)
+
+    @staticmethod
+    def read_exactly(stream, size):
+        """
+        Read an exact number of bytes from a stream
+        :param stream: File-like object
+        :param size: Number of bytes
+        :return: bytes
+        :raises ValueError: if the stream ends first
+        """
+        data = bytearray()
+        while len(data) < size:
+            block = stream.read(size - len(data))
+            if not block:
+                raise ValueError('Truncated frame')
+            data += block
+        return bytes(data)
+
+    @staticmethod
+    def unpack_item(record, body):
+        """
+        Read the metadata of a file or folder record, as it would be transmitted in JSON
+        :param record: FILE_RECORD, ENCODING_RECORD or FOLDER_RECORD
+        :param body: Bytes-like record body
+        :return: Dictionary of item metadata
+        :raises ValueError: if the record is malformed or of another type
+        """
+        if record in (FILE_RECORD, ENCODING_RECORD):
+            return FileMetadata.unpack(body).to_dict()
+        elif record == FOLDER_RECORD:
+            return FolderEncoding.unpack(body).to_dict()
+        raise ValueError('Unexpected record type: {}'.format(record))
+
+    @staticmethod
+    def pack_operations(operations):
+        """
+        Serialise a batch of operations to a buffer of operation frames
+        :param operations: List of batch operations, {"op": "create"|"update", "path": ..., "data": FileMetadata or
+                           FolderEncoding}, {"op": "delete", "path": ..., "data": {"type": ...}},
+                           {"op": "move", "path": ..., "data": {"to": ...}} or {"op": "exists", "md5": ...}
+        :return: bytes
+        """
+        buffer = bytearray()
+        for operation in operations:
+            op = operation['op']
+            if op == 'exists':
+                path, argument = operation['md5'], b''
+            elif op == 'delete':
+                path = operation['path']
+                argument = bytes([FOLDER_RECORD if operation['data']['type'] == 'folder' else FILE_RECORD])
+            elif op == 'move':
+                path, argument = operation['path'], operation['data']['to'].encode('utf-8')
+            else:
+                path, argument = operation['path'], operation['data'].pack()
+            path_bytes = path.encode('utf-8')
+            start = len(buffer)
+            buffer += bytes(FRAME_HEADER.size + OPERATION_FIELDS.size)
+            FRAME_HEADER.pack_into(buffer, start, FRAME_VERSION, OPERATION_RECORD,
+                                   OPERATION_FIELDS.size + len(path_bytes) + len(argument))
+            OPERATION_FIELDS.pack_into(buffer, start + FRAME_HEADER.size, OPERATION_CODES[op], len(path_bytes))
+            buffer += path_bytes
+            buffer += argument
+        return bytes(buffer)
+
+    @staticmethod
+    def unpack_operations(buffer):
+        """
+        Read a batch of operation frames into the operations they would be transmitted as in JSON
+        :param buffer: Bytes-like object
+        :return: List of batch operation dictionaries. An unknown op code gives an operation without a valid 'op'
+        :raises ValueError: if a frame is malformed
+        """
+        ops = {code: op for op, code in OPERATION_CODES.items()}
+        operations = []
+        offset = 0
+        while offset < len(buffer):
+            record, body, offset = Frame.read(buffer, offset)
+            if record != OPERATION_RECORD:
+                raise ValueError('Unexpected record type: {}'.format(record))
+            try:
+                code, path_length = OPERATION_FIELDS.unpack_from(body)
+                path_end = OPERATION_FIELDS.size + path_length
+                if len(body) < path_end:
+                    raise ValueError('Operation record has the wrong length')
+                path = str(body[OPERATION_FIELDS.size:path_end], 'utf-8')
+                operations.append(Frame.unpack_operation(ops.get(code, code), path, body[path_end:]))
+            except (struct.error, UnicodeDecodeError) as e:
+                raise ValueError('Malformed operation record: {}'.format(e))
+        return operations
+
+    @staticmethod
+    def unpack_operation(op, path, argument):
+        """
+        Read the argument of an operation record
+        :param op: Batch operation name, or the op code if it is unknown
+        :param path: Path (or digest, for 'exists') the operation applies to
+        :param argument: memoryview of the rest of the record
+        :return: Batch operation dictionary
+        """
+        if op == 'exists':
+            return {'op': op, 'md5': path}
+        elif op == 'delete':
+            item_type = 'folder' if argument == bytes([FOLDER_RECORD]) else 'file'
+            return {'op': op, 'path': path, 'data': {'type': item_type}}
+        elif op == 'move':
+            return {'op': op, 'path': path, 'data': {'to': str(argument, 'utf-8')}}
+        elif op in ('create', 'update'):
+            record, item, end = Frame.read(argument)
+            if end != len(argument):
+                raise ValueError('Operation record has the wrong length')
+            return {'op': op, 'path': path, 'data': Frame.unpack_item(record, item)}
+        return {'op': op, 'path': path}
@@ -0,0 +1,178 @@
+from threading import Condition
+from utils.DirectoryListener import ChangeType
+import os
+import logging
+import time
+
+# Seconds before the first retry of a failed operation. The delay doubles with each further failure
+RETRY_DELAY = 5
+# Longest delay between retries
+MAX_RETRY_DELAY = 60 * 60
+# Number of failed attempts after which an operation is given up on
+MAX_ATTEMPTS = 10
+
+
+class Outbox:
+    """
+    Durable queue of sync operations that failed, to be retried with exponential backoff.
+    Operations are keyed by path: further changes to a path that is waiting to be retried are merged into its pending
+    operation (several edits collapse into one upload, and a creation followed by a deletion cancels out), and each
+    operation is given up on after a bounded number of attempts. The queue is kept in the client tracker database, so
+    pending operations are retried after a restart.
+    """
+
+    def __init__(self, db, retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY, max_attempts=MAX_ATTEMPTS,
+                 give_up_callback=None):
+        """
+        Initialise the Outbox
+        :param db: TrackerIndex of path -> {"change": ChangeType, "attempts": ..., "due": timestamp, "version": ...}
+        :param retry_delay: Seconds before the first retry of a failed operation
+        :param max_retry_delay: Longest delay between retries
+        :param max_attempts: Number of failed attempts after which an operation is given up on
+        :param give_up_callback: (optional) Function taking the path and ChangeType of an operation given up on, to
+                                 have the change detected (and synced) again on a later scan
+        """
+        self.db = db
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.give_up_callback = give_up_callback
+        self.condition = Condition()
+        # Path -> version of the pending operation when it was taken to be retried
+        self.retrying = {}
+
+    def __contains__(self, path):
+        return path in self.db
+
+    def __len__(self):
+        return len(self.db)
+
+    def pending(self, path):
+        """
+        Check whether a path, or anything inside it, has an operation waiting to be retried
+        :param path: Absolute path of a file/folder
+        :return: True if an operation is pending
+        """
+        prefix = os.path.join(path, '')
+        return any(key == path or key.startswith(prefix) for key in self.db.keys())
+
+    @staticmethod
+    def merge(pending, change):
+        """
+        Combine a pending operation with a later change to the same path
+        :param pending: ChangeType of the pending operation
+        :param change: ChangeType of the later change
+        :return: ChangeType to sync, or None if the two cancel out
+        """
+        if (pending, change) in ((ChangeType.CreatedFile, ChangeType.DeletedFile),
+                                 (ChangeType.CreatedFolder, ChangeType.DeletedFolder)):
+            # The server never received the item, so there is nothing to delete
+            return None
+        if (pending, change) == (ChangeType.CreatedFile, ChangeType.ModifiedFile):
+            # The server has not received the file yet, so it is still a creation
+            return ChangeType.CreatedFile
+        return change
+
+    def coalesce(self, path, change):
+        """
+        Merge a change into the path's pending operation, if it has one. The merged operation is sent when the pending
+        operation is next retried, rather than straight away.
+        :param path: Absolute path of the changed file/folder
+        :param change: ChangeType of the change
+        :return: True if the change was merged (and must not be synced now), False if the path has nothing pending
+        """
+        with self.condition:
+            entry = self.db.get(path)
+            if entry is None:
+                return False
+            merged = Outbox.merge(entry['change'], change)
+            if merged is None and path not in self.retrying:
+                self.db.pop(path)
+            else:
+                # A retry in progress still syncs the old operation, so a cancelled one becomes the deletion
+                entry = dict(entry, change=change if merged is None else merged, version=entry['version'] + 1)
+                self.db[path] = entry
+            self.db.flush()
+            self.condition.notify_all()
+            return True
+
+    def defer(self, path, change):
+        """
+        Record that an operation failed, scheduling it to be retried after an exponentially increasing delay.
+        A change merged into the path's pending operation since it was retried is kept. Once the last attempt has
+        failed, the operation is dropped and passed to the give_up_callback.
+        :param path: Absolute path of the file/folder
+        :param change: ChangeType of the failed operation
+        :return: True if the operation will be retried, False if it has been given up on
+        """
+        with self.condition:
+            self.retrying.pop(path, None)
+            entry = self.db.get(path) or {'change': change, 'attempts': 0, 'version': 0}
+            attempts = entry['attempts'] + 1
+            if attempts <= self.max_attempts:
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+                self.db[path] = dict(entry, attempts=attempts, due=time.time() + delay)
+                self.db.flush()
+                self.condition.notify_all()
+                logging.warning('Sync failed, retrying in {}s:{}'.format(delay, path))
+                return True
+            logging.error('Giving up syncing after {} attempts:{}'.format(entry['attempts'], path))
+            self.db.pop(path)
+            self.db.flush()
+        if self.give_up_callback is not None:
+            self.give_up_callback(path, entry['change'])
+        return False
+
+    def complete(self, path):
+        """
+        Record that an operation on a path succeeded, removing its pending operation. If a change was merged into the
+        pending operation since it was retried (or it was not the operation that succeeded), it is retried straight
+        away instead.
+        :param path: Absolute path of the file/folder
+        :return: None
+        """
+        with self.condition:
+            version = self.retrying.pop(path, None)
+            entry = self.db.get(path)
+            if entry is None:
+                return
+            if version == entry['version']:
+                self.db.pop(path)
+            else:
+                self.db[path] = dict(entry, due=time.time())
+            self.db.flush()
+            self.condition.notify_all()
+
+    def take_due(self):
+        """
+        Take the operations that are due to be retried. Each must be followed by complete() or defer()
+        :return: List of (path, ChangeType)
+        """
+        with self.condition:
+            now = time.time()
+            due = []
+            for path in self.db.keys():
+                entry = self.db.get(path)
+                if path not in self.retrying and entry['due'] <= now:
+                    self.retrying[path] = entry['version']
+                    due.append((path, entry['change']))
+            return due
+
+    def wait(self, timeout=None):
+        """
+        Block until an operation is due to be retried
+        :param timeout: (optional) Longest time to wait, in seconds
+        :return: True if an operation is due, False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                wake = [self.db.get(path)['due'] for path in self.db.keys() if path not in self.retrying]
+                now = time.time()
+                if wake and min(wake) <= now:
+                    return True
+                if deadline is not None:
+                    if deadline <= now:
+                        return False
+                    wake.append(deadline)
+                self.condition.wait(min(wake) - now if wake else None)
@@ -2,6 +2,44 @@ import os
 import shutil
 import hashlib
 import base64
+import uuid
+import time
+from utils.Metadata import CHUNK_SIZE, ENCODING_RECORD, Frame
+from utils.Chunking import ContentChunker, MAX_CHUNK_SIZE
+from utils.Hashing import ContentHash
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where reflinks are not attempted
+    fcntl = None
+
+# ioctl request number for cloning a file's extents (reflink) on Linux (Btrfs, XFS, ...)
+FICLONE = 0x40049409
+# Suffix of temporary files that uploads are written to before being renamed into place
+TEMP_SUFFIX = '.dropnot-tmp'
+# Resumable upload sessions without progress for this many seconds are discarded, with their partial data
+UPLOAD_TTL = 24 * 60 * 60
+# Seconds without progress after which a resumable upload's writer is presumed dead, so another request may resume it
+UPLOAD_CLAIM_TIMEOUT = 120
+# A resumable upload flushes the bytes it has received to disk and acknowledges them after this many bytes, or this
+# many seconds (which also keeps its claim on the session alive on slow links)
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+CHECKPOINT_INTERVAL = 30
+
+
+class UploadOffsetError(Exception):
+    """
+    Raised when a resumable upload is continued from a different offset than the server has acknowledged, or while
+    another request is still writing it
+    """
+
+    def __init__(self, offset):
+        """
+        :param offset: Offset the upload should continue from
+        """
+        super().__init__('Upload continues from offset {}'.format(offset))
+        self.offset = offset
 
 
 class ServerFileUtils:
@@ -9,6 +47,53 @@ class ServerFileUtils:
     Utility functions for the server to handle file-related operations
     """
 
+    @staticmethod
+    def read_for_update(db, key, default=None):
+        """
+        Read a value that is about to be modified. Tables that support it (ServerStore tables) take the write lock
+        first, so concurrent requests cannot interleave their changes and lose one
+        :param db: SqliteDict database (or ServerStore table)
+        :param key: Key to read
+        :param default: Value if the key is not present
+        :return: Value
+        """
+        get = getattr(db, 'get_for_update', db.get)
+        return get(key, default)
+
+
+    @staticmethod
+    def keys_with_prefix(db, prefix):
+        """
+        Get every key starting with a prefix, e.g. the paths inside a folder. Tables that support it (ServerStore
+        tables) find them from the key index, others are scanned
+        :param db: SqliteDict database (or ServerStore table, or dict)
+        :param prefix: Key prefix
+        :return: List of keys
+        """
+        if hasattr(db, 'keys_with_prefix'):
+            return db.keys_with_prefix(prefix)
+        return [key for key in db.keys() if key.startswith(prefix)]
+
+
+    @staticmethod
+    def resolve_path(sync_dir, path):
+        """
+        Get the server path of an item from the path a client sent, relative to the sync directory
+        :param sync_dir: Server sync directory
+        :param path: Folder/file path, relative to the sync directory
+        :return: Folder/file path on the server
+        :raises KeyError: if the path leads outside the sync directory (an absolute path, '..' or a symlink)
+        """
+        if not isinstance(path, str):
+            raise KeyError('Invalid path: {}'.format(path))
+        target_path = os.path.normpath(os.path.join(sync_dir, path))
+        root = os.path.realpath(sync_dir)
+        real_path = os.path.realpath(target_path)
+        if real_path != root and not real_path.startswith(os.path.join(root, '')):
+            raise KeyError('Path is outside the sync directory: {}'.format(path))
+        return target_path
+
+
     @staticmethod
     def new_folder(meta_db, target_path, meta):
         """
@@ -24,16 +109,31 @@ class ServerFileUtils:
 
 
     @staticmethod
-    def remove_folder(meta_db, target_path):
+    def remove_folder(meta_db, target_path, hash_db=None, ref_db=None, chunk_db=None):
         """
         Remove folder(s) in the server sync directory
         :param meta_db: SqliteDict database for tracked file and folder metadata
         :param target_path: Where to sync files to on the server
+        :param hash_db: (optional) SqliteDict database for tracked file MD5 hashes
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
         :return: None
         """
+        # Drop the metadata and content references of everything inside the folder. The folder itself goes first, so a
+        # MerkleTree forgets the hashes of all the folders inside it at once, rather than one subfolder at a time
+        ServerFileUtils.read_for_update(meta_db, target_path)
+        meta_db.pop(target_path, None)
+        prefix = os.path.join(target_path, '')
+        removed = {}
+        for path in ServerFileUtils.keys_with_prefix(meta_db, prefix):
+            removed[path] = meta_db.pop(path, None)
+        meta_db.commit()
+        if hash_db is not None:
+            for path, meta in removed.items():
+                if isinstance(meta, dict) and 'md5' in meta:
+                    ServerFileUtils.remove_reference(hash_db, ref_db, meta['md5'], path, chunk_db=chunk_db)
+
         try:
-            meta_db.pop(target_path, None)
-            meta_db.commit()
             shutil.rmtree(target_path)
         except FileNotFoundError:
             # The folder might not necessarily be on the server
@@ -41,13 +141,362 @@ class ServerFileUtils:
 
 
     @staticmethod
-    def set_file(hash_db, meta_db, target_file, data_dict):
+    def move_item(hash_db, meta_db, source_path, target_path, ref_db=None):
+        """
+        Move or rename a file or folder in the server sync directory with a single os.rename, carrying the metadata and
+        content references of everything moved over to the new paths
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param source_path: File/folder path to move on the server
+        :param target_path: Path to move it to on the server
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :return: None
+        """
+        ServerFileUtils.read_for_update(meta_db, source_path)
+        if not os.path.lexists(source_path):
+            raise FileNotFoundError('Nothing to move at', source_path)
+        if os.path.lexists(target_path):
+            raise FileExistsError('Move target already exists', target_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.rename(source_path, target_path)
+
+        prefix = os.path.join(source_path, '')
+        moved = [source_path]
+        if os.path.isdir(target_path):
+            moved.extend(ServerFileUtils.keys_with_prefix(meta_db, prefix))
+        references = []
+        for path in moved:
+            meta = meta_db.pop(path, None)
+            if meta is None:
+                continue
+            new_path = target_path + path[len(source_path):]
+            meta_db[new_path] = meta
+            if isinstance(meta, dict) and 'md5' in meta:
+                references.append((meta['md5'], path, new_path))
+        meta_db.commit()
+        if hash_db is not None:
+            for md5, path, new_path in references:
+                ServerFileUtils.move_reference(hash_db, ref_db, md5, path, new_path)
+
+
+    @staticmethod
+    def move_reference(hash_db, ref_db, md5, source_file, target_file):
+        """
+        Record that the content a file holds has moved to a new path along with it.
+        A rename keeps the file's inode and modified time, so its stat fingerprint is carried over unchanged.
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param ref_db: SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+                       (None to skip ref counting)
+        :param md5: MD5 of the file's content
+        :param source_file: Path the file moved from
+        :param target_file: Path the file moved to
+        :return: None
+        """
+        if ref_db is not None:
+            holders = ServerFileUtils.read_for_update(ref_db, md5, {})
+            if source_file in holders:
+                holders[target_file] = holders.pop(source_file)
+                ref_db[md5] = holders
+                ref_db.commit()
+        if hash_db.get(md5) == source_file:
+            hash_db[md5] = target_file
+            hash_db.commit()
+
+
+    @staticmethod
+    def fingerprint(target_file):
+        """
+        Get the stat fingerprint of a file, used to check it is unchanged without re-reading its content
+        :param target_file: File path on the server
+        :return: [size, modified (ns), inode]
+        """
+        stat = os.stat(target_file)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+    @staticmethod
+    def add_reference(hash_db, ref_db, md5, target_file):
+        """
+        Record that a file holds the content with a given MD5
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param ref_db: SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+                       (None to skip ref counting)
+        :param md5: MD5 of the file's content
+        :param target_file: File path on the server
+        :return: None
+        """
+        if ref_db is not None:
+            holders = ServerFileUtils.read_for_update(ref_db, md5, {})
+            holders[target_file] = ServerFileUtils.fingerprint(target_file)
+            ref_db[md5] = holders
+            ref_db.commit()
+        hash_db[md5] = target_file  # Hash -> Path map
+        hash_db.commit()
+
+
+    @staticmethod
+    def remove_reference(hash_db, ref_db, md5, target_file, chunk_db=None):
+        """
+        Record that a file no longer holds the content with a given MD5.
+        The hash map entry is only removed once no other file holds the same content.
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param ref_db: SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+                       (None to skip ref counting)
+        :param md5: MD5 of the file's old content
+        :param target_file: File path on the server
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list, whose entry for the content is
+                         removed along with its hash map entry
+        :return: None
+        """
+        holders = {} if ref_db is None else ServerFileUtils.read_for_update(ref_db, md5, {})
+        holders.pop(target_file, None)
+        if holders:
+            ref_db[md5] = holders
+            ref_db.commit()
+            if hash_db.get(md5) == target_file:
+                # Point the hash map at a file that still holds the content
+                hash_db[md5] = next(iter(holders))
+                hash_db.commit()
+        else:
+            if ref_db is not None:
+                ref_db.pop(md5, None)
+                ref_db.commit()
+            hash_db.pop(md5, None)
+            hash_db.commit()
+            if chunk_db is not None:
+                chunk_db.pop(md5, None)
+                chunk_db.commit()
+
+
+    @staticmethod
+    def find_content(hash_db, ref_db, md5):
+        """
+        Find a file on the server that still holds the content with a given MD5.
+        Holders are verified against the stat fingerprint recorded when they were written, rather than by re-hashing,
+        and holders that have changed since are forgotten.
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param ref_db: SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+                       (None to verify by re-hashing the file in hash_db)
+        :param md5: MD5 to look up
+        :return: Path of a file holding the content, or None
+        """
+        if ref_db is None:
+            return ServerFileUtils.find_content_by_hashing(hash_db, md5)
+
+        holders = ref_db.get(md5, {})
+        if not holders:
+            # Hash map entries written before reference tracking have no fingerprint, so are verified by hashing
+            return ServerFileUtils.find_content_by_hashing(hash_db, md5)
+
+        found = None
+        stale = {}
+        for path, fingerprint in holders.items():
+            try:
+                if ServerFileUtils.fingerprint(path) == fingerprint:
+                    found = path
+                    break
+            except FileNotFoundError:
+                pass
+            # The file was modified or removed outside of DropNot since it was written
+            stale[path] = fingerprint
+
+        if stale:
+            # Re-read under the write lock, and only forget holders that have not been re-written meanwhile
+            holders = ServerFileUtils.read_for_update(ref_db, md5, {})
+            for path, fingerprint in stale.items():
+                if holders.get(path) == fingerprint:
+                    holders.pop(path)
+            if holders:
+                ref_db[md5] = holders
+            else:
+                ref_db.pop(md5, None)
+            ref_db.commit()
+        if found is None and not holders:
+            hash_db.pop(md5, None)
+            hash_db.commit()
+        elif found is not None and hash_db.get(md5) != found:
+            hash_db[md5] = found
+            hash_db.commit()
+        return found
+
+
+    @staticmethod
+    def find_content_by_hashing(hash_db, md5):
+        """
+        Find the file on the server mapped to an MD5, verifying its content by re-hashing it
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param md5: MD5 to look up
+        :return: Path of the file holding the content, or None
+        """
+        try:
+            existing_path = hash_db[md5]
+            content_hash = ContentHash.for_digest(md5)
+            with open(existing_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    content_hash.update(chunk)
+        except (KeyError, FileNotFoundError):
+            return None
+
+        if md5 == content_hash.digest():
+            return existing_path
+        # If the DB's stored MD5 map does not match the file's actual MD5
+        # (This could happen if the file was modified server-side after it was originally synced)
+        hash_db.pop(md5, None)
+        hash_db[content_hash.digest()] = existing_path
+        hash_db.commit()
+        return None
+
+
+    @staticmethod
+    def compare_manifest(meta_db, sync_dir, entries):
+        """
+        Compare a client's manifest of its sync directory against the server's copy, to find what the client must send.
+        A file matches if the server holds a file at its path with the same size and modified time (and digest, if the
+        manifest gives one computed with the same algorithm). Items the server holds that are missing from the
+        manifest are left alone, as the client has no record of whether it deleted them.
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param sync_dir: Server sync directory
+        :param entries: List of {"path": ..., "type": "file", "size": ..., "modified": ..., "md5": ... (optional)} and
+                        {"path": ..., "type": "folder"}, with paths relative to the sync directory
+        :return: (operations, synced). operations: list of {"op": "create"|"update", "path": ..., "type": ...} the
+                 client must send. synced: dictionary of path -> digest of the files (None for folders) that match
+        :raises KeyError: if an entry is missing a field, or its path leads outside the sync directory
+        """
+        operations = []
+        synced = {}
+        for entry in entries:
+            path = entry['path']
+            target_path = ServerFileUtils.resolve_path(sync_dir, path)
+            meta = meta_db.get(target_path)
+            if entry['type'] == 'folder':
+                if os.path.isdir(target_path):
+                    synced[path] = None
+                else:
+                    operations.append({'op': 'create', 'path': path, 'type': 'folder'})
+                continue
+
+            md5 = entry.get('md5')
+            if (meta is not None and meta.get('type') == 'file' and meta['size'] == entry['size']
+                    and meta['modified'] == entry['modified'] and os.path.isfile(target_path)
+                    and (md5 is None or ContentHash.algorithm_of(md5) != ContentHash.algorithm_of(meta['md5'])
+                         or md5 == meta['md5'])):
+                synced[path] = meta['md5']
+            else:
+                op = 'update' if os.path.isfile(target_path) else 'create'
+                operations.append({'op': op, 'path': path, 'type': 'file'})
+        return operations, synced
+
+
+    @staticmethod
+    def replace_reference(hash_db, meta_db, ref_db, md5, target_file, chunk_db=None):
+        """
+        Move a file's content reference from its previous content (if any) to a new MD5
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param ref_db: SqliteDict database for MD5 -> {path: fingerprint} (None to skip ref counting)
+        :param md5: MD5 of the file's new content
+        :param target_file: File path on the server
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
+        :return: None
+        """
+        old_meta = ServerFileUtils.read_for_update(meta_db, target_file)
+        if isinstance(old_meta, dict) and 'md5' in old_meta and old_meta['md5'] != md5:
+            ServerFileUtils.remove_reference(hash_db, ref_db, old_meta['md5'], target_file, chunk_db=chunk_db)
+        ServerFileUtils.add_reference(hash_db, ref_db, md5, target_file)
+
+
+    @staticmethod
+    def temp_path(target_file):
+        """
+        Get a unique temporary path next to a target file. Files are written here and then renamed over the target,
+        so a file that shares its content (hard link) with other files is never modified in place.
+        :param target_file: File path on the server
+        :return: Temporary file path in the same folder
+        """
+        folder, name = os.path.split(target_file)
+        return os.path.join(folder, '.{}.{}{}'.format(name, uuid.uuid4().hex[:8], TEMP_SUFFIX))
+
+
+    @staticmethod
+    def materialise(source_file, target_file):
+        """
+        Create a file with identical content to an existing file, without copying its data where possible.
+        A reflink (copy-on-write clone) is tried first, then a hard link, then a normal copy.
+        :param source_file: Existing file holding the content
+        :param target_file: File path to create or replace on the server
+        :return: None
+        """
+        temp_file = ServerFileUtils.temp_path(target_file)
+        try:
+            try:
+                if fcntl is None:
+                    raise OSError('Reflinks are not supported on this platform')
+                with open(source_file, 'rb') as src, open(temp_file, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                try:
+                    os.link(source_file, temp_file)
+                except OSError:
+                    shutil.copyfile(source_file, temp_file)
+            os.replace(temp_file, target_file)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+
+    @staticmethod
+    def write_file(target_file, meta, blocks):
+        """
+        Write a file from blocks of bytes, hashing each block as it is written so the file is never read back.
+        The file is written to a temporary path and only renamed over the target once its digest (using the algorithm
+        named by the metadata digest) and size match the metadata and it has been flushed to disk, so a corrupt upload
+        never replaces the existing copy.
+        :param target_file: File path to create or replace on the server
+        :param meta: Dictionary containing the file's metadata
+        :param blocks: Iterable of the file's bytes
+        :return: Digest of the written file
+        """
+        writer = UploadWriter(target_file, meta)
+        try:
+            for block in blocks:
+                writer.write(block)
+            return writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+
+    @staticmethod
+    def record_file(hash_db, meta_db, target_file, meta, md5, ref_db=None, chunk_db=None):
+        """
+        Record a file that has been written to the server sync directory
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param target_file: File path on the server
+        :param meta: Dictionary containing the file's metadata
+        :param md5: Digest of the file's content
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
+        :return: None
+        """
+        ServerFileUtils.replace_reference(hash_db, meta_db, ref_db, md5, target_file, chunk_db=chunk_db)
+        meta_db[target_file] = meta  # Path -> Metadata map
+        meta_db.commit()
+
+
+    @staticmethod
+    def set_file(hash_db, meta_db, target_file, data_dict, ref_db=None, chunk_db=None):
         """
         Create or update a file in the server sync directory
         :param hash_db: SqliteDict database for tracked file MD5 hashes
         :param meta_db: SqliteDict database for tracked file and folder metadata
         :param target_file: File path to create on the server
         :param data_dict: Dictionary containing file binary & metadata
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
         :return: None
         """
         # Ensure folder structure exists
@@ -55,52 +504,427 @@ class ServerFileUtils:
 
         # Check if dict contains binary (if not, look up the file contents from the md5 hash map)
         if 'bin' in data_dict:
-            # Create file from binary
-            md5_hash = hashlib.md5()
-            with open(target_file, 'wb+') as file:
-                bytes = base64.b64decode(data_dict['bin'])
-                file.write(bytes)
-                # Read back file and verify MD5 to ensure it transferred correctly
-                file.seek(0)
-                md5_hash.update(file.read())
-
-            # Set 'modified' metadata for file
-            os.utime(target_file, (data_dict['modified'], data_dict['modified']))
-
-            # Verify MD5 of file to ensure it transferred correctly
-            if md5_hash.hexdigest() != data_dict['md5']:
-                raise IOError('File', data_dict['path'],
-                              'is corrupt (MD5 before transmission and after transmission do not match)')
-
-            hash_db[md5_hash.hexdigest()] = target_file  # Hash -> Path map
-            hash_db.commit()
+            # Create file from binary, hashing it as it is written
+            md5 = ServerFileUtils.write_file(target_file, data_dict, [base64.b64decode(data_dict['bin'])])
             data_dict.pop('bin', None)  # Remove binary data, only save metadata to DB
-            meta_db[target_file] = data_dict  # Path -> Metadata map
-            meta_db.commit()
+            ServerFileUtils.record_file(hash_db, meta_db, target_file, data_dict, md5, ref_db=ref_db, chunk_db=chunk_db)
         else:
             # Create file by cloning another file with matching MD5 hash
-            duplicate_file_path = hash_db[data_dict['md5']]
-            # Copy the identical file into the new file, saving bandwidth :)
-            shutil.copyfile(duplicate_file_path, target_file)
-            meta_db[target_file] = data_dict
-            meta_db.commit()
+            duplicate_file_path = ServerFileUtils.find_content(hash_db, ref_db, data_dict['md5'])
+            if duplicate_file_path is None:
+                raise KeyError('No file with MD5 {} on the server'.format(data_dict['md5']))
+            if duplicate_file_path != target_file:
+                # Link the identical file into the new file, saving bandwidth and disk space :)
+                ServerFileUtils.materialise(duplicate_file_path, target_file)
+            ServerFileUtils.record_file(hash_db, meta_db, target_file, data_dict, data_dict['md5'], ref_db=ref_db,
+                                        chunk_db=chunk_db)
+
+
+    @staticmethod
+    def set_file_stream(hash_db, meta_db, target_file, meta, stream, ref_db=None, chunk_db=None):
+        """
+        Create or update a file in the server sync directory from a binary stream.
+        The stream is written to disk and hashed in fixed-size chunks, so memory use does not grow with the file size
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param target_file: File path to create on the server
+        :param meta: Dictionary containing the file's metadata
+        :param stream: File-like object to read the file binary from
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
+        :return: None
+        """
+        # Ensure folder structure exists
+        os.makedirs(os.path.split(target_file)[0], exist_ok=True)
+
+        md5 = ServerFileUtils.write_file(target_file, meta, iter(lambda: stream.read(CHUNK_SIZE), b''))
+        ServerFileUtils.record_file(hash_db, meta_db, target_file, meta, md5, ref_db=ref_db, chunk_db=chunk_db)
+
+
+    @staticmethod
+    def unpack_files(hash_db, meta_db, sync_dir, stream, ref_db=None, results=None, chunk_db=None):
+        """
+        Create or update many files from a pack: a stream of encoding frames, each followed by the file binary it
+        describes. Each file is written straight into place and checked against the digest in its frame, so one
+        corrupt file does not fail the others. Each folder is only created once, however many files the pack puts in it.
+        The metadata of the files is only recorded once the whole pack has been read, so a transaction around it does
+        not hold the database's write lock while a slow client is still sending the pack
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param sync_dir: Server sync directory
+        :param stream: File-like object to read the pack from
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param results: (optional) List to append the results to, so they are kept if the pack is malformed
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
+        :return: List of (path, status, message) in pack order. 200 success. 400 path outside the sync directory.
+                 422 file corrupted in transmission.
+        :raises ValueError: if the pack is malformed, once the files before the malformed frame have been recorded
+        """
+        results = [] if results is None else results
+        written = []
+        folders = set()
+        remaining = 0
+
+        def read_binary():
+            # Blocks of the current file's binary, stopping at its size so the next frame is left unread
+            nonlocal remaining
+            while remaining > 0:
+                block = stream.read(min(CHUNK_SIZE, remaining))
+                if not block:
+                    return
+                remaining -= len(block)
+                yield block
+
+        try:
+            while True:
+                frame = Frame.read_stream(stream)
+                if frame is None:
+                    return results
+                record, body = frame
+                if record != ENCODING_RECORD:
+                    raise ValueError('Expected a file encoding record, got record type {}'.format(record))
+                meta = Frame.unpack_item(record, body)
+                remaining = meta['size']
+                try:
+                    target_file = ServerFileUtils.resolve_path(sync_dir, meta['path'])
+                    folder = os.path.dirname(target_file)
+                    if folder not in folders:
+                        os.makedirs(folder, exist_ok=True)
+                        folders.add(folder)
+                    written.append((target_file, meta, ServerFileUtils.write_file(target_file, meta, read_binary())))
+                    results.append((meta['path'], 200, 'OK'))
+                except (KeyError, IOError) as e:
+                    # Skip what is left of the file, to carry on from the next frame
+                    for _ in read_binary():
+                        pass
+                    if remaining > 0:
+                        raise ValueError('Pack ended inside the binary of {}'.format(meta['path']))
+                    results.append((meta['path'], 400 if isinstance(e, KeyError) else 422, str(e)))
+        finally:
+            for target_file, meta, md5 in written:
+                ServerFileUtils.record_file(hash_db, meta_db, target_file, meta, md5, ref_db=ref_db, chunk_db=chunk_db)
+
+
+    @staticmethod
+    def get_chunks(meta_db, chunk_db, target_file):
+        """
+        Get the content-defined chunks of a file already on the server, used as the basis for a delta upload.
+        Chunk lists are cached by file MD5, so a file is only chunked the first time it is used as a basis.
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param chunk_db: SqliteDict database caching MD5 -> chunk list
+        :param target_file: File path on the server
+        :return: List of [md5, size] for each chunk, in file order
+        """
+        md5 = meta_db[target_file]['md5']
+        try:
+            return chunk_db[md5]
+        except KeyError:
+            with open(target_file, 'rb') as file:
+                chunks = ContentChunker().chunk_list(file)
+            chunk_db[md5] = chunks
+            chunk_db.commit()
+            return chunks
+
+    @staticmethod
+    def set_file_delta(hash_db, meta_db, chunk_db, target_file, meta, chunks, stream, ref_db=None):
+        """
+        Update a file in the server sync directory from a delta upload.
+        The new file is rebuilt from chunks of the existing file plus the new chunks read from the stream.
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param chunk_db: SqliteDict database caching MD5 -> chunk list
+        :param target_file: File path to update on the server
+        :param meta: Dictionary containing the file's new metadata
+        :param chunks: List of [md5, size] for each chunk of the new file, in order
+        :param stream: File-like object holding the binary of each chunk the server did not have, in order
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :return: None
+        :raises ValueError: if a chunk is larger than the chunker makes them, before anything is read
+        """
+        for md5, size in chunks:
+            if not isinstance(size, int) or not 0 < size <= MAX_CHUNK_SIZE:
+                raise ValueError('Invalid size {} for chunk {}'.format(size, md5))
+
+        # Offsets of each chunk in the existing file
+        basis = {}
+        offset = 0
+        for md5, size in ServerFileUtils.get_chunks(meta_db, chunk_db, target_file):
+            basis.setdefault(md5, offset)
+            offset += size
+
+        temp_file = ServerFileUtils.temp_path(target_file)
+        content_hash = ContentHash.for_digest(meta['md5'])
+        written = {}  # Offsets of chunks already written to the new file
+        offset = 0
+        try:
+            with open(target_file, 'rb') as old, open(temp_file, 'wb+') as new:
+                for md5, size in chunks:
+                    if md5 in written:
+                        new.seek(written[md5])
+                        data = new.read(size)
+                        new.seek(offset)
+                    elif md5 in basis:
+                        old.seek(basis[md5])
+                        data = old.read(size)
+                    else:
+                        data = stream.read(size)
+
+                    if len(data) != size or hashlib.md5(data).hexdigest() != md5:
+                        raise IOError('File', meta['path'], 'is corrupt (chunk {} does not match)'.format(md5))
+                    written.setdefault(md5, offset)
+                    content_hash.update(data)
+                    new.write(data)
+                    offset += size
+
+                if content_hash.digest() != meta['md5'] or offset != meta['size']:
+                    raise IOError('File', meta['path'],
+                                  'is corrupt (MD5 before transmission and after transmission do not match)')
+                new.flush()
+                os.fsync(new.fileno())
+            os.utime(temp_file, (meta['modified'], meta['modified']))
+            os.replace(temp_file, target_file)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+        chunk_db[meta['md5']] = chunks
+        chunk_db.commit()
+        ServerFileUtils.record_file(hash_db, meta_db, target_file, meta, meta['md5'], ref_db=ref_db, chunk_db=chunk_db)
+
+    @staticmethod
+    def checkpoint(db):
+        """
+        Persist the writes made to a database so far, even if the rest of the request's transaction is rolled back
+        :param db: SqliteDict database (or ServerStore table)
+        :return: None
+        """
+        getattr(db, 'checkpoint', db.commit)()
 
 
     @staticmethod
-    def remove_file(hash_db, meta_db, target_file):
+    def upload_id(target_file, md5):
+        """
+        Get the ID of the resumable upload session for a file's content. It is derived from the target and digest, so
+        a client resuming after an interruption finds the same session without having to remember it
+        :param target_file: File path on the server
+        :param md5: Digest of the file's content
+        :return: Session ID
+        """
+        return hashlib.sha256('{}\0{}'.format(target_file, md5).encode('utf-8')).hexdigest()[:32]
+
+
+    @staticmethod
+    def open_upload(upload_db, target_file, meta):
+        """
+        Start a resumable upload session for a file, or find the session of an interrupted upload of the same content
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :param target_file: File path to create or replace on the server
+        :param meta: Dictionary containing the file's metadata
+        :return: (session ID, offset the upload continues from). Raises UploadOffsetError if another request is still
+                 writing the session
+        """
+        if not isinstance(meta.get('size'), int) or not isinstance(meta.get('md5'), str):
+            raise KeyError('Invalid metadata for a resumable upload')
+        ServerFileUtils.expire_uploads(upload_db)
+        upload_id = ServerFileUtils.upload_id(target_file, meta['md5'])
+        session = ServerFileUtils.read_for_update(upload_db, upload_id)
+        if session is not None and ServerFileUtils.upload_claimed(session):
+            raise UploadOffsetError(session['offset'])
+        if session is None or not os.path.exists(session['partial']):
+            os.makedirs(os.path.split(target_file)[0], exist_ok=True)
+            session = {'path': target_file, 'partial': ServerFileUtils.temp_path(target_file), 'offset': 0,
+                       'owner': None}
+            open(session['partial'], 'wb').close()
+        session['meta'] = meta
+        session['updated'] = time.time()
+        upload_db[upload_id] = session
+        upload_db.commit()
+        return upload_id, session['offset']
+
+
+    @staticmethod
+    def expire_uploads(upload_db):
+        """
+        Discard resumable upload sessions that have made no progress for UPLOAD_TTL seconds
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :return: None
+        """
+        expired = [upload_id for upload_id, session in upload_db.items()
+                   if time.time() - session['updated'] > UPLOAD_TTL]
+        for upload_id in expired:
+            ServerFileUtils.discard_upload(upload_db, upload_id)
+
+
+    @staticmethod
+    def discard_upload(upload_db, upload_id):
+        """
+        Discard a resumable upload session and its partial data
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :param upload_id: Session ID
+        :return: None
+        """
+        session = upload_db.pop(upload_id, None)
+        upload_db.commit()
+        if session is not None and os.path.exists(session['partial']):
+            os.remove(session['partial'])
+
+
+    @staticmethod
+    def upload_claimed(session):
+        """
+        Check whether a resumable upload session is being written by a request that is still making progress
+        :param session: Upload session
+        :return: True if the session is claimed
+        """
+        return session['owner'] is not None and time.time() - session['updated'] < UPLOAD_CLAIM_TIMEOUT
+
+
+    @staticmethod
+    def claim_upload(upload_db, upload_id, offset):
+        """
+        Take ownership of a resumable upload session to continue writing it. The claim is persisted straight away,
+        so other requests see it while this one streams.
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :param upload_id: Session ID
+        :param offset: Offset the client continues the upload from
+        :return: (session, UploadWriter positioned at the offset)
+        """
+        session = ServerFileUtils.read_for_update(upload_db, upload_id)
+        if session is None:
+            raise FileNotFoundError('No upload session {}'.format(upload_id))
+        if ServerFileUtils.upload_claimed(session) or offset != session['offset']:
+            raise UploadOffsetError(session['offset'])
+        session['owner'] = uuid.uuid4().hex
+        session['updated'] = time.time()
+        upload_db[upload_id] = session
+        ServerFileUtils.checkpoint(upload_db)
+
+        # Reopened after the claim is committed, as rebuilding the hash of a large partial file takes a while
+        writer = UploadWriter(session['path'], session['meta'], partial_file=session['partial'],
+                              offset=session['offset'])
+        if writer.size != session['offset']:
+            # Partial data the server acknowledged has been lost
+            ServerFileUtils.acknowledge_upload(upload_db, upload_id, session, writer, release=True)
+            writer.close()
+            raise UploadOffsetError(writer.size)
+        return session, writer
+
+
+    @staticmethod
+    def acknowledge_upload(upload_db, upload_id, session, writer, release=False):
+        """
+        Flush the bytes a resumable upload has received to disk, and record the offset it can be resumed from
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :param upload_id: Session ID
+        :param session: Session claimed with claim_upload()
+        :param writer: The session's UploadWriter
+        :param release: Whether to give up ownership of the session (when the request ends)
+        :return: None
+        """
+        offset = writer.checkpoint()
+        current = ServerFileUtils.read_for_update(upload_db, upload_id)
+        if current is None or current['owner'] != session['owner']:
+            # The session was taken over by another request after this one stalled
+            writer.close()
+            raise UploadOffsetError(current['offset'] if current is not None else 0)
+        session['offset'] = offset
+        session['updated'] = time.time()
+        if release:
+            session['owner'] = None
+        upload_db[upload_id] = session
+        ServerFileUtils.checkpoint(upload_db)
+
+
+    @staticmethod
+    def append_upload(hash_db, meta_db, upload_db, upload_id, offset, stream, ref_db=None, chunk_db=None):
+        """
+        Continue a resumable upload from a binary stream. Received bytes are acknowledged every CHECKPOINT_SIZE bytes (or
+        CHECKPOINT_INTERVAL seconds) and whenever the stream ends or breaks off, so an interrupted upload can be resumed from there. Once every byte
+        has been received, the file is verified and moved into place.
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :param upload_id: Session ID
+        :param offset: Offset the stream starts at
+        :param stream: File-like object to read the next bytes of the file from
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
+        :return: Offset received up to. The upload is complete when this equals the file size
+        """
+        session, writer = ServerFileUtils.claim_upload(upload_db, upload_id, offset)
+        try:
+            for block in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                writer.write(block)
+                if ServerFileUtils.should_acknowledge(session, writer):
+                    ServerFileUtils.acknowledge_upload(upload_db, upload_id, session, writer)
+        except BaseException:
+            # The connection dropped (which servers report in different ways, often as an IOError): keep what was
+            # received. Should the data be corrupt, the file's digest will not match once the upload completes
+            ServerFileUtils.acknowledge_upload(upload_db, upload_id, session, writer, release=True)
+            writer.close()
+            raise
+        return ServerFileUtils.end_upload(hash_db, meta_db, upload_db, upload_id, session, writer, ref_db=ref_db,
+                                          chunk_db=chunk_db)
+
+
+    @staticmethod
+    def should_acknowledge(session, writer):
+        """
+        Check whether a resumable upload has received enough since its last acknowledgement to acknowledge again
+        :param session: Session claimed with claim_upload()
+        :param writer: The session's UploadWriter
+        :return: True if acknowledge_upload() should be called
+        """
+        return (writer.size - session['offset'] >= CHECKPOINT_SIZE
+                or time.time() - session['updated'] >= CHECKPOINT_INTERVAL)
+
+
+    @staticmethod
+    def end_upload(hash_db, meta_db, upload_db, upload_id, session, writer, ref_db=None, chunk_db=None):
+        """
+        Finish a request continuing a resumable upload. The file is moved into place if every byte has been received,
+        otherwise the offset is acknowledged so the upload can be resumed.
+        :param hash_db: SqliteDict database for tracked file MD5 hashes
+        :param meta_db: SqliteDict database for tracked file and folder metadata
+        :param upload_db: SqliteDict database for upload session ID -> session
+        :param upload_id: Session ID
+        :param session: Session claimed with claim_upload()
+        :param writer: The session's UploadWriter
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
+        :return: Offset received up to
+        """
+        if writer.size < session['meta']['size']:
+            ServerFileUtils.acknowledge_upload(upload_db, upload_id, session, writer, release=True)
+            writer.close()
+            return writer.size
+        try:
+            md5 = writer.finish()
+        finally:
+            # The partial data is either in place or corrupt
+            ServerFileUtils.discard_upload(upload_db, upload_id)
+        ServerFileUtils.record_file(hash_db, meta_db, session['path'], session['meta'], md5, ref_db=ref_db,
+                                    chunk_db=chunk_db)
+        return writer.size
+
+
+    @staticmethod
+    def remove_file(hash_db, meta_db, target_file, ref_db=None, chunk_db=None):
         """
         Remove a file in the server sync directory
         :param hash_db: SqliteDict database for tracked file MD5 hashes
         :param meta_db: SqliteDict database for tracked file and folder metadata
         :param target_file: File path to create on the server
+        :param ref_db: (optional) SqliteDict database for MD5 -> {path: fingerprint} of files holding that content
+        :param chunk_db: (optional) SqliteDict database caching MD5 -> chunk list
         :return: None
         """
         try:
-            # Remove DB entries for removed file
-            md5 = meta_db[target_file]['md5']
-            hash_db.pop(md5, None)
+            # Remove DB entries for removed file. The MD5 stays mapped while other files hold the same content
+            md5 = ServerFileUtils.read_for_update(meta_db, target_file, {})['md5']
+            ServerFileUtils.remove_reference(hash_db, ref_db, md5, target_file, chunk_db=chunk_db)
             meta_db.pop(target_file, None)
-            hash_db.commit()
             meta_db.commit()
             # Remove target file
             os.remove(target_file)
@@ -110,3 +934,95 @@ class ServerFileUtils:
         except KeyError:
             # Handle case where file for deletion is missing from MD5 hash DB or metadata DB.
             pass
+
+
+class UploadWriter:
+    """
+    Writes an uploaded file block by block to a temporary file next to its target, hashing each block as it is
+    written. The file only replaces its target once its digest and size are verified against the metadata.
+    """
+
+    def __init__(self, target_file, meta, partial_file=None, offset=0):
+        """
+        Create the temporary file (and the target's folders), or reopen the partial file of a resumable upload
+        :param target_file: File path to create or replace on the server
+        :param meta: Dictionary containing the file's metadata
+        :param partial_file: (optional) Partial file to continue writing
+        :param offset: (optional) Bytes of the partial file already received. Any data beyond this is discarded
+        """
+        self.target_file = target_file
+        self.meta = meta
+        self.content_hash = ContentHash.for_digest(meta['md5'])
+        self.size = 0
+        os.makedirs(os.path.split(target_file)[0], exist_ok=True)
+        if partial_file is None:
+            self.temp_file = ServerFileUtils.temp_path(target_file)
+            self.file = open(self.temp_file, 'wb')
+            return
+
+        # Hash states cannot be saved, so the hash of the bytes received so far is rebuilt by reading them back
+        self.temp_file = partial_file
+        self.file = open(partial_file, 'r+b' if os.path.exists(partial_file) else 'w+b')
+        for block in iter(lambda: self.file.read(min(CHUNK_SIZE, offset - self.size)), b''):
+            self.content_hash.update(block)
+            self.size += len(block)
+        self.file.truncate(self.size)
+
+    def write(self, block):
+        """
+        Hash and write the next block of the file
+        :param block: bytes
+        :return: None
+        """
+        if self.size + len(block) > self.meta.get('size', float('inf')):
+            raise IOError('Upload of', self.meta['path'], 'is larger than expected')
+        self.content_hash.update(block)
+        self.file.write(block)
+        self.size += len(block)
+
+    def finish(self):
+        """
+        Verify the file, flush it to disk and rename it over the target. The temporary file is removed on failure.
+        :return: Digest of the written file
+        """
+        try:
+            # Verify MD5 and size of file to ensure it transferred correctly
+            if self.content_hash.digest() != self.meta['md5'] or self.size != self.meta.get('size', self.size):
+                raise IOError('File', self.meta['path'],
+                              'is corrupt (MD5 before transmission and after transmission do not match)')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+            # Set 'modified' metadata for file
+            os.utime(self.temp_file, (self.meta['modified'], self.meta['modified']))
+            os.replace(self.temp_file, self.target_file)
+        except BaseException:
+            self.abort()
+            raise
+        return self.content_hash.digest()
+
+    def checkpoint(self):
+        """
+        Flush the bytes written so far to disk
+        :return: Number of bytes written
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.size
+
+    def close(self):
+        """
+        Close the temporary file, keeping it to be resumed
+        :return: None
+        """
+        self.file.close()
+
+    def abort(self):
+        """
+        Discard the temporary file
+        :return: None
+        """
+        self.file.close()
+        if os.path.exists(self.temp_file):
+            os.remove(self.temp_file)
@@ -0,0 +1,263 @@
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from threading import Lock, local
+import sqlite3
+import json
+
+
+class ServerStore:
+    """
+    The server's metadata tables, kept in a single SQLite database in WAL mode.
+    Connections are pooled, and each transaction holds its own, so the database can be shared by many threads and
+    worker processes. Within transaction(), SQLite's write lock is taken at the first write (or read for update), and
+    every write is committed together at the end, so the tables never drift apart and a request costs one commit.
+    Tables use the same layout as SqliteDict, so existing server_tracker.db files can be opened.
+    """
+
+    def __init__(self, filename, timeout=30):
+        """
+        Open (or create) the database
+        :param filename: SQLite database file
+        :param timeout: Seconds to wait for another thread or process holding the write lock
+        """
+        self.filename = filename
+        self.timeout = timeout
+        self.local = local()
+        self.pool = []  # Idle connections
+        self.pool_lock = Lock()
+        self.tables = {}
+        conn = self.acquire()
+        conn.execute('PRAGMA journal_mode=WAL')
+        self.release(conn)
+
+    def acquire(self):
+        """
+        Take an idle connection from the pool, or open a new one
+        :return: sqlite3 Connection
+        """
+        with self.pool_lock:
+            if self.pool:
+                return self.pool.pop()
+        # Autocommit mode: transactions are started explicitly in lock()
+        conn = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        # In WAL mode NORMAL only syncs at checkpoints, while still keeping the database consistent after a crash
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def release(self, conn):
+        """
+        Return a connection to the pool
+        :param conn: sqlite3 Connection
+        :return: None
+        """
+        with self.pool_lock:
+            self.pool.append(conn)
+
+    def table(self, name):
+        """
+        Get a dict-like view of a table, creating the table if needed
+        :param name: Table name
+        :return: StoreTable
+        """
+        if name not in self.tables:
+            self.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value BLOB)'.format(name))
+            self.tables[name] = StoreTable(self, name)
+        return self.tables[name]
+
+    def in_transaction(self):
+        """
+        :return: True if the calling thread is inside a transaction
+        """
+        return getattr(self.local, 'depth', 0) > 0
+
+    def begin(self):
+        """
+        Start a transaction for the calling thread. Nested calls join the outer transaction.
+        :return: None
+        """
+        if not self.in_transaction():
+            self.local.conn = self.acquire()
+            self.local.depth = 0
+            self.local.locked = False
+        self.local.depth += 1
+
+    def lock(self):
+        """
+        Take the database write lock for the rest of the calling thread's transaction, waiting for other writers.
+        Called before the first write, and before reading values that are about to be modified.
+        :return: None
+        """
+        if self.in_transaction() and not self.local.locked:
+            self.local.conn.execute('BEGIN IMMEDIATE')
+            self.local.locked = True
+
+    def commit(self):
+        """
+        End the calling thread's transaction, committing its writes
+        :return: None
+        """
+        if not self.in_transaction():
+            # Already rolled back
+            return
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            self.end('COMMIT')
+
+    def checkpoint(self):
+        """
+        Commit the writes the calling thread's transaction has made so far, releasing the write lock, while keeping the
+        transaction open. Used by long-running requests to persist progress that must survive a later rollback.
+        :return: None
+        """
+        if self.in_transaction() and self.local.locked:
+            self.local.conn.execute('COMMIT')
+            self.local.locked = False
+
+    def rollback(self):
+        """
+        End the calling thread's transaction (if any), discarding its writes
+        :return: None
+        """
+        if self.in_transaction():
+            self.local.depth = 0
+            self.end('ROLLBACK')
+
+    def end(self, statement):
+        """
+        Finish the calling thread's transaction and return its connection to the pool
+        :param statement: 'COMMIT' or 'ROLLBACK'
+        :return: None
+        """
+        conn, self.local.conn = self.local.conn, None
+        self.local.locked = False
+        try:
+            if conn.in_transaction:
+                conn.execute(statement)
+        finally:
+            if conn.in_transaction:
+                # The commit failed, so the connection must not be reused with the transaction still open
+                conn.execute('ROLLBACK')
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group every write made by the calling thread into one transaction. Writes are discarded if an exception
+        escapes.
+        :return: Context manager
+        """
+        self.begin()
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def execute(self, sql, args=(), write=False):
+        """
+        Run a statement, in the calling thread's transaction if it has one
+        :param sql: SQL statement
+        :param args: Statement arguments
+        :param write: Whether the statement modifies the database
+        :return: List of result rows
+        """
+        if self.in_transaction():
+            if write:
+                self.lock()
+            return self.local.conn.execute(sql, args).fetchall()
+        conn = self.acquire()
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Close every idle connection
+        :return: None
+        """
+        with self.pool_lock:
+            for conn in self.pool:
+                conn.close()
+            self.pool = []
+
+
+class StoreTable(MutableMapping):
+    """
+    Dict-like view of one ServerStore table, with JSON-encoded values. A drop-in replacement for SqliteDict.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __getitem__(self, key):
+        rows = self.store.execute('SELECT value FROM "{}" WHERE key = ?'.format(self.name), (key,))
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, key, value):
+        self.store.execute('REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(self.name), (key, json.dumps(value)),
+                           write=True)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.store.execute('DELETE FROM "{}" WHERE key = ?'.format(self.name), (key,), write=True)
+
+    def get_for_update(self, key, default=None):
+        """
+        Read a value that is about to be modified, taking the write lock first so no other writer can change it
+        in between
+        :param key: Key
+        :param default: Value if the key is not present
+        :return: Value
+        """
+        self.store.lock()
+        return self.get(key, default)
+
+    def checkpoint(self):
+        """
+        Commit the writes made so far in the calling thread's transaction (see ServerStore.checkpoint)
+        :return: None
+        """
+        self.store.checkpoint()
+
+    def keys(self):
+        """
+        Get every key
+        :return: List of keys
+        """
+        return [row[0] for row in self.store.execute('SELECT key FROM "{}"'.format(self.name))]
+
+    def keys_with_prefix(self, prefix):
+        """
+        Get every key starting with a prefix, found with a range query on the key index instead of a table scan
+        :param prefix: Key prefix, e.g. a folder path ending in a separator
+        :return: List of keys
+        """
+        if not prefix:
+            return self.keys()
+        # Every key with the prefix sorts before the prefix with its last character incremented
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return [row[0] for row in self.store.execute('SELECT key FROM "{}" WHERE key >= ? AND key < ?'.format(self.name),
+                                                     (prefix, end))]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.store.execute('SELECT COUNT(*) FROM "{}"'.format(self.name))[0][0]
+
+    def __contains__(self, key):
+        return bool(self.store.execute('SELECT 1 FROM "{}" WHERE key = ?'.format(self.name), (key,)))
+
+    def commit(self):
+        """
+        No-op, for compatibility with SqliteDict. Writes are committed when their transaction ends, or immediately
+        when made outside of a transaction.
+        :return: None
+        """
+        pass
@@ -0,0 +1,146 @@
+from threading import RLock
+import json
+import time
+
+
+class TrackedFile:
+    """
+    Compact in-memory record of a tracked file on the client
+    """
+    __slots__ = ('modified', 'size', 'md5', 'sync', 'modified_ns', 'inode')
+
+    def __init__(self, modified, size, md5, sync, modified_ns=None, inode=None):
+        self.modified = modified
+        self.size = size
+        self.md5 = md5
+        self.sync = sync
+        self.modified_ns = modified_ns
+        self.inode = inode
+
+    @staticmethod
+    def from_metadata(metadata):
+        """
+        Create a TrackedFile from a file's FileMetadata
+        :param metadata: FileMetadata object
+        :return: TrackedFile
+        """
+        return TrackedFile(metadata.modified, metadata.size, metadata.md5, metadata.sync, metadata.modified_ns,
+                           metadata.inode)
+
+    @staticmethod
+    def from_value(value):
+        """
+        Create a TrackedFile from a stored tracker value
+        :param value: TrackedFile, dict, or JSON string (as stored by older versions)
+        :return: TrackedFile
+        """
+        if isinstance(value, TrackedFile):
+            return value
+        if isinstance(value, str):
+            value = json.loads(value)
+        return TrackedFile(value.get('modified'), value.get('size'), value.get('md5'), value.get('sync', False),
+                           value.get('modified_ns'), value.get('inode'))
+
+    def to_value(self):
+        """
+        Get the value to store in the tracker database
+        :return: dict
+        """
+        value = {'modified': self.modified, 'size': self.size, 'md5': self.md5, 'sync': self.sync}
+        if self.modified_ns is not None:
+            value['modified_ns'] = self.modified_ns
+        if self.inode is not None:
+            value['inode'] = self.inode
+        return value
+
+    def is_modified(self, modified_ns):
+        """
+        Check whether a file's modified time differs from the tracked one
+        :param modified_ns: Modified time of the file in nanoseconds (st_mtime_ns)
+        :return: True if the file was modified since it was tracked
+        """
+        if self.modified_ns is not None:
+            return modified_ns != self.modified_ns
+        # Entries tracked by older versions only hold the float modified time, which is not exact
+        return self.modified is None or abs(modified_ns / 10 ** 9 - self.modified) > 1e-6
+
+
+class TrackerIndex:
+    """
+    Dict-like in-memory index of a SqliteDict tracker table. Every entry is loaded once at start-up so lookups and
+    diffs never touch SQLite. Writes are applied in memory straight away, and written back in batched transactions.
+    """
+
+    def __init__(self, db, decode=None, encode=None, batch_size=1000, interval=5):
+        """
+        Initialise the TrackerIndex, loading every entry of the table
+        :param db: SqliteDict table to index
+        :param decode: (optional) Function converting a stored value to its in-memory form
+        :param encode: (optional) Function converting an in-memory value to its stored form
+        :param batch_size: commit() writes back once this many entries have changed
+        :param interval: commit() writes back once this many seconds have passed since the last write-back
+        """
+        self.db = db
+        self.encode = encode or (lambda value: value)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = RLock()
+        decode = decode or (lambda value: value)
+        self.entries = {key: decode(value) for key, value in db.items()}
+        self.dirty = set()  # Keys changed or removed since the last write-back
+        self.last_flush = time.monotonic()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.dirty.add(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def keys(self):
+        """
+        Get a snapshot of the keys
+        :return: Set of keys
+        """
+        with self.lock:
+            return set(self.entries)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            self.dirty.add(key)
+            return self.entries.pop(key, default)
+
+    def commit(self):
+        """
+        Write changes back to the database if enough have built up, or enough time has passed.
+        Changes not yet written back are lost if the process dies; those items are re-synced on the next start.
+        :return: None
+        """
+        if len(self.dirty) >= self.batch_size or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every change back to the database in a single transaction
+        :return: None
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            for key in dirty:
+                if key in self.entries:
+                    self.db[key] = self.encode(self.entries[key])
+                else:
+                    self.db.pop(key, None)
+            if dirty:
+                self.db.commit()
+            self.last_flush = time.monotonic()
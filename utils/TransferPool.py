@@ -0,0 +1,102 @@
+from collections import deque
+from threading import Thread, Condition, BoundedSemaphore
+import logging
+
+
+class TransferPool:
+    """
+    Bounded pool of worker threads for running sync operations concurrently.
+    Tasks submitted with the same key (e.g. the same path) run one at a time, in the order they were submitted.
+    """
+
+    def __init__(self, workers=4, max_pending=1000):
+        """
+        Initialise the TransferPool and start its worker threads
+        :param workers: Number of tasks to run concurrently
+        :param max_pending: Maximum number of queued + running tasks. submit() blocks when this is reached
+        """
+        self.slots = BoundedSemaphore(max_pending)
+        self.condition = Condition()
+        self.ready = deque()  # Tasks first in line for each of their keys, that no worker is running
+        self.pending = {}  # Key -> deque of its queued tasks, headed by the one running. Present while any remain
+        self.unfinished = 0
+        self.workers = []
+        for i in range(workers):
+            worker = Thread(name='transfer_worker_{}'.format(i), target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key, func, *args, block=True):
+        """
+        Queue a task. Blocks while the pool already holds max_pending tasks, so producers cannot queue unbounded work
+        :param key: Ordering key, or list of keys for a task covering several (e.g. an upload of many paths).
+                    Tasks sharing a key never run concurrently and run in submission order
+        :param func: Function to run
+        :param args: Arguments for the function
+        :param block: Apply backpressure. Tasks that queue follow-up work must pass False, as a worker blocking on a
+                      full pool could otherwise deadlock
+        :return: None
+        """
+        if block:
+            self.slots.acquire()
+        keys = list(dict.fromkeys(key)) if isinstance(key, list) else [key]
+        task = [keys, func, args, block]
+        with self.condition:
+            self.unfinished += 1
+            for key in keys:
+                self.pending.setdefault(key, deque()).append(task)
+            self.queue_if_ready(task)
+
+    def queue_if_ready(self, task):
+        """
+        Hand a task to the workers once it is first in line for every one of its keys. Call holding the condition
+        :param task: [keys, func, args, took_slot]
+        :return: None
+        """
+        if all(self.pending[key][0] is task for key in task[0]):
+            self.ready.append(task)
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until every submitted task has finished
+        :return: None
+        """
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def work(self):
+        """
+        Worker thread loop. Runs one queued task at a time
+        :return: None
+        """
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                task = self.ready.popleft()
+            keys, func, args, took_slot = task
+
+            try:
+                func(*args)
+            except Exception:
+                # A failed task must not kill the worker thread
+                logging.exception('Sync task failed:{}'.format(keys[0]))
+
+            with self.condition:
+                following = []
+                for key in keys:
+                    self.pending[key].popleft()
+                    if self.pending[key]:
+                        # More tasks were queued for this key while it was running
+                        following.append(self.pending[key][0])
+                    else:
+                        del self.pending[key]
+                for waiting in {id(waiting): waiting for waiting in following}.values():
+                    self.queue_if_ready(waiting)
+                self.unfinished -= 1
+                self.condition.notify_all()
+            if took_slot:
+                self.slots.release()